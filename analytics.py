@@ -0,0 +1,230 @@
+"""Per-user activity analytics, computed ahead of time.
+
+`flask analytics update` (run nightly) sums up the last
+`ANALYTICS_WEEKS` weeks of every user's activity. Each user gets one
+`user_activity` row of small integer arrays:
+
+    hours      messages posted in each hour of the day (UTC), 24 counts
+    weekdays   messages posted on each day of the week, Monday first
+    posts      messages posted each week, oldest week first
+    likes      likes received on their messages each week
+    followers  follower count at the end of each week
+
+The job takes users in id ranges of `ANALYTICS_CHUNK_USERS`. For each
+range it fetches bare (user id, timestamp) columns from messages, likes
+and follows, and counts them with one numpy bincount per array, indexed
+by (user, bucket). The profile page reads the stored row and never
+aggregates.
+
+Follower history is derived from the follows that exist now, so someone
+who followed and later unfollowed is not counted in earlier weeks.
+
+Arrays are stored as little-endian int32 bytes, so reading them back
+needs only the standard library.
+"""
+
+import sys
+from array import array
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+import sharding
+import snowflake
+from models import db, Follows, Likes, Message, User, UserActivity
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Activity = namedtuple('Activity', 'computed_at window_end hours weekdays '
+                      'posts likes followers')
+
+ARRAYS = ('hours', 'weekdays', 'posts', 'likes', 'followers')
+
+
+def pack(counts):
+    return np.asarray(counts, dtype='<i4').tobytes()
+
+
+def unpack(data):
+    values = array('i')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+
+def for_user(user_id):
+    """`user_id`'s stored Activity, or None if the job hasn't run yet."""
+
+    row = UserActivity.query.get(user_id)
+    if row is None:
+        return None
+    return Activity(row.computed_at, row.window_end,
+                    *(unpack(getattr(row, name)) for name in ARRAYS))
+
+
+def _sources():
+    """(engine, messages table, likes table) for every message database."""
+
+    router = sharding.get_router()
+    if router:
+        return [(engine, sharding.messages, sharding.likes)
+                for engine in router.shards]
+    return [(db.engine, Message.__table__, Likes.__table__)]
+
+
+def _columns(engine, query):
+    """The (user id, timestamp) rows of `query` as two numpy arrays."""
+
+    rows = engine.execute(query).fetchall()
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype='M8[s]')
+    users, times = zip(*rows)
+    return (np.array(users, dtype=np.int64),
+            np.array(times, dtype='M8[s]'))
+
+
+def _concat(pairs):
+    users, times = zip(*pairs)
+    return np.concatenate(users), np.concatenate(times)
+
+
+def aggregate(user_ids, posts, likes, follows, window_end, weeks):
+    """{array name: (len(user_ids), buckets) counts} for sorted `user_ids`.
+
+    `posts`, `likes` and `follows` are (user ids, datetime64 timestamps)
+    pairs: when each user posted, got a like, and got a follower.
+    """
+
+    n = len(user_ids)
+    end = np.datetime64(window_end, 's')
+    start = end - np.timedelta64(7 * weeks, 'D')
+    week = np.timedelta64(7, 'D')
+
+    def count(users, buckets, size):
+        # drop users not in `user_ids` (signed up after it was read), which
+        # would otherwise be counted on a neighbour's row or past the end
+        rows = np.searchsorted(user_ids, users)
+        known = rows < n
+        known[known] = user_ids[rows[known]] == users[known]
+        rows, buckets = rows[known], buckets[known]
+        return np.bincount(rows * size + buckets,
+                           minlength=n * size).reshape(n, size)
+
+    def in_window(pair):
+        users, times = pair
+        keep = (times >= start) & (times < end)
+        return users[keep], times[keep]
+
+    users, times = in_window(posts)
+    days = times.astype('M8[D]')
+    hours = (times.astype('M8[h]') - days).astype(np.int64)
+    # 1970-01-01 was a Thursday
+    weekdays = (days.astype(np.int64) + 3) % 7
+    post_weeks = ((times - start) // week).astype(np.int64)
+
+    like_users, like_times = in_window(likes)
+    like_weeks = ((like_times - start) // week).astype(np.int64)
+
+    # followers from before the window land in bucket 0, so the running
+    # total from there is the count at the end of each week
+    follow_users, follow_times = follows
+    follow_weeks = np.clip(((follow_times - start) // week).astype(np.int64)
+                           + 1, 0, weeks)
+    followers = np.cumsum(count(follow_users, follow_weeks, weeks + 1),
+                          axis=1)[:, 1:]
+
+    return {
+        'hours': count(users, hours, 24),
+        'weekdays': count(users, weekdays, 7),
+        'posts': count(users, post_weeks, weeks),
+        'likes': count(like_users, like_weeks, weeks),
+        'followers': followers,
+    }
+
+
+def _chunk(engine, user_ids, window_end, weeks):
+    lo, hi = int(user_ids[0]), int(user_ids[-1])
+    start = window_end - timedelta(weeks=weeks)
+    follows = Follows.__table__
+
+    posts, likes = [], []
+    for source, messages, likes_table in _sources():
+        posts.append(_columns(source, (
+            select([messages.c.user_id, messages.c.timestamp])
+            .where(messages.c.user_id.between(lo, hi))
+            # ids are time-ordered: an index range on (user_id, id)
+            .where(messages.c.id >= snowflake.lowest_id_at(start)))))
+        likes.append(_columns(source, (
+            select([messages.c.user_id, likes_table.c.created_at])
+            .select_from(likes_table.join(
+                messages, likes_table.c.message_id == messages.c.id))
+            .where(messages.c.user_id.between(lo, hi))
+            .where(likes_table.c.created_at >= start))))
+    followers = _columns(engine, (
+        select([follows.c.user_being_followed_id, follows.c.created_at])
+        .where(follows.c.user_being_followed_id.between(lo, hi))))
+
+    return aggregate(user_ids, _concat(posts), _concat(likes), followers,
+                     window_end, weeks)
+
+
+def update(engine, weeks=26, chunk_users=5000, now=None):
+    """Recompute everyone's activity arrays; return how many users."""
+
+    if np is None:
+        raise RuntimeError("activity analytics need numpy")
+
+    now = now or datetime.utcnow()
+    # whole days, so a nightly run covers the day just ended
+    window_end = datetime.combine(now.date() + timedelta(days=1), time())
+    table = UserActivity.__table__
+    users = User.__table__
+
+    total = 0
+    after = None
+    while True:
+        query = select([users.c.id]).order_by(users.c.id).limit(chunk_users)
+        if after is not None:
+            query = query.where(users.c.id > after)
+        user_ids = np.array([row[0] for row in engine.execute(query)],
+                            dtype=np.int64)
+        if not len(user_ids):
+            break
+
+        arrays = _chunk(engine, user_ids, window_end, weeks)
+        rows = [dict({name: pack(arrays[name][i]) for name in ARRAYS},
+                     user_id=int(user_id), computed_at=now,
+                     window_end=window_end)
+                for i, user_id in enumerate(user_ids)]
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(
+                table.c.user_id.between(int(user_ids[0]),
+                                        int(user_ids[-1]))))
+            conn.execute(table.insert(), rows)
+
+        after = int(user_ids[-1])
+        total += len(user_ids)
+    return total
+
+
+analytics_cli = AppGroup('analytics', help="Compute profile analytics.")
+
+
+@analytics_cli.command('update')
+def update_command():
+    """Recompute every user's activity analytics."""
+
+    if np is None:
+        raise click.UsageError("activity analytics need numpy")
+    config = current_app.config
+    count = update(db.engine, config['ANALYTICS_WEEKS'],
+                   config['ANALYTICS_CHUNK_USERS'])
+    click.echo(f"Updated activity for {count} users.")
@@ -1,35 +1,56 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
+import click
+from flask import (Blueprint, Flask, Response, render_template, request,
+                   flash, redirect, session, g, abort, current_app, jsonify,
+                   send_file, stream_with_context, url_for)
+from flask.cli import with_appcontext
+from flask_wtf.csrf import validate_csrf
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from wtforms import ValidationError
+
+import analytics
+import assets
+import bulk_import
+import events
+import export
+import highwater
+import influence
+import like_counts
+import metrics
+import slow_queries
+import social
+import images
+import partitions
+import pubsub
+import recommendations
+import sharding
+import tags
+import template_cache
+import trending
+from compression import CompressionMiddleware
+from config import PROFILES, default_profile, from_environ
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm
-from models import db, connect_db, User, Message, Likes
+from images import ImageError, VARIANTS, url_key, thumb_url
+from models import db, connect_db, User, Message, LikeCount
+from partitions import with_archived
+from pubsub import event_stream, get_broker, message_event
+from sharding import get_router
+from streaming import render_listing
+from write_buffer import get_write_buffer
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+bp = Blueprint('warbler', __name__)
 
-connect_db(app)
+FEED_PAGE_SIZE = 100
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -57,7 +78,7 @@ def do_logout():
         flash('You are not signed in!')
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -93,7 +114,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -113,7 +134,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -124,44 +145,82 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, most influential first.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username. Exact
+    and prefix matches come first; influence breaks ties.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.query.order_by(User.influence.desc(), User.id)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = (User
+                 .query
+                 .filter(User.username.like(f"%{search}%"))
+                 .order_by((User.username == search).desc(),
+                           User.username.like(f"{search}%").desc(),
+                           User.influence.desc(),
+                           User.id))
 
-    return render_template('users/index.html', users=users)
+    suggestions = []
+    if g.user and not search:
+        suggestions = recommendations.for_user(
+            g.user.id, current_app.config['RECOMMENDATIONS_SHOWN'])
 
+    return render_listing('users/index.html', users=users,
+                          suggestions=suggestions)
 
-@app.route('/users/add_like/<int:msg_id>', methods=['POST'])
+
+@bp.route('/users/add_like/<int:msg_id>', methods=['POST'])
 def like_or_unlike(msg_id):
     if not g.user:
         flash('Must be logged in to like a warble.', 'danger')
         return redirect('/login')
-    likes = [l.id for l in g.user.likes]
     prev = request.referrer
-    if msg_id in likes:
+    router = get_router()
+    if router:
+        liked = router.toggle_like(g.user.id, msg_id)
+        if liked is None:
+            abort(404)
+        current_app.extensions['trending'].record_like(msg_id, liked)
+        like_counts.record(msg_id, liked)
+        return redirect(prev)
+
+    likes = [l.id for l in g.user.likes]
+    liked = msg_id not in likes
+    if not liked:
         g.user.likes = [l for l in g.user.likes if l.id != msg_id]
     else:
         g.user.likes.append(Message.query.get_or_404(msg_id))
-    
+    events.record('like.added' if liked else 'like.removed',
+                  user_id=g.user.id, message_id=msg_id)
     db.session.commit()
+    current_app.extensions['trending'].record_like(msg_id, liked)
+    like_counts.record(msg_id, liked)
     return redirect(prev)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
+    before = request.args.get('before', type=int)
+
+    router = get_router()
+    if router:
+        messages = router.feed([user_id], FEED_PAGE_SIZE, before)
+        return render_template(
+            'users/show.html', user=user, messages=messages,
+            like_counts=like_counts.counts(m.id for m in messages),
+            likes=router.liked_ids(g.user.id) if g.user else set(),
+            page_size=FEED_PAGE_SIZE, social=social_context(user),
+            activity=analytics.for_user(user_id))
+
     if not g.user:
         likes = []
     else:
@@ -172,21 +231,38 @@ def users_show(user_id):
     messages = (Message
                 .query
                 .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+                .order_by(Message.id.desc()))
+    messages = page_before(messages, before)
+    # deep scroll continues into the cold archive
+    messages = with_archived(messages.all(), user, before, FEED_PAGE_SIZE)
+
+    return render_template('users/show.html', user=user,
+                           messages=messages, likes=likes,
+                           like_counts=like_counts.counts(
+                               m.id for m in messages),
+                           page_size=FEED_PAGE_SIZE,
+                           social=social_context(user),
+                           activity=analytics.for_user(user_id))
 
 
-@app.route('/users/<int:user_id>/likes')
+def social_context(user):
+    """Who the viewer follows that follows `user` (None if not useful)."""
+
+    if not g.user or g.user.id == user.id:
+        return None
+    return social.followed_by(g.user.id, user.id)
+
+
+@bp.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
     user = User.query.get_or_404(user_id)
-    messages = user.likes
+    router = get_router()
+    messages = router.liked_messages(user_id) if router else user.likes
     likes = [m.id for m in messages]
     return render_template('users/likes.html', messages=messages, user=user, likes=likes)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -195,10 +271,13 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following, cursor = follow_page(user_id, 'following')
+    return render_listing('users/following.html', user=user,
+                          following=following, cursor=cursor,
+                          social=social_context(user))
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -207,10 +286,21 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers, cursor = follow_page(user_id, 'followers')
+    return render_listing('users/followers.html', user=user,
+                          followers=followers, cursor=cursor,
+                          social=social_context(user))
+
+
+def follow_page(user_id, kind):
+    """A page of `user_id`'s follow list, paginated by ?before=<cursor>."""
 
+    return social.follow_page(user_id, kind, g.user.id,
+                              request.args.get('before'),
+                              current_app.config['FOLLOW_PAGE_SIZE'])
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -220,12 +310,15 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    recommendations.mark_changed(g.user.id)
+    events.record('follow.added', user_id=g.user.id, followed_id=follow_id)
     db.session.commit()
+    social.invalidate(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -235,12 +328,16 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    recommendations.mark_changed(g.user.id)
+    events.record('follow.removed', user_id=g.user.id,
+                  followed_id=follow_id)
     db.session.commit()
+    social.invalidate(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -255,12 +352,33 @@ def profile():
                                  form.password.data)
 
         if user:
-            user.username=form.username.data,
-            user.email=form.email.data,
-            user.image_url=form.image_url.data or User.image_url.default.arg,
-            user.header_image_url=form.header_image_url.data or User.header_image_url.default.arg,
-            user.bio=form.bio.data or None
-
+            image_service = current_app.extensions['images']
+            try:
+                image_url = (
+                    form.image_file.data
+                    and image_service.store_upload(
+                        form.image_file.data.read()))
+                header_image_url = (
+                    form.header_image_file.data
+                    and image_service.store_upload(
+                        form.header_image_file.data.read()))
+            except ImageError:
+                flash("Couldn't read that image.", 'danger')
+                return render_template('/users/edit.html', form=form)
+
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = (image_url or form.image_url.data
+                              or User.image_url.default.arg)
+            user.header_image_url = (header_image_url
+                                     or form.header_image_url.data
+                                     or User.header_image_url.default.arg)
+            user.bio = form.bio.data or None
+
+            events.record('user.updated', user_id=user.id,
+                          username=user.username, image_url=user.image_url,
+                          header_image_url=user.header_image_url,
+                          bio=user.bio)
             db.session.commit()
             return redirect(f"/users/{g.user.id}")
         else:
@@ -272,7 +390,7 @@ def profile():
     # IMPLEMENT THIS
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -280,18 +398,109 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    # do_logout() clears g.user
+    user = g.user
     do_logout()
 
-    db.session.delete(g.user)
+    message_ids, unliked = [], []
+    router = get_router()
+    if router:
+        # shard tables have no foreign keys to cascade from users
+        message_ids, liked_ids = router.delete_author(user.id)
+        tags.unindex_messages(message_ids)
+        (LikeCount.query
+         .filter(LikeCount.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+        unliked = set(liked_ids) - set(message_ids)
+
+    db.session.delete(user)
+    events.record('user.deleted', user_id=user.id)
     db.session.commit()
+    like_counts.forget(message_ids)
+    for message_id in unliked:
+        like_counts.record(message_id, False)
 
     return redirect("/signup")
 
 
+def _download(chunks, mimetype, filename):
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename="{filename}"'})
+
+
+@bp.route('/users/export.ndjson')
+def export_ndjson():
+    """Stream all of the current user's data as NDJSON."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    chunks = export.ndjson_chunks(g.user.id,
+                                  current_app.config['EXPORT_BATCH_ROWS'])
+    return _download(chunks, 'application/x-ndjson',
+                     f"warbler-{g.user.username}.ndjson")
+
+
+@bp.route('/users/export/<section>.csv')
+def export_csv(section):
+    """Stream one section of the current user's data as CSV."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    if section not in export.SECTIONS:
+        abort(404)
+
+    chunks = export.csv_chunks(g.user.id, section,
+                               current_app.config['EXPORT_BATCH_ROWS'])
+    return _download(chunks, 'text/csv',
+                     f"warbler-{g.user.username}-{section}.csv")
+
+
+@bp.route('/users/export', methods=["POST"])
+def start_export():
+    """Prepare a compressed export of the current user's data."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.form.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        abort(400)
+
+    name = current_app.extensions['exports'].start(g.user.id, fmt)
+    flash("Your export is being prepared.", "success")
+    return redirect(url_for('warbler.export_file', name=name))
+
+
+@bp.route('/users/exports/<name>')
+def export_file(name):
+    """Download a prepared export once it's ready."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    jobs = current_app.extensions['exports']
+    if jobs.owner(name) != g.user.id:
+        abort(404)
+
+    status = jobs.status(name)
+    if status is None:
+        abort(404)
+    if status == 'pending':
+        return ("Your export is still being prepared. This page will "
+                "reload until it is ready.", 202, {'Refresh': '5'})
+    return send_file(jobs.path(name), as_attachment=True)
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -305,31 +514,119 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        router = get_router()
+        if router:
+            # the router and the write buffer log message.created
+            # themselves, in the transaction that adds the message
+            msg_id = router.add(g.user.id, form.text.data)
+            tags.index_message(msg_id, g.user.id, form.text.data)
+            db.session.commit()
+        elif current_app.config['MESSAGE_WRITE_COALESCING']:
+            # Blocks until our batch commits, so the redirect sees the post.
+            try:
+                write = get_write_buffer().submit(g.user.id, form.text.data)
+                write.wait()
+            except SQLAlchemyError:
+                flash("Could not post your warble, please try again.",
+                      'danger')
+                return render_template('messages/new.html', form=form)
+            msg_id = write.row['id']
+            tags.index_message(msg_id, g.user.id, form.text.data)
+            db.session.commit()
+        else:
+            msg = Message(text=form.text.data)
+            g.user.messages.append(msg)
+            db.session.flush()
+            tags.index_message(msg.id, g.user.id, msg.text)
+            events.record('message.created', message_id=msg.id,
+                          user_id=g.user.id, text=msg.text)
+            db.session.commit()
+            msg_id = msg.id
 
+        current_app.extensions['trending'].record_post(
+            tags.extract(form.text.data)[0])
+        get_broker().publish(g.user.id,
+                             message_event(g.user, msg_id, form.text.data))
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+def api_user():
+    """The user making an API call: by HTTP Basic auth, or the logged-in one.
+
+    The session cookie rides along on cross-site posts too, so a logged-in
+    user only counts if the call also carries their CSRF token, in an
+    X-CSRFToken header.
+    """
+
+    auth = request.authorization
+    if auth and auth.username and auth.password:
+        return User.authenticate(auth.username, auth.password) or None
+    if g.user:
+        if current_app.config['WTF_CSRF_ENABLED']:
+            try:
+                validate_csrf(request.headers.get('X-CSRFToken'))
+            except ValidationError:
+                return None
+        return g.user
+    return None
+
+
+@bp.route('/api/messages/import', methods=["POST"])
+def import_messages():
+    """Post many messages at once from an NDJSON request body.
+
+    Responds with a per-line report of new message ids and errors.
+    """
+
+    user = api_user()
+    if not user:
+        return (jsonify(error="Authentication required."), 401,
+                {'WWW-Authenticate': 'Basic realm="warbler"'})
+
+    config = current_app.config
+    lines = (line.decode('utf-8', 'replace') for line in request.stream)
+    results = bulk_import.import_messages(user.id, lines,
+                                          config['BULK_IMPORT_BATCH'],
+                                          config['BULK_IMPORT_MAX_ITEMS'])
+    return jsonify(bulk_import.summarize(results))
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    router = get_router()
+    if router:
+        msg = router.get(message_id) or abort(404)
+    else:
+        msg = Message.query.get_or_404(message_id)
+    return render_template('messages/show.html', message=msg,
+                           like_count=like_counts.counts([msg.id]).get(
+                               msg.id, 0))
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    
+
+    router = get_router()
+    if router:
+        if not router.delete(message_id, g.user.id):
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+        # (the shard logged message.deleted with the delete)
+        tags.unindex_messages([message_id])
+        LikeCount.query.filter_by(message_id=message_id).delete()
+        db.session.commit()
+        like_counts.forget([message_id])
+        return redirect(f"/users/{g.user.id}")
+
     msg = Message.query.get(message_id)
     
     if g.user.id != msg.user_id:
@@ -337,37 +634,288 @@ def messages_destroy(message_id):
         return redirect("/")
     
     db.session.delete(msg)
+    tags.unindex_messages([message_id])
+    LikeCount.query.filter_by(message_id=message_id).delete()
+    events.record('message.deleted', message_id=message_id,
+                  user_id=g.user.id)
     db.session.commit()
+    like_counts.forget([message_id])
 
     return redirect(f"/users/{g.user.id}")
 
 
+@bp.route('/tags/<tag>')
+def tag_timeline(tag):
+    """Messages using #tag, newest first, paginated by ?before=<id>."""
+
+    before = request.args.get('before', type=int)
+    messages, cursor = tags.tag_page(tag, before, FEED_PAGE_SIZE)
+    likes = liked_ids(g.user) if g.user else set()
+    return render_template('messages/timeline.html',
+                           title=f"#{tag.lower()}", count=tags.tag_count(tag),
+                           messages=messages, likes=likes, cursor=cursor)
+
+
+@bp.route('/mentions')
+def mentions_timeline():
+    """Messages @mentioning the logged-in user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before', type=int)
+    messages, cursor = tags.mentions_page(g.user.id, before, FEED_PAGE_SIZE)
+    return render_template('messages/timeline.html',
+                           title=f"Mentions of @{g.user.username}",
+                           count=tags.mention_count(g.user.id),
+                           messages=messages, likes=liked_ids(g.user),
+                           cursor=cursor)
+
+
+def liked_ids(user):
+    """Ids of the messages `user` has liked."""
+
+    router = get_router()
+    if router:
+        return router.liked_ids(user.id)
+    return {message.id for message in user.likes}
+
+
+##############################################################################
+# Live feed updates
+
+
+def feed_author_ids(user_id):
+    """Ids of the users whose messages make up `user_id`'s feed.
+
+    Followed ids come from the per-process cache in social.py, so polling
+    the feed doesn't load every followee.
+    """
+
+    following = current_app.extensions['social_cache'].get('following',
+                                                           user_id)
+    return list(following) + [user_id]
+
+
+@bp.route('/stream')
+def feed_stream():
+    """Push new messages in the current user's feed as Server-Sent Events.
+
+    A browser reconnecting with Last-Event-ID first gets what it missed.
+    """
+
+    if not g.user:
+        return "Access unauthorized.", 401
+
+    config = current_app.config
+    connections = current_app.extensions['sse_connections']
+    user_id = g.user.id
+    if not connections.acquire(user_id):
+        return "Too many open streams.", 503, {'Retry-After': '30'}
+
+    try:
+        following_ids = feed_author_ids(user_id)
+        sub = get_broker().subscribe(following_ids)
+
+        backlog = []
+        last_id = request.headers.get('Last-Event-ID', type=int)
+        if last_id is not None and not get_router():
+            missed = (Message
+                      .query
+                      .filter(Message.user_id.in_(following_ids),
+                              Message.id > last_id)
+                      .order_by(Message.id)
+                      .limit(FEED_PAGE_SIZE))
+            backlog = [message_event(m.user, m.id, m.text) for m in missed]
+    except Exception:
+        connections.release(user_id)
+        raise
+
+    resp = Response(event_stream(sub, config['SSE_HEARTBEAT_SECONDS'],
+                                 config['SSE_MAX_SECONDS'], backlog),
+                    mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+    # runs even if the browser leaves before the first event
+    resp.call_on_close(sub.close)
+    resp.call_on_close(lambda: connections.release(user_id))
+    return resp
+
+
+@bp.route('/api/feed/new')
+def feed_new():
+    """Count messages in the current user's feed newer than ?since=<id>.
+
+    Answered from in-memory high-water marks (see highwater.py). With
+    ?include=messages, the new messages (up to a page) are sent too.
+    """
+
+    if not g.user:
+        return jsonify(error="Authentication required."), 401
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify(error="Pass your newest message id as ?since="), 400
+
+    following_ids = feed_author_ids(g.user.id)
+    marks = current_app.extensions['highwater']
+    count, latest = marks.new_since(following_ids, since)
+    result = {'count': count, 'latest': latest}
+
+    if request.args.get('include') == 'messages':
+        messages = []
+        if count:
+            router = get_router()
+            if router:
+                messages = [m for m in router.feed(following_ids,
+                                                   FEED_PAGE_SIZE)
+                            if m.id > since]
+            else:
+                messages = (Message
+                            .query
+                            .filter(Message.user_id.in_(following_ids),
+                                    Message.id > since)
+                            .order_by(Message.id.desc())
+                            .limit(FEED_PAGE_SIZE))
+        result['messages'] = [message_event(m.user, m.id, m.text)
+                              for m in messages]
+
+    return jsonify(result)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+def page_before(messages, before):
+    """Limit a newest-first message query to one page older than `before`.
+
+    Message ids are time-ordered snowflakes, so the id of the last message
+    on a page is all we need as the cursor for the next one.
+    """
+
+    if before is not None:
+        messages = messages.filter(Message.id < before)
+    return messages.limit(FEED_PAGE_SIZE)
+
+
+@bp.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, or the 100
+      before the message id given as ?before=
     """
 
     if g.user:
+        following_ids = feed_author_ids(g.user.id)
+        before = request.args.get('before', type=int)
+
+        suggestions = recommendations.for_user(
+            g.user.id, current_app.config['RECOMMENDATIONS_SHOWN'])
+
+        router = get_router()
+        if router:
+            messages = router.feed(following_ids, FEED_PAGE_SIZE, before)
+            return render_listing(
+                'home.html', messages=messages,
+                like_counts=like_counts.counts(m.id for m in messages),
+                likes=router.liked_ids(g.user.id), page_size=FEED_PAGE_SIZE,
+                suggestions=suggestions)
+
         likes = [l.id for l in g.user.likes]
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
         messages = (Message
                     .query
                     .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+                    .order_by(Message.id.desc()))
+        # one page, so load it to look up its like counts in one go
+        messages = page_before(messages, before).all()
 
-        return render_template('home.html', messages=messages, likes=likes)
+        return render_listing('home.html', messages=messages, likes=likes,
+                              like_counts=like_counts.counts(
+                                  m.id for m in messages),
+                              page_size=FEED_PAGE_SIZE,
+                              suggestions=suggestions)
 
     else:
-        return render_template('home-anon.html')
+        return render_template(
+            'home-anon.html',
+            trending=current_app.extensions['trending'].snapshot())
+
+
+##############################################################################
+# Static assets and images
+
+
+@bp.route('/users/<int:user_id>/images/<variant>/<key>')
+def user_image(user_id, variant, key):
+    """Serve a thumbnail of a user's avatar or header image."""
+
+    user = User.query.get_or_404(user_id)
+    if variant not in VARIANTS:
+        abort(404)
+
+    # The key pins the source URL; if the user has changed their image
+    # since this page was rendered, send them to the current one.
+    source = getattr(user, VARIANTS[variant].attr)
+    if not source or url_key(source) != key:
+        return redirect(thumb_url(user, variant))
+
+    image_service = current_app.extensions['images']
+    try:
+        return image_service.send(image_service.thumbnail(source, variant))
+    except ImageError:
+        return redirect(assets.asset_url(source))
+
+
+@bp.route('/uploads/<digest>')
+def uploaded_image(digest):
+    """Serve an uploaded original image."""
+
+    image_service = current_app.extensions['images']
+    path = os.path.join(image_service.upload_dir, digest)
+    if len(digest) != 64 or not os.path.isfile(path):
+        abort(404)
+    return image_service.send(path)
+
+
+@bp.route('/assets/<path:filename>')
+def hashed_asset(filename):
+    """Serve a fingerprinted asset with immutable, year-long caching."""
+
+    return current_app.extensions['assets'].send(filename)
+
+
+##############################################################################
+# Operations
+
+
+@bp.route('/metrics')
+def metrics_page():
+    """Prometheus metrics for every worker process."""
+
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(metrics.render(current_app),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def is_admin(user):
+    return bool(user) and user.username in current_app.config['ADMIN_USERNAMES']
+
+
+@bp.route('/admin/slow-queries')
+def admin_slow_queries():
+    """Slow statements grouped by normalized SQL, costliest first."""
+
+    if not is_admin(g.user):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    log = current_app.extensions.get('slow_queries')
+    groups = log.groups() if log else []
+    return render_template('admin/slow_queries.html', groups=groups,
+                           enabled=log is not None)
 
 
 ##############################################################################
@@ -377,12 +925,125 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
+    # These never change under the same URL and set their own caching.
+    if request.endpoint in ('warbler.hashed_asset', 'warbler.user_image',
+                            'warbler.uploaded_image'):
+        return req
+
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+##############################################################################
+# Application factory
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint and precompress static/ into static/dist/."""
+
+    manifest = assets.build_assets(current_app.static_folder)
+    click.echo(f"Fingerprinted {len(manifest)} assets.")
+
+
+def create_app(profile=None, serve=False, **config):
+    """Create and configure a Warbler app.
+
+    `profile` names one of the profiles in config.py (by default it comes
+    from WARBLER_PROFILE / FLASK_ENV); keyword arguments override
+    individual settings. Pass `serve=True` for the app a server will run
+    (see wsgi.py): only then does WARM_UP apply, so tests, scripts and the
+    flask CLI don't compile templates into the instance folder.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(PROFILES[profile or default_profile()])
+    app.config.update(from_environ())
+    app.config.update(config)
+
+    # before anything creates app.jinja_env
+    template_cache.init_app(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    assets.init_app(app)
+    images.init_app(app)
+    sharding.init_app(app)
+    partitions.init_app(app)
+    export.init_app(app)
+    pubsub.init_app(app)
+    highwater.init_app(app)
+    social.init_app(app)
+    trending.init_app(app)
+    like_counts.init_app(app)
+
+    engines = [db.get_engine(app)]
+    if 'shard_router' in app.extensions:
+        engines += app.extensions['shard_router'].shards
+    metrics.init_app(app, engines)
+    slow_queries.init_app(app)
+
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config['COMPRESS_MIN_SIZE'],
+        gzip_level=app.config['COMPRESS_GZIP_LEVEL'],
+        brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+    )
+
+    app.register_blueprint(bp)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(template_cache.precompile_templates_command)
+    app.cli.add_command(sharding.shards_cli)
+    app.cli.add_command(partitions.partitions_cli)
+    app.cli.add_command(export.export_user_command)
+    app.cli.add_command(bulk_import.import_messages_command)
+    app.cli.add_command(pubsub.pubsub_hub_command)
+    app.cli.add_command(tags.tags_cli)
+    app.cli.add_command(recommendations.recommendations_cli)
+    app.cli.add_command(influence.influence_cli)
+    app.cli.add_command(analytics.analytics_cli)
+    app.cli.add_command(events.events_cli)
+    app.cli.add_command(like_counts.likes_cli)
+
+    if serve and app.config['WARM_UP']:
+        warm_up(app)
+
+    return app
+
+
+def warm_up(app):
+    """Do the work a worker would otherwise do on its first requests.
+
+    Runs in create_app(serve=True), so with a preloading prefork server it
+    happens once in the master and is shared by every forked worker. It
+    doesn't open database connections, since those must not cross a fork.
+    """
+
+    template_cache.precompile_templates(app)
+    app.url_map.update()
+
+    with app.app_context():
+        current_app.extensions['assets'].manifest
+        # builds the engine and imports the DB driver without connecting
+        db.get_engine()
+
+
+def __getattr__(name):
+    # `from app import app` (tests, `flask run`) gets a default app, built
+    # on first use so that importing this module for create_app() is cheap.
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
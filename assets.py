@@ -0,0 +1,198 @@
+"""Fingerprinted, precompressed static assets.
+
+`build_assets()` copies everything under static/ to static/dist/ with a
+content hash in the filename (style.css -> style.3f2a9c1b0d4e.css), writes
+.gz (and, if the `brotli` package is installed, .br) siblings for
+compressible files, and records the mapping in static/dist/manifest.json.
+Stylesheets are rewritten to point at the hashed images they reference.
+
+Templates link assets through `asset_url()`, which falls back to the plain
+/static/ path when no manifest has been built (e.g. in development).
+Hashed files are served from /assets/ with year-long immutable caching,
+since a changed file always gets a new name.
+
+Build with:
+
+    flask build-assets      (or: python assets.py)
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import abort, current_app, request, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+ASSET_URL_PREFIX = '/assets/'
+
+# Already-compressed formats aren't worth precompressing.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+ONE_YEAR = 365 * 24 * 60 * 60
+IMMUTABLE = f'public, max-age={ONE_YEAR}, immutable'
+
+
+def _hashed_name(rel_path, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(rel_path)
+    return f"{stem}.{digest}{ext}"
+
+
+def _write_asset(dist, name, data):
+    path = os.path.join(dist, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    if os.path.splitext(name)[1] in COMPRESSIBLE:
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+
+
+def build_assets(static_dir):
+    """Fingerprint and precompress everything in `static_dir`.
+
+    Returns the manifest: {source path: hashed path}, both relative to
+    `static_dir` and `static_dir`/dist respectively.
+    """
+
+    dist = os.path.join(static_dir, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs
+                   if os.path.join(root, d) != dist]
+        for name in files:
+            path = os.path.join(root, name)
+            sources.append(os.path.relpath(path, static_dir)
+                           .replace(os.sep, '/'))
+
+    # Stylesheets go last so their url()s can point at hashed images.
+    sources.sort(key=lambda p: (p.endswith('.css'), p))
+
+    manifest = {}
+    for rel_path in sources:
+        with open(os.path.join(static_dir, rel_path), 'rb') as f:
+            data = f.read()
+
+        if rel_path.endswith('.css'):
+            def rewrite(match):
+                target = manifest.get(match.group(2))
+                if target is None:
+                    return match.group(0)
+                return f"url({match.group(1)}{ASSET_URL_PREFIX}{target}" \
+                       f"{match.group(1)})"
+            data = CSS_URL_RE.sub(rewrite, data.decode('utf-8')) \
+                .encode('utf-8')
+
+        hashed = _hashed_name(rel_path, data)
+        _write_asset(dist, hashed, data)
+        manifest[rel_path] = hashed
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class AssetManifest:
+    """Resolve static paths to their fingerprinted URLs."""
+
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.dist = os.path.join(static_dir, DIST_DIR)
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.dist, MANIFEST)) as f:
+                    self._manifest = json.load(f)
+            except FileNotFoundError:
+                self._manifest = {}
+        return self._manifest
+
+    def url(self, path):
+        """URL for static `path` ('images/x.png' or '/static/images/x.png').
+
+        Anything that isn't a local static path (e.g. a user's external
+        image URL) is returned unchanged.
+        """
+
+        if path is None:
+            return path
+
+        if path.startswith('/static/'):
+            path = path[len('/static/'):]
+        elif '://' in path or path.startswith('/'):
+            return path
+
+        hashed = self.manifest.get(path)
+        if hashed is None:
+            return f"/static/{path}"
+        return ASSET_URL_PREFIX + hashed
+
+    def send(self, filename):
+        """Serve a hashed asset, preferring a precompressed variant."""
+
+        path = os.path.realpath(os.path.join(self.dist, filename))
+        if (not path.startswith(os.path.realpath(self.dist) + os.sep)
+                or filename == MANIFEST or not os.path.isfile(path)):
+            abort(404)
+
+        encodings = request.accept_encodings
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encodings[encoding] and os.path.isfile(path + suffix):
+                resp = send_file(
+                    path + suffix, conditional=True, cache_timeout=ONE_YEAR,
+                    mimetype=(
+                        mimetypes.guess_type(filename)[0]
+                        or 'application/octet-stream'))
+                resp.headers['Content-Encoding'] = encoding
+                break
+        else:
+            resp = send_file(path, conditional=True,
+                             cache_timeout=ONE_YEAR)
+
+        resp.headers['Vary'] = 'Accept-Encoding'
+        resp.headers['Cache-Control'] = IMMUTABLE
+        return resp
+
+
+def init_app(app):
+    """Attach an AssetManifest to `app` and expose asset_url() to templates."""
+
+    manifest = AssetManifest(app.static_folder)
+    app.extensions['assets'] = manifest
+    app.jinja_env.globals['asset_url'] = manifest.url
+
+
+def asset_url(path):
+    """URL for static `path` in the current app (see AssetManifest.url)."""
+
+    return current_app.extensions['assets'].url(path)
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    built = build_assets(os.path.join(here, 'static'))
+    print(f"Fingerprinted {len(built)} assets into static/{DIST_DIR}/")
@@ -0,0 +1,113 @@
+"""Benchmark response compression: CPU cost vs. bytes saved.
+
+Renders the real homepage timeline, /users listing and a followers page with
+the sample data in generator/ and compresses each page at several gzip
+levels and brotli qualities.
+
+Run from the project root like:
+
+    python -m benchmarks.bench_compression
+"""
+
+import os
+import time
+from csv import DictReader
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import g, render_template
+
+from app import app
+from compression import GzipCompressor, BrotliCompressor, brotli
+from models import db
+from social import FollowCard, encode_cursor
+
+ROUNDS = 50
+
+
+def load_sample_data():
+    with open('generator/users.csv') as f:
+        users = [SimpleNamespace(id=i, is_following=lambda u: u.id % 2 == 0,
+                                 messages=[], following=[], followers=[],
+                                 likes=[], **row)
+                 for i, row in enumerate(DictReader(f), start=1)]
+
+    by_id = {u.id: u for u in users}
+    with open('generator/messages.csv') as f:
+        messages = [SimpleNamespace(
+            id=i, text=row['text'], user=by_id[int(row['user_id'])],
+            timestamp=datetime.strptime(row['timestamp'],
+                                        '%Y-%m-%d %H:%M:%S.%f'))
+            for i, row in enumerate(DictReader(f), start=1)]
+
+    return users, messages
+
+
+def follower_page(viewer, followers):
+    """A page of FollowCards and its cursor, as the followers view has."""
+
+    size = app.config['FOLLOW_PAGE_SIZE']
+    now = datetime.utcnow()
+    cards = [FollowCard(u.id, u.username, u.image_url, u.header_image_url,
+                        u.bio, now - timedelta(minutes=n),
+                        viewer.is_following(u))
+             for n, u in enumerate(followers[:size + 1])]
+    cursor = None
+    if len(cards) > size:
+        cards = cards[:size]
+        cursor = encode_cursor(cards[-1].followed_at, cards[-1].id)
+    return cards, cursor
+
+
+def render_pages(users, messages):
+    viewer = users[0]
+    followers, cursor = follower_page(viewer, users[1:200])
+
+    with app.test_request_context('/'):
+        # empty tables, for the profile counts in the page header
+        db.create_all()
+        g.user = viewer
+        return {
+            'home (100 msgs)': render_template(
+                'home.html', messages=messages[:100], likes=[],
+                like_counts={m.id: m.id % 7 for m in messages[:100]}),
+            '/users (300 users)': render_template(
+                'users/index.html', users=users),
+            f'followers ({len(followers)} of 199)': render_template(
+                'users/followers.html', user=viewer, followers=followers,
+                cursor=cursor),
+        }
+
+
+def compress(make, data):
+    c = make()
+    return c.compress(data) + c.finish()
+
+
+def main():
+    pages = render_pages(*load_sample_data())
+
+    codecs = [(f'gzip -{level}', lambda level=level: GzipCompressor(level))
+              for level in (1, 6, 9)]
+    if brotli is not None:
+        codecs += [(f'br q{q}', lambda q=q: BrotliCompressor(q))
+                   for q in (1, 4, 11)]
+
+    for page, html in pages.items():
+        data = html.encode('utf-8')
+        print(f"{page}: {len(data):,} bytes uncompressed")
+
+        for name, make in codecs:
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                out = compress(make, data)
+            ms = (time.perf_counter() - start) / ROUNDS * 1000
+            saved = 100 * (1 - len(out) / len(data))
+            print(f"  {name:<9} {len(out):>8,} bytes  {saved:5.1f}% saved"
+                  f"  {ms:7.3f} ms/response")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark message posting: one commit per post vs. the group-commit buffer.
+
+Run from the project root like:
+
+    python -m benchmarks.bench_message_writes [DATABASE_URL] [THREADS] [POSTS]
+
+Defaults to a throwaway SQLite file; point it at a scratch Postgres
+database to see the effect of real fsync-bound commits. Both ways write
+each message's `message.created` event in the same transaction, as
+messages_add() does.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, select
+
+import snowflake
+from models import db, Event, User, Message
+from write_buffer import MessageWriteBuffer, PendingWrite, write_batch
+
+
+def setup(engine):
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {'id': 1, 'email': 'bench@bench.com', 'username': 'bench',
+             'password': 'x'}
+        ])
+
+
+def per_post_commit(engine):
+    def post(text):
+        write = PendingWrite({'id': snowflake.next_id(), 'user_id': 1,
+                              'text': text, 'timestamp': datetime.utcnow()})
+        with engine.begin() as conn:
+            write_batch(conn, [write])
+    return post, lambda: None
+
+
+def group_commit(engine):
+    buf = MessageWriteBuffer(engine, window_ms=5, max_batch=200)
+
+    def post(text):
+        buf.submit(1, text).wait()
+    return post, buf.close
+
+
+def run(engine, strategy, threads, posts):
+    setup(engine)
+    post, done = strategy(engine)
+
+    def worker(n):
+        for i in range(posts):
+            post(f"warble {n}-{i}")
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    done()
+
+    with engine.connect() as conn:
+        count = conn.execute(
+            select([func.count()]).select_from(Message.__table__)).scalar()
+        logged = conn.execute(
+            select([func.count()]).select_from(Event.__table__)).scalar()
+    assert count == logged == threads * posts, (count, logged)
+
+    return count / elapsed
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    url = (sys.argv[1] if len(sys.argv) > 1 and sys.argv[1]
+           else f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    posts = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    engine = create_engine(url, connect_args=(
+        {'timeout': 60} if url.startswith('sqlite') else {}))
+
+    print(f"{threads} threads x {posts} posts against {engine.url}")
+    for name, strategy in [('per-post commit', per_post_commit),
+                           ('group commit', group_commit)]:
+        rate = run(engine, strategy, threads, posts)
+        print(f"  {name:<16} {rate:10.0f} posts/s")
+
+
+if __name__ == '__main__':
+    main()
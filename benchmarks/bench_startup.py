@@ -0,0 +1,68 @@
+"""Benchmark worker cold start: import, create_app() and first request.
+
+Each scenario runs in a fresh interpreter, like a newly forked worker, and
+reports the time to import the app module, build the app, and serve the
+first (and second) request for a few pages.
+
+Run from the project root like:
+
+    python -m benchmarks.bench_startup [RUNS]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+CHILD = r"""
+import json, sys, time
+
+t0 = time.perf_counter()
+import app as app_module
+t1 = time.perf_counter()
+app = app_module.create_app(sys.argv[1], serve=True,
+                             **json.loads(sys.argv[2]))
+t2 = time.perf_counter()
+
+client = app.test_client()
+timings = {'import': t1 - t0, 'create_app': t2 - t1}
+for url in ('/login', '/signup'):
+    for attempt in ('first', 'second'):
+        start = time.perf_counter()
+        client.get(url)
+        timings[f'{url} {attempt}'] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+SCENARIOS = [
+    ('development (toolbar)', 'development', {}),
+    ('production, no warm-up', 'production', {'WARM_UP': False}),
+    ('production, warm-up', 'production', {'WARM_UP': True}),
+]
+
+
+def run(profile, overrides, env):
+    out = subprocess.run(
+        [sys.executable, '-c', CHILD, profile, json.dumps(overrides)],
+        env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(out)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{tempfile.mktemp(suffix='.db')}",
+               PYTHONPATH=os.getcwd())
+
+    for name, profile, overrides in SCENARIOS:
+        samples = [run(profile, overrides, env) for _ in range(runs)]
+        print(f"{name} (median of {runs}):")
+        for key in samples[0]:
+            values = sorted(s[key] for s in samples)
+            print(f"  {key:<18} {values[len(values) // 2] * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
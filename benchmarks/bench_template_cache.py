@@ -0,0 +1,90 @@
+"""Benchmark first-request latency with and without the template cache.
+
+Each scenario runs in a fresh interpreter, like a newly started worker,
+and times the first request to pages that render our heaviest templates:
+
+- no bytecode cache: every template is compiled from source
+- cold cache: the first worker compiles and writes the cache
+- precompiled: `flask precompile-templates` ran during the deploy
+
+Run from the project root like:
+
+    python -m benchmarks.bench_template_cache [RUNS]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+CHILD = r"""
+import json, sys, time
+from app import create_app
+from models import db
+
+app = create_app('production', WARM_UP=False, **json.loads(sys.argv[1]))
+with app.app_context():
+    db.create_all()
+
+client = app.test_client()
+timings = {}
+for url in ('/', '/login', '/signup', '/users'):
+    start = time.perf_counter()
+    client.get(url)
+    timings[url] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+PRECOMPILE = r"""
+import json, sys
+from app import create_app
+from template_cache import precompile_templates
+precompile_templates(create_app('production', WARM_UP=False,
+                                **json.loads(sys.argv[1])))
+"""
+
+
+def child(script, config, env):
+    out = subprocess.run([sys.executable, '-c', script, json.dumps(config)],
+                         env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(out) if out.strip() else None
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    tmp = tempfile.mkdtemp()
+    cache_dir = os.path.join(tmp, 'jinja-cache')
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+               PYTHONPATH=os.getcwd())
+    cached = {'TEMPLATE_CACHE_DIR': cache_dir}
+
+    def no_cache():
+        return child(CHILD, {'TEMPLATE_BYTECODE_CACHE': False}, env)
+
+    def cold_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return child(CHILD, cached, env)
+
+    def precompiled():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        child(PRECOMPILE, cached, env)
+        return child(CHILD, cached, env)
+
+    for name, scenario in [('no bytecode cache', no_cache),
+                           ('cold cache', cold_cache),
+                           ('precompiled', precompiled)]:
+        samples = [scenario() for _ in range(runs)]
+        print(f"{name} (median first request of {runs} workers):")
+        for url in samples[0]:
+            values = sorted(s[url] for s in samples)
+            print(f"  {url:<8} {values[len(values) // 2] * 1000:7.1f} ms")
+
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
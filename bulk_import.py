@@ -0,0 +1,244 @@
+"""Bulk import of messages from NDJSON.
+
+Each line of the input is one message: `{"text": "..."}`, optionally with
+a past `"timestamp"` (ISO 8601, UTC) for messages migrated from elsewhere,
+which then get backdated snowflake ids (see snowflake.py) and slot into
+feeds at their original time. Timestamps from months that are already
+archived (see partitions.py) are rejected, since nothing would move those
+messages into the archive.
+
+Every item is checked against the MessageForm rules, and valid items are
+inserted `BULK_IMPORT_BATCH` at a time with multi-row INSERTs, one
+transaction per batch. If a batch fails, its rows are retried one by one,
+so a bad row only fails itself, and a row whose backdated id was taken
+already gets a new one. Each message's `message.created` event is
+inserted in the same transaction as the message (into the shard's outbox
+when sharded, see sharding.py). The #tags and @mentions of imported
+messages are indexed (see tags.py) after each batch, and messages without
+a timestamp count toward trending and are published to open feeds like
+posts from `messages_add()`; backdated ones aren't new to anyone. The
+result has one entry per input line: either the new message's id or that
+line's errors.
+
+Used by the POST /api/messages/import endpoint and `flask import-messages`.
+"""
+
+import json
+from datetime import datetime, time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.datastructures import MultiDict
+
+import events
+import sharding
+import snowflake
+import tags
+from forms import MessageForm
+from partitions import archive_cutoff
+from pubsub import get_broker, message_event
+from models import db, Event, Message, User
+
+# inserts of a row before giving up on id collisions
+ID_ATTEMPTS = 3
+
+
+def parse_item(line, now=None, oldest=None):
+    """A message row's text and timestamp from one NDJSON line.
+
+    Timestamps must fall between `oldest` (if given) and `now`.
+
+    Returns (row, None) or (None, errors), where errors is like a form's.
+    """
+
+    try:
+        item = json.loads(line)
+    except ValueError as exc:
+        return None, {'line': [f"Invalid JSON: {exc}"]}
+    if not isinstance(item, dict):
+        return None, {'line': ["Expected a JSON object."]}
+
+    text = item.get('text')
+    form = MessageForm(formdata=MultiDict(
+        {'text': text} if isinstance(text, str) else {}), meta={'csrf': False})
+    errors = {} if form.validate() else dict(form.errors)
+
+    timestamp = item.get('timestamp')
+    if timestamp is not None:
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError):
+            errors['timestamp'] = ["Expected an ISO 8601 timestamp."]
+        else:
+            if timestamp.tzinfo is not None:
+                timestamp = (timestamp - timestamp.utcoffset()).replace(
+                    tzinfo=None)
+            if timestamp > (now or datetime.utcnow()):
+                errors['timestamp'] = ["Timestamp is in the future."]
+            elif oldest is not None and timestamp < oldest:
+                errors['timestamp'] = [
+                    f"Messages before {oldest:%Y-%m} are archived."]
+
+    if errors:
+        return None, errors
+    return {'text': form.text.data, 'timestamp': timestamp}, None
+
+
+def _message_tables(user_id):
+    """(engine, messages table, events table) for `user_id`'s messages."""
+
+    router = sharding.get_router()
+    if router:
+        return (router.shards[router.shard_for(user_id)], sharding.messages,
+                sharding.outbox)
+    return db.engine, Message.__table__, Event.__table__
+
+
+def created_event(row):
+    return events.event_row('message.created', message_id=row['id'],
+                            user_id=row['user_id'], text=row['text'])
+
+
+def insert_batch(engine, table, log, rows):
+    """Insert `rows` and their events into `log`; return an error (or None)
+    for each of them."""
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(table.insert().values(rows))
+            conn.execute(log.insert(), [created_event(row) for row in rows])
+        return [None] * len(rows)
+    except SQLAlchemyError:
+        pass
+
+    errors = []
+    for row in rows:
+        for attempt in range(ID_ATTEMPTS):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(table.insert().values(row))
+                    conn.execute(log.insert().values(created_event(row)))
+            except IntegrityError as exc:
+                # most likely a backdated id minted before, by an earlier
+                # import; try a fresh one (see snowflake.py)
+                error = exc
+                row['id'] = snowflake.next_id(at=row['timestamp'])
+            except SQLAlchemyError as exc:
+                error = exc
+                break
+            else:
+                error = None
+                break
+        errors.append(error and {'database': [str(error.orig or error)]})
+    return errors
+
+
+def notify(user, rows):
+    """Tell trending and open feeds about newly posted `rows`."""
+
+    trending = current_app.extensions['trending']
+    broker = get_broker()
+    for row in rows:
+        trending.record_post(tags.extract(row['text'])[0])
+        broker.publish(user.id, message_event(user, row['id'], row['text']))
+
+
+def import_messages(user_id, lines, batch_size=500, max_items=10000):
+    """Import NDJSON `lines` as messages by `user_id`.
+
+    Returns a list of {"line": n, "id": id} or {"line": n, "errors": {...}}
+    entries, one per non-blank line. Input past `max_items` messages is
+    not read: the first line over the limit gets an error and the import
+    stops there.
+    """
+
+    engine, table, log = _message_tables(user_id)
+    user = User.query.get(user_id)
+    results = []
+    batch = []
+
+    def flush():
+        errors = insert_batch(engine, table, log,
+                              [row for _, row, _ in batch])
+        inserted = []
+        posted = []
+        for (result, row, backdated), error in zip(batch, errors):
+            if error:
+                result['errors'] = error
+            else:
+                result['id'] = row['id']
+                inserted.append(row)
+                if not backdated:
+                    posted.append(row)
+        tags.index_messages(inserted)
+        db.session.commit()
+        notify(user, posted)
+        batch.clear()
+
+    now = datetime.utcnow()
+    cutoff = archive_cutoff(now)
+    oldest = cutoff and datetime.combine(cutoff, time.min)
+    count = 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        result = {'line': number}
+        results.append(result)
+
+        count += 1
+        if count > max_items:
+            result['errors'] = {
+                'line': [f"At most {max_items} messages per import."]}
+            break
+
+        row, errors = parse_item(line, now, oldest)
+        if errors:
+            result['errors'] = errors
+            continue
+
+        backdated = row['timestamp'] is not None
+        row['id'] = snowflake.next_id(at=row['timestamp'])
+        row['timestamp'] = row['timestamp'] or datetime.utcnow()
+        row['user_id'] = user_id
+        batch.append((result, row, backdated))
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+    return results
+
+
+def summarize(results):
+    failed = sum(1 for r in results if 'errors' in r)
+    return {'imported': len(results) - failed, 'failed': failed,
+            'results': results}
+
+
+@click.command('import-messages')
+@click.argument('username')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@with_appcontext
+def import_messages_command(username, source):
+    """Import NDJSON messages from SOURCE ('-' for stdin) as USERNAME."""
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter(f"no user {username!r}")
+
+    config = current_app.config
+    # MessageForm needs a request context to validate
+    with current_app.test_request_context():
+        results = import_messages(user.id, source,
+                                  config['BULK_IMPORT_BATCH'],
+                                  config['BULK_IMPORT_MAX_ITEMS'])
+
+    summary = summarize(results)
+    for result in results:
+        if 'errors' in result:
+            click.echo(f"line {result['line']}: "
+                       f"{json.dumps(result['errors'])}")
+    click.echo(f"Imported {summary['imported']} messages, "
+               f"{summary['failed']} failed.")
@@ -0,0 +1,193 @@
+"""Response compression middleware.
+
+CompressionMiddleware wraps the WSGI app and gzip- or brotli-encodes
+HTML/JSON/text responses for clients that advertise support in
+Accept-Encoding. Responses are left alone when they:
+
+- are smaller than `min_size` bytes (not worth the CPU),
+- already carry a Content-Encoding (e.g. precompressed /assets/ files),
+- have a content type that isn't compressible, or ask for no-transform.
+
+Buffered responses (the usual `render_template` case) are compressed in
+one go and keep an accurate Content-Length. Streamed responses, which
+have no Content-Length, are compressed chunk by chunk and flushed after
+every chunk so the client still receives each piece as soon as it is
+produced.
+
+Brotli is only offered when the `brotli` package is installed.
+"""
+
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+}
+
+
+class GzipCompressor:
+    """Incremental gzip encoder."""
+
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._z.compress(data)
+
+    def flush(self):
+        return self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    """Incremental brotli encoder."""
+
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._c.process(data)
+
+    def flush(self):
+        return self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+class CompressionMiddleware:
+    """WSGI middleware negotiating gzip/brotli response compression."""
+
+    def __init__(self, app, min_size=500, gzip_level=6, brotli_quality=4,
+                 types=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.types = types
+
+    def negotiate(self, accept_encoding):
+        """Pick the best encoding we support, or None."""
+
+        accepted = parse_accept_header(accept_encoding)
+
+        if brotli is not None and accepted.quality('br') > 0:
+            return 'br'
+        if accepted.quality('gzip') > 0:
+            return 'gzip'
+        return None
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            return BrotliCompressor(self.brotli_quality)
+        return GzipCompressor(self.gzip_level)
+
+    def should_compress(self, status, headers):
+        """Is this response (status line + header list) worth compressing?"""
+
+        if int(status.split(None, 1)[0]) in (204, 206, 304):
+            return False
+
+        values = {k.lower(): v for k, v in headers}
+
+        if 'content-encoding' in values:
+            return False
+        if 'no-transform' in values.get('cache-control', ''):
+            return False
+
+        mimetype = values.get('content-type', '').split(';')[0].strip()
+        if mimetype not in self.types:
+            return False
+
+        length = values.get('content-length')
+        if length is not None and int(length) < self.min_size:
+            return False
+
+        return True
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+        if encoding is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+
+        captured = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        return self._respond(app_iter, captured, written, encoding,
+                             start_response)
+
+    def _respond(self, app_iter, captured, written, encoding,
+                 start_response):
+        try:
+            chunks = iter(app_iter)
+
+            # The app may defer start_response until its first chunk.
+            first = next(chunks, b'')
+            status, headers, exc_info = captured
+            pending = written + [first]
+
+            if not self.should_compress(status, headers):
+                start_response(status, headers, exc_info)
+                yield from pending
+                yield from chunks
+                return
+
+            streamed = not any(k.lower() == 'content-length'
+                               for k, v in headers)
+            headers = [(k, v) for k, v in headers
+                       if k.lower() not in ('content-length', 'vary')] + [
+                ('Content-Encoding', encoding),
+                ('Vary', _vary(captured[1])),
+            ]
+            compressor = self.compressor(encoding)
+
+            if not streamed:
+                body = b''.join(pending) + b''.join(chunks)
+                data = compressor.compress(body) + compressor.finish()
+                headers.append(('Content-Length', str(len(data))))
+                start_response(status, headers, exc_info)
+                yield data
+                return
+
+            start_response(status, headers, exc_info)
+            for chunk in pending:
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush()
+            for chunk in chunks:
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush()
+            yield compressor.finish()
+
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+def _vary(headers):
+    """The response's Vary header with Accept-Encoding added."""
+
+    vary = [v.strip() for k, value in headers if k.lower() == 'vary'
+            for v in value.split(',') if v.strip()]
+    if 'accept-encoding' not in (v.lower() for v in vary):
+        vary.append('Accept-Encoding')
+    return ', '.join(vary)
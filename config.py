@@ -0,0 +1,236 @@
+"""Configuration profiles for Warbler.
+
+`create_app()` loads one of these by name (`development`, `testing` or
+`production`), then applies any overrides found in the environment (see
+`from_environ()`), so e.g. DATABASE_URL is read when the app is created
+rather than when a module is imported.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = "it's a secret"
+
+    # Dev-only extensions are imported and attached only when enabled.
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    # Compile templates and prime caches in create_app(serve=True), i.e.
+    # when building the app a server runs (wsgi.py), rather than on the
+    # first request a worker serves.
+    WARM_UP = False
+
+    # Opt-in group commit for new messages (see write_buffer.py): posts
+    # that arrive within the window are inserted together in one
+    # transaction.
+    MESSAGE_WRITE_COALESCING = False
+    MESSAGE_WRITE_WINDOW_MS = 5
+    MESSAGE_WRITE_MAX_BATCH = 200
+
+    # Response compression (see compression.py); bodies smaller than
+    # COMPRESS_MIN_SIZE bytes are sent as-is.
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+
+    # Stream the long listing pages (see streaming.py) instead of
+    # rendering them into memory first.
+    STREAM_TEMPLATES = False
+    STREAM_BUFFER_BYTES = 8192
+    STREAM_ROW_BATCH = 100
+
+    # Thumbnailed user images (see images.py). The cache and upload dirs
+    # default to the app's instance folder. Set IMAGE_SOURCE_DIR to read
+    # "remote" images from a local directory instead of fetching them.
+    IMAGE_CACHE_DIR = None
+    IMAGE_UPLOAD_DIR = None
+    IMAGE_SOURCE_DIR = None
+    IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+    # Share compiled templates between workers (see template_cache.py).
+    # The directory defaults to the app's instance folder.
+    TEMPLATE_BYTECODE_CACHE = True
+    TEMPLATE_CACHE_DIR = None
+
+    # Database URLs to spread messages over by author (see sharding.py).
+    # Empty keeps messages in the main database.
+    MESSAGE_SHARDS = []
+
+    # Monthly message partitions and the cold archive (see partitions.py).
+    # Months older than MESSAGE_ARCHIVE_AFTER_MONTHS are archived by
+    # `flask partitions maintain`; None keeps everything live. The archive
+    # dir defaults to the app's instance folder.
+    MESSAGE_PARTITION_MONTHS_AHEAD = 3
+    MESSAGE_ARCHIVE_AFTER_MONTHS = None
+    MESSAGE_ARCHIVE_DIR = None
+
+    # Account data exports (see export.py). Prepared files go to
+    # EXPORT_DIR, which defaults to the app's instance folder.
+    EXPORT_DIR = None
+    EXPORT_BATCH_ROWS = 1000
+
+    # Bulk message imports (see bulk_import.py): rows per INSERT, and the
+    # most messages one import may hold.
+    BULK_IMPORT_BATCH = 500
+    BULK_IMPORT_MAX_ITEMS = 10000
+
+    # Live feed updates over Server-Sent Events (see pubsub.py). Each open
+    # stream holds a worker thread, hence the limits (per process). Use
+    # PUBSUB_BROKER = 'socket' with `flask pubsub-hub` when running more
+    # than one worker process; the socket defaults to the instance folder.
+    PUBSUB_BROKER = 'memory'
+    PUBSUB_SOCKET = None
+    SSE_MAX_CONNECTIONS = 100
+    SSE_MAX_PER_USER = 3
+    SSE_HEARTBEAT_SECONDS = 15
+    SSE_MAX_SECONDS = 300
+    SSE_QUEUE_SIZE = 100
+
+    # Seconds before an author's in-memory newest-message mark (see
+    # highwater.py) is re-checked against the database.
+    HIGHWATER_TTL = 30
+
+    # Prometheus metrics at /metrics (see metrics.py). With several worker
+    # processes, set METRICS_DIR so that every worker's numbers are
+    # aggregated; empty it before starting the server.
+    METRICS_ENABLED = True
+    METRICS_DIR = None
+    METRICS_FLUSH_SECONDS = 1.0
+
+    # Log statements slower than SLOW_QUERY_MS, with their plans (see
+    # slow_queries.py); None turns the log off. SLOW_QUERY_DIR defaults
+    # to the app's instance folder.
+    SLOW_QUERY_MS = None
+    SLOW_QUERY_DIR = None
+    SLOW_QUERY_MAX_BYTES = 10 * 1024 * 1024
+    SLOW_QUERY_BACKUPS = 5
+    SLOW_QUERY_EXPLAIN_INTERVAL = 300
+
+    # Trending warbles and tags (see trending.py): counts are kept in
+    # buckets of TRENDING_BUCKET_SECONDS over a window of
+    # TRENDING_WINDOW_BUCKETS buckets, and flushed to the database (and the
+    # top K recomputed) every TRENDING_FLUSH_SECONDS.
+    TRENDING_BUCKET_SECONDS = 60
+    TRENDING_WINDOW_BUCKETS = 60
+    TRENDING_TOP_K = 10
+    TRENDING_FLUSH_SECONDS = 10
+
+    # Who-to-follow suggestions (see recommendations.py), computed by
+    # `flask recommendations update` in chunks of RECOMMENDATIONS_CHUNK_ROWS
+    # users. RECOMMENDATIONS_SHOWN of them are shown on a page.
+    RECOMMENDATIONS_PER_USER = 20
+    RECOMMENDATIONS_CHUNK_ROWS = 2000
+    RECOMMENDATIONS_SHOWN = 5
+
+    # Per-process cache of follower/following id lists for "followed by
+    # people you follow" (see social.py), bounded by total ids held.
+    SOCIAL_CACHE_MAX_IDS = 5_000_000
+    SOCIAL_CACHE_TTL = 60
+
+    # Cards per page on /users/<id>/following and /followers.
+    FOLLOW_PAGE_SIZE = 48
+
+    # PageRank influence scores (see influence.py), computed by
+    # `flask influence update`; /users lists users by them.
+    INFLUENCE_DAMPING = 0.85
+    INFLUENCE_TOLERANCE = 1e-6
+    INFLUENCE_MAX_ITERATIONS = 100
+
+    # Profile activity analytics (see analytics.py), computed nightly by
+    # `flask analytics update` over the last ANALYTICS_WEEKS weeks.
+    ANALYTICS_WEEKS = 26
+    ANALYTICS_CHUNK_USERS = 5000
+
+    # Change event log consumers (see events.py) read EVENTS_BATCH_SIZE
+    # events at a time, and wait up to EVENTS_SETTLE_SECONDS for a gap in
+    # the sequence to be filled by a slower transaction.
+    EVENTS_BATCH_SIZE = 500
+    EVENTS_SETTLE_SECONDS = 5
+
+    # Like counts (see like_counts.py) are summed in memory and flushed
+    # every LIKE_COUNT_FLUSH_SECONDS into one of LIKE_COUNT_SHARDS rows per
+    # message, so concurrent flushes of a hot message rarely contend.
+    LIKE_COUNT_SHARDS = 16
+    LIKE_COUNT_FLUSH_SECONDS = 1
+
+    # Users allowed into the /admin pages.
+    ADMIN_USERNAMES = []
+
+
+class DevelopmentConfig(Config):
+    DEBUG_TOOLBAR = True
+
+
+class TestingConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler-test'
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+
+
+class ProductionConfig(Config):
+    WARM_UP = True
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def default_profile():
+    """Profile named by WARBLER_PROFILE, else by FLASK_ENV.
+
+    Like Flask itself, we assume production unless told otherwise.
+    """
+
+    return (os.environ.get('WARBLER_PROFILE')
+            or os.environ.get('FLASK_ENV')
+            or 'production')
+
+
+def from_environ():
+    """Config overrides taken from environment variables."""
+
+    overrides = {}
+    env = os.environ
+
+    if 'DATABASE_URL' in env:
+        overrides['SQLALCHEMY_DATABASE_URI'] = env['DATABASE_URL']
+    if 'SECRET_KEY' in env:
+        overrides['SECRET_KEY'] = env['SECRET_KEY']
+
+    for flag in ('MESSAGE_WRITE_COALESCING', 'STREAM_TEMPLATES', 'WARM_UP',
+                 'TEMPLATE_BYTECODE_CACHE', 'METRICS_ENABLED'):
+        if flag in env:
+            overrides[flag] = env[flag] == '1'
+
+    for key in ('IMAGE_CACHE_DIR', 'IMAGE_UPLOAD_DIR', 'IMAGE_SOURCE_DIR',
+                'TEMPLATE_CACHE_DIR', 'MESSAGE_ARCHIVE_DIR', 'EXPORT_DIR',
+                'PUBSUB_BROKER', 'PUBSUB_SOCKET', 'METRICS_DIR',
+                'SLOW_QUERY_DIR'):
+        if key in env:
+            overrides[key] = env[key]
+
+    if 'MESSAGE_ARCHIVE_AFTER_MONTHS' in env:
+        overrides['MESSAGE_ARCHIVE_AFTER_MONTHS'] = int(
+            env['MESSAGE_ARCHIVE_AFTER_MONTHS'])
+
+    if 'SLOW_QUERY_MS' in env:
+        overrides['SLOW_QUERY_MS'] = float(env['SLOW_QUERY_MS'])
+
+    if 'ADMIN_USERNAMES' in env:
+        overrides['ADMIN_USERNAMES'] = [
+            name for name in env['ADMIN_USERNAMES'].split(',') if name]
+
+    if 'MESSAGE_SHARDS' in env:
+        overrides['MESSAGE_SHARDS'] = [
+            url for url in env['MESSAGE_SHARDS'].split(',') if url]
+
+    return overrides
@@ -0,0 +1,167 @@
+"""Change data capture: an append-only log of every write.
+
+Views that change data call `record(type, **fields)` before they commit.
+The event lands in the same transaction as the change it describes, so
+if the write rolls back, the event does too. Events are numbered by
+`seq`, from the table's sequence. Each type has a fixed set of fields,
+listed in EVENT_TYPES.
+
+Consumers, such as caches, search indexes, counters and feeds, each
+keep a checkpoint: the last seq they have handled, stored in
+`event_checkpoints`. `consume(name, handler)` passes the handler a batch
+of the events after that checkpoint, in order. Once the handler returns,
+the checkpoint moves past them. If the handler raises, the checkpoint
+stays put and the batch is delivered again next time, so handlers
+should be idempotent.
+
+Sequence numbers are handed out at insert but become visible at commit,
+so a consumer can see event 12 before event 11 commits. consume() stops
+at such a gap until the event after it is `EVENTS_SETTLE_SECONDS` old.
+After that, the missing numbers are taken to be rolled back.
+
+Coalesced writes commit on the write buffer's connection, so the buffer
+inserts their events in its batch transaction. Sharded messages and likes
+commit on their shard, so the router writes their events to an outbox
+table there (`event_outbox`), in the same transaction. consume() first
+relays whatever is in the outboxes into the log here. A relay that dies
+between copying and clearing an outbox delivers those events twice, which
+idempotent handlers shrug off.
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import sharding
+from models import db, Event, EventCheckpoint
+
+EVENT_TYPES = {
+    'message.created': ('message_id', 'user_id', 'text'),
+    'message.deleted': ('message_id', 'user_id'),
+    'like.added': ('user_id', 'message_id'),
+    'like.removed': ('user_id', 'message_id'),
+    'follow.added': ('user_id', 'followed_id'),
+    'follow.removed': ('user_id', 'followed_id'),
+    'user.updated': ('user_id', 'username', 'image_url', 'header_image_url',
+                     'bio'),
+    'user.deleted': ('user_id',),
+}
+
+
+def event_row(type, **fields):
+    """Column values for a `type` event, for writers outside the session."""
+
+    expected = EVENT_TYPES.get(type)
+    if expected is None:
+        raise ValueError(f"unknown event type {type!r}")
+    if set(fields) != set(expected):
+        raise ValueError(f"{type} events have fields {', '.join(expected)}")
+    return {'type': type, 'data': fields, 'created_at': datetime.utcnow()}
+
+
+def record(type, **fields):
+    """Add a `type` event to the session; the caller commits."""
+
+    db.session.add(Event(**event_row(type, **fields)))
+
+
+def checkpoint(name):
+    """The last seq consumer `name` has handled (0 if none)."""
+
+    row = EventCheckpoint.query.get(name)
+    return row.seq if row else 0
+
+
+def settled(events, after, cutoff):
+    """The leading run of `events` that can't have earlier events still to
+    commit: up to the first gap whose next event is newer than `cutoff`."""
+
+    expected = after + 1
+    for i, event in enumerate(events):
+        if event.seq != expected and event.created_at > cutoff:
+            return events[:i]
+        expected = event.seq + 1
+    return events
+
+
+def consume(name, handler, batch_size=500, settle_seconds=5):
+    """Hand consumer `name` its next batch of events; return how many.
+
+    `handler` gets a list of Events, oldest first. Call repeatedly (until
+    it returns 0) to catch up.
+    """
+
+    router = sharding.get_router()
+    if router:
+        router.relay_events(batch_size)
+
+    after = checkpoint(name)
+    events = (Event
+              .query
+              .filter(Event.seq > after)
+              .order_by(Event.seq)
+              .limit(batch_size)
+              .all())
+    cutoff = datetime.utcnow() - timedelta(seconds=settle_seconds)
+    events = settled(events, after, cutoff)
+    if not events:
+        return 0
+
+    handler(events)
+    db.session.merge(EventCheckpoint(name=name, seq=events[-1].seq))
+    db.session.commit()
+    return len(events)
+
+
+def consume_all(name, handler):
+    """Run `consume()` with the app's settings until caught up."""
+
+    config = current_app.config
+    total = 0
+    while True:
+        count = consume(name, handler, config['EVENTS_BATCH_SIZE'],
+                        config['EVENTS_SETTLE_SECONDS'])
+        if not count:
+            return total
+        total += count
+
+
+events_cli = AppGroup('events', help="Inspect the change event log.")
+
+
+@events_cli.command('tail')
+@click.option('--after', default=0, show_default=True,
+              help="Show events after this seq.")
+@click.option('--limit', default=100, show_default=True)
+def tail_command(after, limit):
+    """Print events as JSON lines."""
+
+    for event in (Event.query.filter(Event.seq > after)
+                  .order_by(Event.seq).limit(limit)):
+        click.echo(json.dumps({'seq': event.seq, 'type': event.type,
+                               'created_at': event.created_at.isoformat(),
+                               **event.data}))
+
+
+@events_cli.command('relay')
+def relay_command():
+    """Copy events from the shards' outboxes into the log."""
+
+    router = sharding.get_router()
+    if router is None:
+        raise click.UsageError("MESSAGE_SHARDS is not set.")
+    count = router.relay_events(current_app.config['EVENTS_BATCH_SIZE'])
+    click.echo(f"Relayed {count} events.")
+
+
+@events_cli.command('checkpoints')
+def checkpoints_command():
+    """List consumers and how far behind they are."""
+
+    latest = db.session.query(db.func.max(Event.seq)).scalar() or 0
+    for row in EventCheckpoint.query.order_by(EventCheckpoint.name):
+        click.echo(f"{row.name}: at {row.seq}, "
+                   f"{latest - row.seq} behind")
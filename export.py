@@ -0,0 +1,253 @@
+"""Export of a user's account data as NDJSON or CSV.
+
+Everything is read with server-side cursors (`stream_results`) in batches
+of `EXPORT_BATCH_ROWS`, and written out as it is read. So memory use is
+the same for a user with ten messages as for one with a million, unlike
+walking `User.messages` / `User.likes`, which load every row.
+
+Exports come in two forms:
+
+- a streamed download: all sections as NDJSON (one JSON object per line,
+  each tagged with its "section"), or one section as CSV;
+- a background job that writes a compressed file to `EXPORT_DIR`: gzip
+  NDJSON, or a zip with one CSV per section. The job writes to a
+  `.part` file and renames it when done, so a finished file is never
+  partial.
+
+Archived messages (see partitions.py) are exported after the live ones,
+and messages on shards (see sharding.py) are read from their shard.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import secrets
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+import sharding
+from models import db, Follows, Likes, Message, User
+
+SECTIONS = {
+    'profile': ['id', 'username', 'email', 'image_url', 'header_image_url',
+                'bio', 'location'],
+    'messages': ['id', 'timestamp', 'text'],
+    'likes': ['message_id'],
+    'followers': ['id', 'username'],
+    'following': ['id', 'username'],
+}
+
+FORMATS = {'ndjson': '.ndjson.gz', 'csv': '.zip'}
+
+EXPORT_NAME = re.compile(r'^(\d+)-[0-9a-f]{16}\.(ndjson\.gz|zip)$')
+
+
+def _batches(engine, query, batch_size):
+    """Rows of `query` in lists of up to `batch_size`, via a server-side cursor."""
+
+    result = engine.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [dict(row) for row in rows]
+    finally:
+        result.close()
+
+
+def section_batches(user_id, section, batch_size=1000):
+    """Batches of row dicts for one section of `user_id`'s data."""
+
+    users = User.__table__
+    follows = Follows.__table__
+    router = sharding.get_router()
+
+    if section == 'profile':
+        query = (select([users.c[name] for name in SECTIONS['profile']])
+                 .where(users.c.id == user_id))
+        yield from _batches(db.engine, query, batch_size)
+
+    elif section == 'messages':
+        if router:
+            engine = router.shards[router.shard_for(user_id)]
+            messages = sharding.messages
+        else:
+            engine, messages = db.engine, Message.__table__
+        query = (select([messages.c.id, messages.c.timestamp,
+                         messages.c.text])
+                 .where(messages.c.user_id == user_id)
+                 .order_by(messages.c.id.desc()))
+        for batch in _batches(engine, query, batch_size):
+            yield [dict(row, timestamp=row['timestamp'].isoformat())
+                   for row in batch]
+
+        archived = current_app.extensions['message_archive'].records(user_id)
+        batch = []
+        for record in archived:
+            batch.append({name: record[name]
+                          for name in SECTIONS['messages']})
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    elif section == 'likes':
+        tables = ([(engine, sharding.likes) for engine in router.shards]
+                  if router else [(db.engine, Likes.__table__)])
+        for engine, likes in tables:
+            query = (select([likes.c.message_id])
+                     .where(likes.c.user_id == user_id)
+                     .order_by(likes.c.message_id))
+            yield from _batches(engine, query, batch_size)
+
+    elif section in ('followers', 'following'):
+        # followers: who follows user_id; following: whom user_id follows
+        mine, theirs = (('user_being_followed_id', 'user_following_id')
+                        if section == 'followers' else
+                        ('user_following_id', 'user_being_followed_id'))
+        query = (select([users.c.id, users.c.username])
+                 .select_from(users.join(
+                     follows, follows.c[theirs] == users.c.id))
+                 .where(follows.c[mine] == user_id)
+                 .order_by(users.c.id))
+        yield from _batches(db.engine, query, batch_size)
+
+    else:
+        raise ValueError(f"unknown section {section!r}")
+
+
+def ndjson_chunks(user_id, batch_size=1000):
+    """All of `user_id`'s data as NDJSON text, one chunk per batch."""
+
+    for section in SECTIONS:
+        for batch in section_batches(user_id, section, batch_size):
+            yield ''.join(json.dumps(dict(row, section=section)) + '\n'
+                          for row in batch)
+
+
+def csv_chunks(user_id, section, batch_size=1000):
+    """One section of `user_id`'s data as CSV text, one chunk per batch."""
+
+    columns = SECTIONS[section]
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, columns)
+    writer.writeheader()
+
+    for batch in section_batches(user_id, section, batch_size):
+        writer.writerows(batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def write_archive(user_id, path, fmt, batch_size=1000):
+    """Write `user_id`'s data to `path` as gzip NDJSON or a zip of CSVs."""
+
+    part = path + '.part'
+    try:
+        if fmt == 'ndjson':
+            with gzip.open(part, 'wt', encoding='utf-8') as f:
+                for chunk in ndjson_chunks(user_id, batch_size):
+                    f.write(chunk)
+        else:
+            with zipfile.ZipFile(part, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for section in SECTIONS:
+                    with zf.open(f"{section}.csv", 'w') as raw:
+                        with io.TextIOWrapper(raw, encoding='utf-8',
+                                              newline='') as f:
+                            for chunk in csv_chunks(user_id, section,
+                                                    batch_size):
+                                f.write(chunk)
+        os.replace(part, path)
+    except BaseException:
+        os.unlink(part)
+        raise
+
+
+class ExportJobs:
+    """Run archive exports one at a time on a background thread."""
+
+    def __init__(self, app, directory):
+        self.app = app
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        # Executor threads don't survive a fork; start one per process.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='export')
+                self._pid = os.getpid()
+            return self._executor
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def start(self, user_id, fmt):
+        """Queue an export of `user_id`'s data; return the file's name."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{user_id}-{secrets.token_hex(8)}{FORMATS[fmt]}"
+        # mark it as pending right away, so it can be polled
+        open(self.path(name) + '.part', 'wb').close()
+        self._pool().submit(self._run, user_id, name, fmt)
+        return name
+
+    def _run(self, user_id, name, fmt):
+        with self.app.app_context():
+            try:
+                write_archive(user_id, self.path(name), fmt,
+                              self.app.config['EXPORT_BATCH_ROWS'])
+            except Exception:
+                self.app.logger.exception("export %s failed", name)
+
+    def owner(self, name):
+        """Id of the user an export file name belongs to, or None."""
+
+        match = EXPORT_NAME.match(name)
+        return int(match[1]) if match else None
+
+    def status(self, name):
+        """'ready', 'pending' or None for an export file name."""
+
+        if os.path.isfile(self.path(name)):
+            return 'ready'
+        if os.path.isfile(self.path(name) + '.part'):
+            return 'pending'
+        return None
+
+
+def init_app(app):
+    app.extensions['exports'] = ExportJobs(
+        app, app.config['EXPORT_DIR']
+        or os.path.join(app.instance_path, 'exports'))
+
+
+@click.command('export-user')
+@click.argument('user_id', type=int)
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)),
+              default='ndjson')
+@with_appcontext
+def export_user_command(user_id, path, fmt):
+    """Export USER_ID's data to PATH (gzip NDJSON or a zip of CSVs)."""
+
+    write_archive(user_id, path, fmt, current_app.config['EXPORT_BATCH_ROWS'])
+    click.echo(f"Exported user {user_id} to {path}.")
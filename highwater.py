@@ -0,0 +1,149 @@
+"""In-memory high-water marks of each author's newest message.
+
+`/api/feed/new?since=<id>` tells a polling client how many messages in
+its home feed are newer than the newest one it has. Since message ids are
+time-ordered snowflakes, an author with nothing newer than `since` is
+ruled out by comparing one number, and most polls find nothing new for
+anybody, so they are answered without querying the messages table.
+
+For every author it has seen, the tracker keeps the newest message id and
+the ids of their last few messages. It also keeps a floor: the id above
+which it knows every message. Counts above the floor come from memory;
+the rare poll reaching below it is counted in the database.
+
+Marks are kept current by listening to the pub/sub broker (see
+pubsub.py), which sees every post made in this process or, with the
+socket broker, on the host. As a safety net against missed events, marks
+are re-checked against the database after `HIGHWATER_TTL` seconds.
+"""
+
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import func
+
+import metrics
+import sharding
+from models import db, Message
+
+
+class _Mark:
+    __slots__ = ('latest', 'floor', 'recent', 'checked')
+
+    def __init__(self, latest, checked, size):
+        self.latest = latest
+        self.floor = latest
+        self.recent = deque([latest] if latest else [], maxlen=size)
+        self.checked = checked
+
+
+class HighWaterMarks:
+    """Newest message id per author, to count new feed messages cheaply.
+
+    `load_latest(user_ids)` returns {user_id: newest id} for authors with
+    messages; `count_since(user_ids, since)` counts their messages newer
+    than `since`. Both hit the database and are called as little as
+    possible.
+    """
+
+    def __init__(self, load_latest, count_since, ttl=30, recent=20,
+                 clock=time.monotonic):
+        self.load_latest = load_latest
+        self.count_since = count_since
+        self.ttl = ttl
+        self.recent = recent
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._marks = {}
+
+    def observe(self, user_id, message_id):
+        """Record a new message by `user_id`."""
+
+        with self._lock:
+            mark = self._marks.get(user_id)
+            if mark is None:
+                # never asked about: load from the database when we are
+                return
+            if message_id > mark.latest:
+                mark.latest = message_id
+            if len(mark.recent) == mark.recent.maxlen:
+                # the oldest recent id drops out; we now know less
+                mark.floor = mark.recent[1]
+            mark.recent.append(message_id)
+
+    def _marks_for(self, user_ids):
+        now = self.clock()
+        with self._lock:
+            stale = [uid for uid in user_ids
+                     if uid not in self._marks
+                     or now - self._marks[uid].checked > self.ttl]
+        metrics.cache_result('highwater', not stale)
+
+        if stale:
+            latest = self.load_latest(stale)
+            with self._lock:
+                for uid in stale:
+                    mark = self._marks.get(uid)
+                    found = latest.get(uid, 0)
+                    if mark is None or found > mark.latest:
+                        # new, or we missed something: start over from here
+                        self._marks[uid] = _Mark(found, now, self.recent)
+                    else:
+                        mark.checked = now
+
+        with self._lock:
+            return {uid: self._marks[uid] for uid in user_ids}
+
+    def new_since(self, user_ids, since):
+        """(count, newest id) of messages by `user_ids` newer than `since`."""
+
+        count = 0
+        unknown = []
+        newest = since
+
+        for uid, mark in self._marks_for(set(user_ids)).items():
+            if mark.latest <= since:
+                continue
+            newest = max(newest, mark.latest)
+            if since >= mark.floor:
+                count += sum(1 for i in mark.recent if i > since)
+            else:
+                unknown.append(uid)
+
+        if unknown:
+            count += self.count_since(unknown, since)
+        return count, newest
+
+
+def _load_latest(user_ids):
+    router = sharding.get_router()
+    if router:
+        return router.latest_ids(user_ids)
+
+    query = (db.session
+             .query(Message.user_id, func.max(Message.id))
+             .filter(Message.user_id.in_(user_ids))
+             .group_by(Message.user_id))
+    return dict(query.all())
+
+
+def _count_since(user_ids, since):
+    router = sharding.get_router()
+    if router:
+        return router.count_since(user_ids, since)
+
+    return (Message
+            .query
+            .filter(Message.user_id.in_(user_ids), Message.id > since)
+            .count())
+
+
+def init_app(app):
+    """Track high-water marks from the app's pub/sub broker."""
+
+    marks = HighWaterMarks(_load_latest, _count_since,
+                           ttl=app.config['HIGHWATER_TTL'])
+    app.extensions['highwater'] = marks
+    app.extensions['pubsub'].add_listener(
+        lambda topic, event: marks.observe(event['user_id'], event['id']))
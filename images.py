@@ -0,0 +1,409 @@
+"""Avatar and header thumbnails with a local content-addressed cache.
+
+Instead of hotlinking `User.image_url` / `User.header_image_url` at full
+size, templates use `thumb_url(user, variant)`, which points at
+/users/<id>/images/<variant>/<key>. The first request for a variant
+fetches the source image, resizes it once with Pillow, and stores it under
+the SHA-256 of the source bytes, so identical images (e.g. everyone's
+default avatar) share one thumbnail. The <key> is derived from the source
+URL, so a thumbnail URL changes whenever the user changes their image,
+which lets us serve thumbnails with immutable caching.
+
+The cache directory is bounded by `IMAGE_CACHE_MAX_BYTES`; the least
+recently used files are evicted when it fills up.
+
+Sources are read through a fetcher: HTTPFetcher for remote hosts, or
+LocalDirectoryFetcher when `IMAGE_SOURCE_DIR` is set, which maps
+http://host/path to <dir>/host/path (handy for tests and offline dev).
+Our own /static/ and /uploads/ paths are always read from disk.
+
+Pillow is required to generate thumbnails; without it, `thumb_url()` falls
+back to the original image URL.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import ssl
+import tempfile
+import threading
+from collections import namedtuple
+from urllib.parse import urljoin, urlparse
+
+from flask import current_app, send_file
+
+import metrics
+from assets import asset_url
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+Variant = namedtuple('Variant', ['attr', 'size'])
+
+VARIANTS = {
+    # timeline and nav avatars are shown at 48px; 2x for hi-dpi screens
+    'avatar': Variant('image_url', (96, 96)),
+    'card': Variant('image_url', (200, 200)),
+    'header': Variant('header_image_url', (1200, 300)),
+}
+
+UPLOAD_URL_PREFIX = '/uploads/'
+
+
+class ImageError(Exception):
+    """The source image could not be fetched or decoded."""
+
+
+def url_key(url):
+    """Short, stable key for a source URL."""
+
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _read_limited(f, max_bytes):
+    data = f.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise ImageError("source image is too large")
+    return data
+
+
+# Leading bytes of the formats Pillow will accept as uploads.
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+
+def _sniff_mimetype(path):
+    """Content type of the image at `path`, from its first bytes.
+
+    Uploads are stored under their digest, with no extension to go by.
+    """
+
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection to an address we've already vetted.
+
+    The Host header still names the original host.
+    """
+
+    def __init__(self, host, ip, port=None, timeout=None):
+        super().__init__(host, port, timeout=timeout)
+        self.ip = ip
+
+    def connect(self):
+        self.sock = socket.create_connection((self.ip, self.port),
+                                             self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """Like _PinnedHTTPConnection; the certificate is checked against the
+    original host name."""
+
+    def __init__(self, host, ip, port=None, timeout=None):
+        super().__init__(host, port, timeout=timeout,
+                         context=ssl.create_default_context())
+        self.ip = ip
+
+    def connect(self):
+        sock = socket.create_connection((self.ip, self.port), self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class HTTPFetcher:
+    """Fetch source images from remote http(s) hosts.
+
+    image_url is user input, so it mustn't reach internal services: every
+    hop, redirects included, connects only to an address that resolved to
+    a public IP, and to that address rather than a fresh lookup of the
+    name (which DNS rebinding could point elsewhere).
+    """
+
+    MAX_REDIRECTS = 3
+
+    def __init__(self, timeout=5, max_bytes=10 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+    def _resolve(self, host, port):
+        """A public address for `host`; ImageError if any is not public."""
+
+        try:
+            addrs = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as exc:
+            raise ImageError(str(exc))
+        for addr in addrs:
+            ip = ipaddress.ip_address(addr[4][0])
+            if not ip.is_global:
+                raise ImageError(f"refusing to fetch from {ip}")
+        if not addrs:
+            raise ImageError(f"can't resolve {host!r}")
+        return addrs[0][4][0]
+
+    def fetch(self, url):
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+                raise ImageError(f"can't fetch {url!r}")
+            connection = (_PinnedHTTPSConnection if parsed.scheme == 'https'
+                          else _PinnedHTTPConnection)
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+            conn = connection(parsed.hostname,
+                              self._resolve(parsed.hostname, port), port,
+                              timeout=self.timeout)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                if resp.status in (301, 302, 303, 307, 308):
+                    location = resp.getheader('Location')
+                    if not location:
+                        raise ImageError("redirect without a location")
+                    url = urljoin(url, location)
+                    continue
+                if resp.status != 200:
+                    raise ImageError(f"{url} returned {resp.status}")
+                return _read_limited(resp, self.max_bytes)
+            except (OSError, http.client.HTTPException) as exc:
+                raise ImageError(str(exc))
+            finally:
+                conn.close()
+        raise ImageError(f"too many redirects fetching {url!r}")
+
+
+class LocalDirectoryFetcher:
+    """Stand in for remote hosts: read http://host/path from root/host/path."""
+
+    def __init__(self, root, max_bytes=10 * 1024 * 1024):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+
+    def fetch(self, url):
+        parsed = urlparse(url)
+        path = os.path.realpath(os.path.join(
+            self.root, parsed.netloc, parsed.path.lstrip('/')))
+
+        if not path.startswith(self.root + os.sep):
+            raise ImageError(f"can't fetch {url!r}")
+        try:
+            with open(path, 'rb') as f:
+                return _read_limited(f, self.max_bytes)
+        except OSError as exc:
+            raise ImageError(str(exc))
+
+
+class ImageCache:
+    """On-disk cache of files with least-recently-used eviction.
+
+    Reads bump a file's mtime, so eviction removes the files with the
+    oldest mtimes until the cache is back under 90% of `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def get(self, path):
+        """Return `path` if it is cached (marking it recently used)."""
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, path, data):
+        _write_atomic(path, data)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(os.path.getsize(p) for p, _ in self._files())
+            else:
+                self._size += len(data)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+        return path
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda f: f[1].st_mtime)
+        size = sum(st.st_size for _, st in files)
+        target = self.max_bytes * 0.9
+
+        for path, st in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= st.st_size
+
+        self._size = size
+
+
+class ImageService:
+    """Fetch, thumbnail, cache and serve user images."""
+
+    def __init__(self, cache_dir, upload_dir, static_dir, fetcher,
+                 max_cache_bytes=512 * 1024 * 1024):
+        self.cache = ImageCache(cache_dir, max_cache_bytes)
+        self.upload_dir = upload_dir
+        self.static_dir = static_dir
+        self.fetcher = fetcher
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def fetch(self, url):
+        """Source bytes for `url`, which may be one of our own paths."""
+
+        for prefix, root in (('/static/', self.static_dir),
+                             (UPLOAD_URL_PREFIX, self.upload_dir)):
+            if url.startswith(prefix):
+                return LocalDirectoryFetcher(root).fetch(url[len(prefix):])
+        return self.fetcher.fetch(url)
+
+    def store_upload(self, data):
+        """Keep an uploaded image; return its URL (/uploads/<sha256>)."""
+
+        self._decode(data)
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.upload_dir, digest)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+        return UPLOAD_URL_PREFIX + digest
+
+    def thumbnail(self, url, variant):
+        """Path of the `variant` thumbnail of `url`, generating it if needed."""
+
+        index = self.cache.path('urls', url_key(url))
+        digest = None
+        if self.cache.get(index):
+            with open(index) as f:
+                digest = f.read().strip()
+            thumb = self.cache.get(self._thumb_path(digest, variant))
+            if thumb:
+                metrics.cache_result('images', True)
+                return thumb
+
+        metrics.cache_result('images', False)
+        data = self.fetch(url)
+        digest = hashlib.sha256(data).hexdigest()
+        self.cache.put(index, digest.encode('ascii'))
+
+        path = self._thumb_path(digest, variant)
+        if self.cache.get(path):
+            return path
+        return self.cache.put(path, self._resize(data, VARIANTS[variant].size))
+
+    def send(self, path):
+        """Serve a cached file with long-lived caching and range support."""
+
+        resp = send_file(path, mimetype=_sniff_mimetype(path),
+                         conditional=True, cache_timeout=ONE_YEAR)
+        resp.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+        return resp
+
+    def _thumb_path(self, digest, variant):
+        return self.cache.path('thumbs', variant, digest[:2], digest + '.jpg')
+
+    def _decode(self, data):
+        if Image is None:
+            raise ImageError("Pillow is not installed")
+        try:
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        except (OSError, ValueError, Image.DecompressionBombError) as exc:
+            raise ImageError(str(exc))
+        return img
+
+    def _resize(self, data, size):
+        img = self._decode(data)
+        img = ImageOps.exif_transpose(img)
+
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        else:
+            img = img.convert('RGB')
+
+        thumb = ImageOps.fit(img, size, Image.LANCZOS)
+        out = io.BytesIO()
+        thumb.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+        return out.getvalue()
+
+
+def init_app(app):
+    """Attach an ImageService to `app` and expose thumb_url() to templates."""
+
+    config = app.config
+    source_dir = config['IMAGE_SOURCE_DIR']
+
+    app.extensions['images'] = ImageService(
+        cache_dir=(config['IMAGE_CACHE_DIR']
+                   or os.path.join(app.instance_path, 'image-cache')),
+        upload_dir=(config['IMAGE_UPLOAD_DIR']
+                    or os.path.join(app.instance_path, 'uploads')),
+        static_dir=app.static_folder,
+        fetcher=(LocalDirectoryFetcher(source_dir) if source_dir
+                 else HTTPFetcher()),
+        max_cache_bytes=config['IMAGE_CACHE_MAX_BYTES'],
+    )
+    app.jinja_env.globals['thumb_url'] = thumb_url
+
+
+def thumb_url(user, variant):
+    """URL of the `variant` thumbnail of one of `user`'s images."""
+
+    source = getattr(user, VARIANTS[variant].attr)
+    if not source or not current_app.extensions['images'].enabled:
+        return asset_url(source)
+    return f"/users/{user.id}/images/{variant}/{url_key(source)}"
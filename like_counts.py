@@ -0,0 +1,209 @@
+"""Like counts on messages, without COUNT(*) over `likes`.
+
+Each worker adds up likes and unlikes in memory. A background thread
+flushes them every `LIKE_COUNT_FLUSH_SECONDS` into `like_counts`. That
+table keeps `LIKE_COUNT_SHARDS` rows per message, and each flush adds to
+a randomly chosen one. So workers flushing the same hot message rarely
+wait on each other's row lock, and a burst of likes costs one UPDATE per
+flush, not one per like.
+
+A message's count is the sum of its rows. A 100-message page reads them
+all in one grouped query on the primary key. The worker's own unflushed
+deltas are added on top, so whoever just liked something sees it
+counted.
+
+`flask likes recount` rebuilds the table from `likes`. Use it to start
+off, or to fix drift from counts lost when a worker died before
+flushing.
+"""
+
+import os
+import random
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+
+import sharding
+from models import db, LikeCount, Likes, Message
+
+
+class LikeCounter:
+    """This worker's unflushed like counts, and the thread that flushes them."""
+
+    def __init__(self, app, shards=16, flush_seconds=1):
+        self.app = app
+        self.shards = shards
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pid = None
+
+    def _ensure_thread(self):
+        # The flush thread doesn't survive a fork; start one per process.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='like-count-flush',
+                         daemon=True).start()
+
+    def record(self, message_id, liked):
+        self._ensure_thread()
+        with self._lock:
+            self._pending[message_id] = (self._pending.get(message_id, 0)
+                                         + (1 if liked else -1))
+
+    def pending(self):
+        """A copy of the unflushed counts."""
+
+        with self._lock:
+            return dict(self._pending)
+
+    def settle(self, flushed):
+        """Take counts that have been committed off the pending ones."""
+
+        with self._lock:
+            for message_id, amount in flushed.items():
+                if message_id not in self._pending:
+                    # forgotten meanwhile
+                    continue
+                left = self._pending[message_id] - amount
+                if left:
+                    self._pending[message_id] = left
+                else:
+                    del self._pending[message_id]
+
+    def forget(self, message_ids):
+        """Drop the unflushed counts of deleted messages."""
+
+        with self._lock:
+            for message_id in message_ids:
+                self._pending.pop(message_id, None)
+
+    def counts(self, message_ids):
+        """{message id: like count} for `message_ids` with any likes."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        table = LikeCount.__table__
+        counts = dict(db.session.execute(
+            select([table.c.message_id, func.sum(table.c.count)])
+            .where(table.c.message_id.in_(message_ids))
+            .group_by(table.c.message_id)).fetchall())
+        with self._lock:
+            for message_id in message_ids:
+                if message_id in self._pending:
+                    counts[message_id] = (counts.get(message_id, 0)
+                                          + self._pending[message_id])
+        return {message_id: int(count)
+                for message_id, count in counts.items() if count > 0}
+
+    def flush(self, engine):
+        """Add the pending counts to the database.
+
+        They stay pending, and so counted by counts(), until the flush
+        commits. New rows are only written for messages that still exist,
+        so a delete isn't undone by a late flush from another worker.
+        """
+
+        table = LikeCount.__table__
+        pending = self.pending()
+        with engine.begin() as conn:
+            new = []
+            for message_id, amount in sorted(pending.items()):
+                if not amount:
+                    continue
+                shard = random.randrange(self.shards)
+                match = ((table.c.message_id == message_id)
+                         & (table.c.shard == shard))
+                updated = conn.execute(table.update().where(match).values(
+                    count=table.c.count + amount)).rowcount
+                if not updated:
+                    new.append({'message_id': message_id, 'shard': shard,
+                                'count': amount})
+            if new:
+                alive = existing_messages(conn, [r['message_id'] for r in new])
+                new = [r for r in new if r['message_id'] in alive]
+            if new:
+                conn.execute(table.insert(), new)
+        self.settle(pending)
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_seconds)
+            try:
+                with self.app.app_context():
+                    self.flush(db.get_engine(self.app))
+            except Exception:
+                self.app.logger.exception("like count flush failed")
+
+
+def existing_messages(conn, message_ids):
+    """Which of `message_ids` are still around, on the shards or `conn`."""
+
+    router = sharding.get_router()
+    if router:
+        return router.existing_ids(message_ids)
+    table = Message.__table__
+    return {row.id for row in conn.execute(
+        select([table.c.id]).where(table.c.id.in_(message_ids)))}
+
+
+def counts(message_ids):
+    """{message id: like count} for the current app."""
+
+    return current_app.extensions['like_counts'].counts(message_ids)
+
+
+def record(message_id, liked):
+    current_app.extensions['like_counts'].record(message_id, liked)
+
+
+def forget(message_ids):
+    current_app.extensions['like_counts'].forget(message_ids)
+
+
+def recount(engine):
+    """Rebuild `like_counts` from the likes tables; return rows written."""
+
+    router = sharding.get_router()
+    sources = ([(shard, sharding.likes) for shard in router.shards]
+               if router else [(engine, Likes.__table__)])
+    totals = {}
+    for source, likes in sources:
+        for message_id, count in source.execute(
+                select([likes.c.message_id, func.count()])
+                .group_by(likes.c.message_id)):
+            totals[message_id] = totals.get(message_id, 0) + count
+
+    table = LikeCount.__table__
+    with engine.begin() as conn:
+        conn.execute(table.delete())
+        if totals:
+            conn.execute(table.insert(), [
+                {'message_id': message_id, 'shard': 0, 'count': count}
+                for message_id, count in totals.items()])
+    return len(totals)
+
+
+likes_cli = AppGroup('likes', help="Maintain message like counts.")
+
+
+@likes_cli.command('recount')
+def recount_command():
+    """Rebuild like counts from the likes themselves."""
+
+    count = recount(db.engine)
+    click.echo(f"Counted likes on {count} messages.")
+
+
+def init_app(app):
+    app.extensions['like_counts'] = LikeCounter(
+        app, app.config['LIKE_COUNT_SHARDS'],
+        app.config['LIKE_COUNT_FLUSH_SECONDS'])
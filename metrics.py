@@ -0,0 +1,383 @@
+"""Prometheus-style metrics for the web tier, served at /metrics.
+
+Collected:
+
+- warbler_http_request_duration_seconds: latency per endpoint (histogram)
+- warbler_http_requests_in_flight: requests being handled right now
+- warbler_http_responses_total: responses per endpoint and status code
+- warbler_db_queries_total / warbler_db_query_duration_seconds: SQL
+  statements per endpoint, and how long they took
+- warbler_db_pool_checkout_wait_seconds: time spent waiting for a pooled
+  connection
+- warbler_cache_requests_total: hits and misses per cache (image
+  thumbnails, template bytecode, feed high-water marks)
+- warbler_bcrypt_in_progress / warbler_bcrypt_duration_seconds: password
+  hashes queued or running, and how long each took
+
+Each process counts in memory. With `METRICS_DIR` set, it also writes its
+numbers to <dir>/<pid>.json (atomically, at most every
+`METRICS_FLUSH_SECONDS`), and /metrics adds up every process's file. So
+one scrape covers all prefork workers. Counters and histograms of exited
+workers keep counting toward the totals; their gauges are dropped.
+Empty the directory before (re)starting the server.
+
+Without `METRICS_DIR`, /metrics reports the process that answers it.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1, 2.5)
+
+# name: (type, help, buckets)
+METRICS = {
+    'warbler_http_request_duration_seconds': (
+        'histogram', "Request latency by endpoint.", LATENCY_BUCKETS),
+    'warbler_http_requests_in_flight': (
+        'gauge', "Requests being handled.", None),
+    'warbler_http_responses_total': (
+        'counter', "Responses by endpoint and status code.", None),
+    'warbler_db_queries_total': (
+        'counter', "SQL statements executed, by endpoint.", None),
+    'warbler_db_query_duration_seconds': (
+        'histogram', "SQL statement duration, by endpoint.", QUERY_BUCKETS),
+    'warbler_db_pool_checkout_wait_seconds': (
+        'histogram', "Time waiting for a pooled DB connection.",
+        QUERY_BUCKETS),
+    'warbler_cache_requests_total': (
+        'counter', "Cache lookups by cache and result (hit/miss).", None),
+    'warbler_bcrypt_in_progress': (
+        'gauge', "Password hashes waiting or running.", None),
+    'warbler_bcrypt_duration_seconds': (
+        'histogram', "Time to hash or check a password.", LATENCY_BUCKETS),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    """One process's metric values."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = _key(name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': self.pid,
+                'values': [[n, list(map(list, l)), v]
+                           for (n, l), v in self.values.items()],
+                'histograms': [[n, list(map(list, l)), list(h[0]), h[1], h[2]]
+                               for (n, l), h in self.histograms.items()],
+            }
+
+
+_registry = Registry()
+_registry_lock = threading.Lock()
+
+
+def registry():
+    """This process's Registry (a fresh one after a fork)."""
+
+    global _registry
+    if _registry.pid != os.getpid():
+        with _registry_lock:
+            if _registry.pid != os.getpid():
+                _registry = Registry()
+    return _registry
+
+
+def inc(name, amount=1, **labels):
+    registry().inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    registry().observe(name, value, **labels)
+
+
+def cache_result(cache, hit):
+    """Count a lookup in `cache` as a hit or a miss."""
+
+    inc('warbler_cache_requests_total', cache=cache,
+        result='hit' if hit else 'miss')
+
+
+@contextmanager
+def track_bcrypt():
+    """Count a password hash as in progress, and time it."""
+
+    inc('warbler_bcrypt_in_progress')
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('warbler_bcrypt_duration_seconds',
+                time.perf_counter() - start)
+        inc('warbler_bcrypt_in_progress', -1)
+
+
+##############################################################################
+# Aggregation across processes
+
+
+class MetricsDirectory:
+    """Per-process snapshot files, merged at scrape time."""
+
+    def __init__(self, path, flush_seconds=1.0):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self._last_flush = 0
+        os.makedirs(path, exist_ok=True)
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_seconds:
+            return
+        self._last_flush = now
+
+        snapshot = registry().snapshot()
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, os.path.join(self.path, f"{snapshot['pid']}.json"))
+
+    def snapshots(self):
+        self.flush(force=True)
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots):
+    """Add up snapshots; gauges only count processes still running."""
+
+    values = {}
+    histograms = {}
+    for snap in snapshots:
+        alive = None
+        for name, labels, value in snap['values']:
+            if METRICS[name][0] == 'gauge':
+                if alive is None:
+                    alive = _alive(snap['pid'])
+                if not alive:
+                    continue
+            key = (name, tuple(map(tuple, labels)))
+            values[key] = values.get(key, 0) + value
+
+        for name, labels, buckets, total, count in snap['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            h = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            h[0] = [a + b for a, b in zip(h[0], buckets)]
+            h[1] += total
+            h[2] += count
+    return values, histograms
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return '{' + body + '}'
+
+
+def exposition(values, histograms):
+    """Prometheus text format for merged values."""
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        if kind == 'histogram':
+            for (n, labels), (counts, total, count) in sorted(
+                    histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(buckets, counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket"
+                                 f"{_labels(labels, [('le', bound)])} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_bucket"
+                             f"{_labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        else:
+            for (n, labels), value in sorted(values.items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def render(app):
+    """The /metrics page for `app`."""
+
+    directory = app.extensions.get('metrics_dir')
+    if directory is None:
+        snapshots = [registry().snapshot()]
+    else:
+        snapshots = directory.snapshots()
+    return exposition(*merge(snapshots))
+
+
+##############################################################################
+# Instrumentation
+
+
+def _endpoint():
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'none'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['query_start'].pop()
+    endpoint = _endpoint()
+    inc('warbler_db_queries_total', endpoint=endpoint)
+    observe('warbler_db_query_duration_seconds',
+            time.perf_counter() - started, endpoint=endpoint)
+
+
+def _handle_error(context):
+    starts = context.connection and context.connection.info.get('query_start')
+    if starts:
+        starts.pop()
+
+
+def instrument_queries():
+    """Time every SQL statement run by any engine."""
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+def instrument_pool(engine):
+    """Time how long `engine` callers wait for a pooled connection."""
+
+    def wrap(pool):
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                observe('warbler_db_pool_checkout_wait_seconds',
+                        time.perf_counter() - start)
+
+        pool.connect = timed_connect
+
+    wrap(engine.pool)
+    # dispose() swaps in a new pool
+    event.listen(engine, 'engine_disposed', lambda e: wrap(engine.pool))
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_in_flight = True
+    inc('warbler_http_requests_in_flight')
+
+
+def _finish_request(response):
+    started = g.pop('metrics_start', None)
+    if started is not None:
+        endpoint = request.endpoint or 'none'
+        observe('warbler_http_request_duration_seconds',
+                time.perf_counter() - started, endpoint=endpoint,
+                method=request.method)
+        inc('warbler_http_responses_total', endpoint=endpoint,
+            status=str(response.status_code))
+    return response
+
+
+def init_app(app, engines=()):
+    """Record metrics for `app` and its database `engines`.
+
+    With METRICS_DIR set, they are also written there for /metrics to
+    aggregate.
+    """
+
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    instrument_queries()
+    for engine in engines:
+        instrument_pool(engine)
+
+    directory = None
+    if app.config['METRICS_DIR']:
+        directory = MetricsDirectory(app.config['METRICS_DIR'],
+                                     app.config['METRICS_FLUSH_SECONDS'])
+        app.extensions['metrics_dir'] = directory
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    @app.teardown_request
+    def end_request(exc):
+        if g.pop('metrics_in_flight', False):
+            inc('warbler_http_requests_in_flight', -1)
+        if directory is not None:
+            directory.flush()
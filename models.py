@@ -5,6 +5,9 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+import metrics
+import snowflake
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -13,6 +16,17 @@ class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # the primary key serves "who follows X"; this serves "who does X
+        # follow"
+        db.Index('ix_follows_user_following_id', 'user_following_id',
+                 'user_being_followed_id'),
+        # newest-first pages of following/followers lists
+        db.Index('ix_follows_following_created', 'user_following_id',
+                 'created_at'),
+        db.Index('ix_follows_followed_created', 'user_being_followed_id',
+                 'created_at'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -26,11 +40,21 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        # one like per user per message, any number of users per message
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -43,9 +67,15 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 
 
@@ -81,6 +111,16 @@ class User(db.Model):
         default="/static/images/warbler-hero.jpg"
     )
 
+    # PageRank over the follow graph, scaled so the average user has 1.0;
+    # set by `flask influence update` (see influence.py)
+    influence = db.Column(
+        db.Float,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True,
+    )
+
     bio = db.Column(
         db.Text,
     )
@@ -118,6 +158,18 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def following_count(self):
+        return (Follows.query
+                .filter(Follows.user_following_id == self.id)
+                .count())
+
+    @property
+    def followers_count(self):
+        return (Follows.query
+                .filter(Follows.user_being_followed_id == self.id)
+                .count())
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -137,7 +189,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with metrics.track_bcrypt():
+            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -163,21 +216,40 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with metrics.track_bcrypt():
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
         return False
 
 
+def message_id_default(context):
+    """Snowflake id for a new message, minted for its timestamp if given."""
+
+    timestamp = context.get_current_parameters().get('timestamp')
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return snowflake.next_id(at=timestamp)
+
+
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are snowflakes (see snowflake.py), so they sort by posting time:
+    feeds order and paginate by id alone.
+    """
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=message_id_default,
     )
 
     text = db.Column(
@@ -188,7 +260,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -200,6 +272,244 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class ShardPlacement(db.Model):
+    """An author whose messages live on a shard other than the default.
+
+    See sharding.py.
+    """
+
+    __tablename__ = 'shard_placements'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class MessageTag(db.Model):
+    """A #tag used in a message. See tags.py.
+
+    No foreign key to `messages`, which may be sharded; rows are removed
+    along with their message.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class MessageMention(db.Model):
+    """A user @mentioned in a message. See tags.py."""
+
+    __tablename__ = 'message_mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class TrendingCount(db.Model):
+    """Likes of a message, or posts using a tag, in one time bucket.
+
+    See trending.py.
+    """
+
+    __tablename__ = 'trending_counts'
+
+    kind = db.Column(
+        db.String(10),
+        primary_key=True,
+    )
+
+    key = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A user suggested for another to follow. See recommendations.py."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    candidate = db.relationship('User', foreign_keys=[candidate_id])
+
+
+class FollowChange(db.Model):
+    """A user whose follows changed since recommendations were computed."""
+
+    __tablename__ = 'follow_changes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    changed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class LikeCount(db.Model):
+    """Part of a message's like count; its rows add up to the total.
+
+    See like_counts.py.
+    """
+
+    __tablename__ = 'like_counts'
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class UserActivity(db.Model):
+    """A user's precomputed activity analytics. See analytics.py."""
+
+    __tablename__ = 'user_activity'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # the weekly arrays cover the weeks up to here
+    window_end = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # packed int32 arrays
+    hours = db.Column(db.LargeBinary, nullable=False)
+    weekdays = db.Column(db.LargeBinary, nullable=False)
+    posts = db.Column(db.LargeBinary, nullable=False)
+    likes = db.Column(db.LargeBinary, nullable=False)
+    followers = db.Column(db.LargeBinary, nullable=False)
+
+
+class Event(db.Model):
+    """One write, in the change event log. See events.py."""
+
+    __tablename__ = 'events'
+
+    seq = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True,
+    )
+
+    type = db.Column(
+        db.String(30),
+        nullable=False,
+    )
+
+    data = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class EventCheckpoint(db.Model):
+    """How far a consumer of the change event log has got."""
+
+    __tablename__ = 'event_checkpoints'
+
+    name = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    seq = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,498 @@
+"""Monthly partitions of the messages table, and a cold archive.
+
+Message ids are snowflakes (see snowflake.py), so a range of ids is a
+range of time. `flask partitions convert` turns `messages` into a table
+partitioned by month on `id` (Postgres only; run it once, in a quiet
+moment, since it copies the table). Feeds read newest-first with a
+LIMIT, so Postgres reads the newest partitions first and stops early,
+and a `?before=` cursor prunes every partition above it.
+
+`flask partitions maintain` (run it daily) creates partitions for the
+coming months and moves months older than `MESSAGE_ARCHIVE_AFTER_MONTHS`
+into the archive.
+
+The archive is one gzip file per month in `MESSAGE_ARCHIVE_DIR`. Each
+author's messages for that month are a separate gzip member of
+newest-first NDJSON, and a JSON index gives the offset of each member.
+So the whole file is still a valid gzip file, but one author's month can
+be read without decompressing anyone else's. Profiles fall back to the
+archive when the live table runs out of older messages. Archived
+messages are read-only, and their likes are kept as a list of user ids.
+Archiving a month again, e.g. after a backdated post landed in it, merges
+the new messages into its file.
+
+Without partitioning (e.g. on SQLite), `archive_month()` deletes the
+archived rows instead of dropping a partition.
+"""
+
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import date, datetime
+from itertools import groupby, islice
+from operator import attrgetter, itemgetter
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import column, func, select, table as table_clause, text
+
+from models import db, LikeCount, Likes, Message, MessageMention, MessageTag
+from snowflake import lowest_id_at, timestamp_of
+
+PARTITION_NAME = re.compile(r'^messages_y(\d{4})m(\d{2})$')
+ARCHIVE_NAME = re.compile(r'^messages-(\d{4})-(\d{2})\.ndjson\.gz$')
+
+# ids per DELETE when clearing archived rows
+DELETE_BATCH = 1000
+
+
+def month_of(dt):
+    return date(dt.year, dt.month, 1)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def archive_cutoff(now=None):
+    """The first month kept live, or None if nothing is archived."""
+
+    after = current_app.config['MESSAGE_ARCHIVE_AFTER_MONTHS']
+    if after is None:
+        return None
+    return add_months(month_of(now or datetime.utcnow()), -after)
+
+
+def month_bounds(month):
+    """The range [lo, hi) of ids minted during `month`."""
+
+    return (lowest_id_at(datetime(month.year, month.month, 1)),
+            lowest_id_at(datetime.combine(add_months(month, 1),
+                                          datetime.min.time())))
+
+
+def partition_name(month):
+    return f"messages_y{month.year:04d}m{month.month:02d}"
+
+
+class PartitionManager:
+    """Create, list, convert and archive monthly message partitions."""
+
+    def __init__(self, engine, archive):
+        self.engine = engine
+        self.archive = archive
+
+    @property
+    def supported(self):
+        return self.engine.dialect.name == 'postgresql'
+
+    def is_partitioned(self):
+        if not self.supported:
+            return False
+        return bool(self.engine.execute(text(
+            "SELECT 1 FROM pg_partitioned_table pt "
+            "JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = 'messages'")).first())
+
+    def partitions(self):
+        """Months that have a partition, oldest first."""
+
+        if not self.supported:
+            return []
+        names = self.engine.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'messages'")).fetchall()
+        months = [PARTITION_NAME.match(name) for name, in names]
+        return sorted(date(int(m[1]), int(m[2]), 1) for m in months if m)
+
+    def _create_partition(self, conn, month):
+        lo, hi = month_bounds(month)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF messages FOR VALUES FROM ({lo}) TO ({hi})"))
+
+    def create_future(self, months_ahead):
+        """Make sure this month and the next `months_ahead` have partitions."""
+
+        this_month = month_of(datetime.utcnow())
+        with self.engine.begin() as conn:
+            for n in range(months_ahead + 1):
+                self._create_partition(conn, add_months(this_month, n))
+
+    def convert(self, months_ahead):
+        """Rebuild a plain `messages` table as a partitioned one."""
+
+        if not self.supported:
+            raise RuntimeError("partitioning needs PostgreSQL")
+        if self.is_partitioned():
+            return
+
+        with self.engine.begin() as conn:
+            oldest = conn.execute(select([func.min(Message.id)])).scalar()
+            first = (month_of(timestamp_of(oldest)) if oldest is not None
+                     else month_of(datetime.utcnow()))
+
+            conn.execute(text(
+                "ALTER TABLE messages RENAME TO messages_unpartitioned"))
+            conn.execute(text(
+                "ALTER TABLE messages_unpartitioned "
+                "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey"))
+            conn.execute(text(
+                "ALTER INDEX ix_messages_user_id_id "
+                "RENAME TO ix_messages_unpartitioned_user_id_id"))
+
+            conn.execute(text(
+                "CREATE TABLE messages (LIKE messages_unpartitioned "
+                "INCLUDING DEFAULTS) PARTITION BY RANGE (id)"))
+            conn.execute(text("ALTER TABLE messages ADD PRIMARY KEY (id)"))
+            conn.execute(text(
+                "ALTER TABLE messages ADD FOREIGN KEY (user_id) "
+                "REFERENCES users (id) ON DELETE CASCADE"))
+            conn.execute(text(
+                "CREATE INDEX ix_messages_user_id_id "
+                "ON messages (user_id, id)"))
+            # catches backdated rows older than the first partition
+            conn.execute(text(
+                "CREATE TABLE messages_default PARTITION OF messages DEFAULT"))
+
+            month = first
+            last = add_months(month_of(datetime.utcnow()), months_ahead)
+            while month <= last:
+                self._create_partition(conn, month)
+                month = add_months(month, 1)
+
+            conn.execute(text(
+                "INSERT INTO messages SELECT * FROM messages_unpartitioned"))
+            conn.execute(text(
+                "ALTER TABLE likes DROP CONSTRAINT likes_message_id_fkey"))
+            conn.execute(text(
+                "ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey "
+                "FOREIGN KEY (message_id) REFERENCES messages (id) "
+                "ON DELETE CASCADE"))
+            conn.execute(text("DROP TABLE messages_unpartitioned"))
+
+    def months_with_messages(self, before):
+        """Months earlier than `before` that still have live messages."""
+
+        oldest = self.engine.execute(select([func.min(Message.id)])).scalar()
+        if oldest is None:
+            return []
+
+        months = []
+        month = month_of(timestamp_of(oldest))
+        while month < before:
+            lo, hi = month_bounds(month)
+            if self.engine.execute(select([Message.id]).where(
+                    (Message.id >= lo) & (Message.id < hi)).limit(1)).first():
+                months.append(month)
+            month = add_months(month, 1)
+        return months
+
+    def archive_month(self, month):
+        """Move `month`'s messages (and their likes) into the archive.
+
+        Archived messages drop out of the #tag and @mention timelines.
+        Only the messages that made it into the archive are deleted;
+        anything posted into the month meanwhile stays live until the
+        next run, which adds it to the month's archive.
+        """
+
+        lo, hi = month_bounds(month)
+        messages = Message.__table__
+        likes = Likes.__table__
+
+        liked_by = {}
+        for message_id, user_id in self.engine.execute(
+                select([likes.c.message_id, likes.c.user_id])
+                .where((likes.c.message_id >= lo) & (likes.c.message_id < hi))):
+            liked_by.setdefault(message_id, []).append(user_id)
+
+        rows = self.engine.execution_options(stream_results=True).execute(
+            select([messages])
+            .where((messages.c.id >= lo) & (messages.c.id < hi))
+            .order_by(messages.c.user_id, messages.c.id.desc()))
+        written = []
+
+        def recorded(rows):
+            for row in rows:
+                written.append(row.id)
+                yield row
+
+        count = self.archive.write_month(month, recorded(rows), liked_by)
+        batches = [written[i:i + DELETE_BATCH]
+                   for i in range(0, len(written), DELETE_BATCH)]
+
+        with self.engine.begin() as conn:
+            for table in (likes, MessageTag.__table__,
+                          MessageMention.__table__, LikeCount.__table__):
+                for ids in batches:
+                    conn.execute(table.delete().where(
+                        table.c.message_id.in_(ids)))
+
+            if month in self.partitions():
+                name = partition_name(month)
+                # Writers wait on the lock, so the partition holds exactly
+                # the archived rows plus any that arrived since the read.
+                conn.execute(text(
+                    f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE"))
+                default = table_clause('messages_default', column('id'))
+                in_default = sum(
+                    conn.execute(default.delete().where(
+                        default.c.id.in_(ids))).rowcount
+                    for ids in batches)
+                live = conn.execute(text(
+                    f"SELECT count(*) FROM {name}")).scalar()
+                if live == len(written) - in_default:
+                    conn.execute(text(
+                        f"ALTER TABLE messages DETACH PARTITION {name}"))
+                    conn.execute(text(f"DROP TABLE {name}"))
+                    return count
+
+            for ids in batches:
+                conn.execute(messages.delete().where(messages.c.id.in_(ids)))
+
+        return count
+
+
+class ArchivedMessage:
+    """A message read back from the archive.
+
+    Has the attributes templates use on `Message`.
+    """
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user', 'liked_by')
+
+    def __init__(self, record, user=None):
+        self.id = record['id']
+        self.text = record['text']
+        self.timestamp = datetime.fromisoformat(record['timestamp'])
+        self.user_id = record['user_id']
+        self.liked_by = record['likes']
+        self.user = user
+
+
+class MessageArchive:
+    """Monthly gzip files of messages, readable one author at a time."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._indexes = {}
+
+    def _paths(self, month):
+        base = os.path.join(self.directory,
+                            f"messages-{month.year:04d}-{month.month:02d}")
+        return base + '.ndjson.gz', base + '.index.json'
+
+    def months(self):
+        """Archived months, newest first."""
+
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        months = [ARCHIVE_NAME.match(name) for name in names]
+        return sorted((date(int(m[1]), int(m[2]), 1) for m in months if m),
+                      reverse=True)
+
+    def write_month(self, month, rows, liked_by):
+        """Write `rows` (ordered by author, then id descending) for `month`.
+
+        If the month is archived already, its records are kept and the
+        new rows merged in. Returns the number of rows written.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        data_path, index_path = self._paths(month)
+        archived = self._index(month)
+        # authors in the old file, popped from the end in ascending order
+        old_authors = sorted(map(int, archived), reverse=True)
+        old = open(data_path, 'rb') if archived else None
+        index = {}
+        count = 0
+
+        def read_old(author):
+            entry = archived.get(str(author))
+            if not entry:
+                return []
+            offset, length, _ = entry
+            old.seek(offset)
+            return [json.loads(line) for line in
+                    gzip.decompress(old.read(length)).splitlines()]
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+
+                def write(author, records):
+                    member = gzip.compress(b''.join(
+                        json.dumps(record).encode('utf-8') + b'\n'
+                        for record in records))
+                    index[str(author)] = [f.tell(), len(member), len(records)]
+                    f.write(member)
+
+                for author, group in groupby(rows, key=attrgetter('user_id')):
+                    while old_authors and old_authors[-1] < author:
+                        earlier = old_authors.pop()
+                        write(earlier, read_old(earlier))
+                    if old_authors and old_authors[-1] == author:
+                        old_authors.pop()
+
+                    records = [{
+                        'id': row.id,
+                        'text': row.text,
+                        'timestamp': row.timestamp.isoformat(),
+                        'user_id': row.user_id,
+                        'likes': liked_by.get(row.id, []),
+                    } for row in group]
+                    count += len(records)
+                    ids = {record['id'] for record in records}
+                    records += [record for record in read_old(author)
+                                if record['id'] not in ids]
+                    records.sort(key=itemgetter('id'), reverse=True)
+                    write(author, records)
+
+                for author in reversed(old_authors):
+                    write(author, read_old(author))
+
+            os.replace(tmp, data_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            if old is not None:
+                old.close()
+
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+        return count
+
+    def _index(self, month):
+        data_path, index_path = self._paths(month)
+        try:
+            mtime = os.path.getmtime(index_path)
+        except FileNotFoundError:
+            return {}
+
+        cached = self._indexes.get(month)
+        if cached is None or cached[0] != mtime:
+            with open(index_path) as f:
+                cached = self._indexes[month] = (mtime, json.load(f))
+        return cached[1]
+
+    def messages(self, user_id, before=None, limit=100):
+        """Up to `limit` of `user_id`'s archived records, newest first."""
+
+        return list(islice(self.records(user_id, before), limit))
+
+    def records(self, user_id, before=None):
+        """Iterate over `user_id`'s archived records, newest first.
+
+        Holds one author-month in memory at a time.
+        """
+
+        for month in self.months():
+            if before is not None and month_bounds(month)[0] >= before:
+                continue
+
+            entry = self._index(month).get(str(user_id))
+            if not entry:
+                continue
+
+            offset, length, _ = entry
+            with open(self._paths(month)[0], 'rb') as f:
+                f.seek(offset)
+                member = gzip.decompress(f.read(length))
+
+            for line in member.splitlines():
+                record = json.loads(line)
+                if before is None or record['id'] < before:
+                    yield record
+
+
+def with_archived(messages, user, before, limit):
+    """Top up a short page of `user`'s live messages from the archive."""
+
+    archive = current_app.extensions['message_archive']
+    if len(messages) >= limit:
+        return messages
+
+    if messages:
+        before = messages[-1].id
+    records = archive.messages(user.id, before, limit - len(messages))
+    return messages + [ArchivedMessage(r, user) for r in records]
+
+
+def init_app(app):
+    app.extensions['message_archive'] = MessageArchive(
+        app.config['MESSAGE_ARCHIVE_DIR']
+        or os.path.join(app.instance_path, 'message-archive'))
+
+
+def get_manager():
+    return PartitionManager(db.engine,
+                            current_app.extensions['message_archive'])
+
+
+partitions_cli = AppGroup('partitions', help="Manage message partitions.")
+
+
+def _parse_month(value):
+    try:
+        return month_of(datetime.strptime(value, '%Y-%m'))
+    except ValueError:
+        raise click.BadParameter("expected YYYY-MM")
+
+
+@partitions_cli.command('convert')
+def convert_command():
+    """Rebuild messages as a monthly-partitioned table (Postgres)."""
+
+    manager = get_manager()
+    if not manager.supported:
+        raise click.UsageError("partitioning needs PostgreSQL")
+    manager.convert(current_app.config['MESSAGE_PARTITION_MONTHS_AHEAD'])
+    click.echo(f"messages has {len(manager.partitions())} partitions.")
+
+
+@partitions_cli.command('maintain')
+def maintain_command():
+    """Create upcoming partitions and archive old months."""
+
+    config = current_app.config
+    manager = get_manager()
+    if manager.is_partitioned():
+        manager.create_future(config['MESSAGE_PARTITION_MONTHS_AHEAD'])
+
+    cutoff = archive_cutoff()
+    if cutoff is not None:
+        for month in manager.months_with_messages(before=cutoff):
+            count = manager.archive_month(month)
+            click.echo(f"Archived {count} messages from {month:%Y-%m}.")
+
+
+@partitions_cli.command('archive')
+@click.argument('month')
+def archive_command(month):
+    """Move the messages of MONTH (YYYY-MM) into the archive."""
+
+    month = _parse_month(month)
+    count = get_manager().archive_month(month)
+    click.echo(f"Archived {count} messages from {month:%Y-%m}.")
+
+
+@partitions_cli.command('list')
+def list_command():
+    """Show live partitions and archived months."""
+
+    manager = get_manager()
+    for month in manager.partitions():
+        click.echo(f"live      {month:%Y-%m}")
+    for month in sorted(manager.archive.months()):
+        click.echo(f"archived  {month:%Y-%m}")
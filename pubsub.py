@@ -0,0 +1,354 @@
+"""Publish/subscribe for pushing new messages to open feeds.
+
+`messages_add()` and bulk imports (see bulk_import.py) publish each new
+message on its author's topic. The /stream endpoint subscribes to the
+topics of everyone the viewer follows and relays events to the browser as
+Server-Sent Events.
+
+Two brokers share one interface (`subscribe(topics)`, `publish(topic,
+event)`), chosen by `PUBSUB_BROKER`:
+
+- InMemoryBroker ('memory', the default) delivers within one process.
+  That's enough for a single worker.
+- SocketBroker ('socket') links every worker on the host through a hub
+  listening on a Unix socket (`PUBSUB_SOCKET`). Run it with `flask
+  pubsub-hub`. Each worker keeps one connection to the hub and fans
+  events out to its own subscribers. If the hub is down, events are
+  delivered locally and the worker reconnects in the background.
+
+Each subscription has a bounded queue. A subscriber that falls more than
+`SSE_QUEUE_SIZE` events behind is marked overflowed rather than letting
+its queue grow without bound; its stream then tells the browser to
+reload.
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import snowflake
+from images import thumb_url
+
+
+# how long browsers wait before reconnecting a dropped stream
+RETRY_MS = 3000
+
+
+class Subscription:
+    """A subscriber's queue of (topic, event) pairs."""
+
+    def __init__(self, broker, topics, maxsize):
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, topic, event):
+        try:
+            self.queue.put_nowait((topic, event))
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """The next (topic, event), or None after `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker:
+    """Deliver events to subscribers in this process."""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._listeners = []
+
+    def add_listener(self, fn):
+        """Call fn(topic, event) for every event delivered in this process."""
+
+        self._listeners.append(fn)
+
+    def subscribe(self, topics):
+        sub = Subscription(self, topics, self.queue_size)
+        with self._lock:
+            for topic in sub.topics:
+                self._topics.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._topics.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._topics[topic]
+
+    def publish(self, topic, event):
+        with self._lock:
+            subs = list(self._topics.get(topic, ()))
+        for sub in subs:
+            sub.put(topic, event)
+        for fn in self._listeners:
+            fn(topic, event)
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len({s for subs in self._topics.values() for s in subs})
+
+
+def _encode(topic, event):
+    return json.dumps({'topic': topic, 'event': event}).encode('utf-8') + b'\n'
+
+
+class SocketBroker(InMemoryBroker):
+    """Share events between processes through a hub on a Unix socket."""
+
+    RECONNECT_SECONDS = 1
+
+    def __init__(self, path, queue_size=100):
+        super().__init__(queue_size)
+        self.path = path
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_reader(self):
+        # The reader thread doesn't survive a fork; start one per process.
+        with self._conn_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._conn = None
+        threading.Thread(target=self._read_forever, name='pubsub-reader',
+                         daemon=True).start()
+
+    def subscribe(self, topics):
+        self._ensure_reader()
+        return super().subscribe(topics)
+
+    def publish(self, topic, event):
+        self._ensure_reader()
+        with self._conn_lock:
+            conn = self._conn
+            if conn is not None:
+                try:
+                    conn.sendall(_encode(topic, event))
+                    return
+                except OSError:
+                    self._conn = None
+
+        # no hub: at least this process's subscribers hear about it
+        super().publish(topic, event)
+
+    def _read_forever(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            try:
+                conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn.connect(self.path)
+            except OSError:
+                time.sleep(self.RECONNECT_SECONDS)
+                continue
+
+            with self._conn_lock:
+                self._conn = conn
+            try:
+                for line in conn.makefile('rb'):
+                    message = json.loads(line)
+                    InMemoryBroker.publish(self, message['topic'],
+                                           message['event'])
+            except (OSError, ValueError):
+                pass
+            finally:
+                with self._conn_lock:
+                    if self._conn is conn:
+                        self._conn = None
+                conn.close()
+
+
+class _HubHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        hub = self.server
+        outbox = queue.Queue(hub.OUTBOX_SIZE)
+        with hub.lock:
+            hub.clients[self.request] = outbox
+        threading.Thread(target=self._send, args=(outbox,),
+                         daemon=True).start()
+        try:
+            for line in self.rfile:
+                hub.broadcast(line)
+        finally:
+            with hub.lock:
+                hub.clients.pop(self.request, None)
+            outbox.put(None)
+
+    def _send(self, outbox):
+        for line in iter(outbox.get, None):
+            try:
+                self.request.sendall(line)
+            except OSError:
+                return
+
+
+class PubSubHub(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Relay every line a worker sends to all connected workers."""
+
+    daemon_threads = True
+    # a worker this many events behind is disconnected (and reconnects)
+    OUTBOX_SIZE = 10000
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.clients = {}
+        self.lock = threading.Lock()
+        super().__init__(path, _HubHandler)
+
+    def broadcast(self, line):
+        with self.lock:
+            clients = list(self.clients.items())
+        for client, outbox in clients:
+            try:
+                outbox.put_nowait(line)
+            except queue.Full:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class ConnectionLimiter:
+    """Cap the number of open streams in this process, overall and per user."""
+
+    def __init__(self, max_total, max_per_user):
+        self.max_total = max_total
+        self.max_per_user = max_per_user
+        self._lock = threading.Lock()
+        self._open = {}
+
+    def acquire(self, user_id):
+        """Count a new stream for `user_id`; False if over a limit."""
+
+        with self._lock:
+            if (sum(self._open.values()) >= self.max_total
+                    or self._open.get(user_id, 0) >= self.max_per_user):
+                return False
+            self._open[user_id] = self._open.get(user_id, 0) + 1
+            return True
+
+    def release(self, user_id):
+        with self._lock:
+            self._open[user_id] -= 1
+            if not self._open[user_id]:
+                del self._open[user_id]
+
+
+def message_event(user, message_id, text):
+    """What /stream sends browsers about a new message."""
+
+    return {
+        'id': message_id,
+        'text': text,
+        'timestamp': snowflake.timestamp_of(message_id).isoformat(),
+        'user_id': user.id,
+        'username': user.username,
+        'avatar': thumb_url(user, 'avatar'),
+    }
+
+
+def sse(data=None, event=None, id=None):
+    """One Server-Sent Event; `data` is sent as JSON."""
+
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    if id is not None:
+        lines.append(f"id: {id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(sub, heartbeat, max_seconds, backlog=()):
+    """SSE text for a subscription, with heartbeats, until `max_seconds`.
+
+    Heartbeats are comments, which browsers ignore, but they keep proxies
+    from timing the connection out and make a write fail (ending the
+    stream) soon after the browser goes away. After `max_seconds` the
+    stream ends and the browser reconnects, which spreads long-lived
+    connections over workers.
+    """
+
+    yield f"retry: {RETRY_MS}\n\n"
+    for event in backlog:
+        yield sse(event, id=event['id'])
+
+    deadline = time.monotonic() + max_seconds
+    while True:
+        if sub.overflowed:
+            yield sse({}, event='reset')
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+
+        item = sub.get(timeout=min(heartbeat, remaining))
+        if item is None:
+            yield ": heartbeat\n\n"
+        else:
+            topic, event = item
+            yield sse(event, id=event['id'])
+
+
+def socket_path(app):
+    return (app.config['PUBSUB_SOCKET']
+            or os.path.join(app.instance_path, 'pubsub.sock'))
+
+
+def init_app(app):
+    queue_size = app.config['SSE_QUEUE_SIZE']
+    if app.config['PUBSUB_BROKER'] == 'socket':
+        broker = SocketBroker(socket_path(app), queue_size)
+    else:
+        broker = InMemoryBroker(queue_size)
+    app.extensions['pubsub'] = broker
+    app.extensions['sse_connections'] = ConnectionLimiter(
+        app.config['SSE_MAX_CONNECTIONS'], app.config['SSE_MAX_PER_USER'])
+
+
+def get_broker():
+    return current_app.extensions['pubsub']
+
+
+@click.command('pubsub-hub')
+@with_appcontext
+def pubsub_hub_command():
+    """Run the hub that links workers using the socket broker."""
+
+    path = socket_path(current_app)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hub = PubSubHub(path)
+    click.echo(f"Relaying events on {path}.")
+    try:
+        hub.serve_forever()
+    finally:
+        hub.server_close()
+        os.unlink(path)
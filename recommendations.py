@@ -0,0 +1,208 @@
+"""Who-to-follow suggestions from friends of friends.
+
+`flask recommendations update` loads the `follows` table into a sparse
+adjacency matrix A (A[u, v] = 1 when u follows v), so A @ A counts, for
+every pair, the people u follows who follow w. Those two-hop counts are
+the candidate scores. Users u already follows, and u themself, are
+masked out, and the best `RECOMMENDATIONS_PER_USER` are stored in the
+`recommendations` table. That table is what home.html and /users read.
+
+Rows of A @ A are computed `RECOMMENDATIONS_CHUNK_ROWS` users at a time,
+so memory stays bounded by the graph plus one chunk of products, never
+the whole n x n result.
+
+add_follow() and stop_following() record the user in `follow_changes`.
+A plain `update` recomputes only those users, whose own follows changed,
+and their followers, whose two-hop neighbourhoods did. `--full`
+recomputes everyone. Run it now and then to catch up on deleted users.
+
+Needs numpy and scipy; serving the stored suggestions does not.
+"""
+
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select
+
+from models import db, Follows, FollowChange, Recommendation, User
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+FETCH_ROWS = 100000
+
+
+def mark_changed(user_id):
+    """Note that `user_id`'s follows changed; the caller commits."""
+
+    db.session.merge(FollowChange(user_id=user_id,
+                                  changed_at=datetime.utcnow()))
+
+
+def for_user(user_id, limit):
+    """Up to `limit` suggested Users for `user_id`, best first.
+
+    Users followed since the last update are left out here rather than
+    waiting for the next one.
+    """
+
+    following = (db.session.query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id))
+    return (User
+            .query
+            .join(Recommendation, Recommendation.candidate_id == User.id)
+            .filter(Recommendation.user_id == user_id,
+                    ~User.id.in_(following))
+            .order_by(Recommendation.score.desc(), User.id)
+            .limit(limit)
+            .all())
+
+
+class FollowGraph:
+    """The follows table as a sparse matrix over users."""
+
+    def __init__(self, user_ids, adjacency):
+        self.user_ids = user_ids
+        self.adjacency = adjacency
+
+    @classmethod
+    def load(cls, engine):
+        user_ids = np.array(
+            [row[0] for row in engine.execute(
+                select([User.id]).order_by(User.id))], dtype=np.int64)
+
+        followers, followed = [], []
+        result = engine.execution_options(stream_results=True).execute(
+            select([Follows.user_following_id,
+                    Follows.user_being_followed_id]))
+        while True:
+            rows = result.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            pairs = np.array(rows, dtype=np.int64)
+            followers.append(pairs[:, 0])
+            followed.append(pairs[:, 1])
+
+        if followers:
+            followers = np.concatenate(followers)
+            followed = np.concatenate(followed)
+            # follows by or of users who signed up after `user_ids` was read
+            known = (np.isin(followers, user_ids)
+                     & np.isin(followed, user_ids))
+            rows = np.searchsorted(user_ids, followers[known])
+            cols = np.searchsorted(user_ids, followed[known])
+        else:
+            rows = cols = np.zeros(0, dtype=np.int64)
+
+        n = len(user_ids)
+        adjacency = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(n, n))
+        return cls(user_ids, adjacency)
+
+    def indices(self, user_ids):
+        """Matrix rows of the `user_ids` that exist."""
+
+        user_ids = np.fromiter(user_ids, dtype=np.int64)
+        known = user_ids[np.isin(user_ids, self.user_ids)]
+        return np.searchsorted(self.user_ids, known)
+
+    def affected_by(self, rows):
+        """`rows` plus everyone following one of them."""
+
+        if not len(rows):
+            return rows
+        followers = self.adjacency[:, rows].nonzero()[0]
+        return np.union1d(rows, followers)
+
+    def suggestions(self, rows, limit):
+        """(user id, [(candidate id, score), ...]) for each of `rows`."""
+
+        adjacency = self.adjacency
+        mine = adjacency[rows]
+        two_hop = mine @ adjacency
+
+        # mask out users already followed, and each user themself
+        itself = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32),
+             (np.arange(len(rows)), rows)), shape=two_hop.shape)
+        two_hop = two_hop - two_hop.multiply(mine) - two_hop.multiply(itself)
+        two_hop.eliminate_zeros()
+
+        for i, row in enumerate(rows):
+            lo, hi = two_hop.indptr[i], two_hop.indptr[i + 1]
+            cols = two_hop.indices[lo:hi]
+            scores = two_hop.data[lo:hi]
+            if len(cols) > limit:
+                best = np.argpartition(-scores, limit)[:limit]
+                cols, scores = cols[best], scores[best]
+            order = np.lexsort((self.user_ids[cols], -scores))
+            yield (int(self.user_ids[row]),
+                   [(int(self.user_ids[c]), float(s))
+                    for c, s in zip(cols[order], scores[order])])
+
+
+def store(engine, results):
+    """Replace the stored suggestions of the users in `results`."""
+
+    table = Recommendation.__table__
+    rows = [{'user_id': user_id, 'candidate_id': candidate, 'score': score}
+            for user_id, found in results for candidate, score in found]
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(
+            table.c.user_id.in_([user_id for user_id, _ in results])))
+        if rows:
+            conn.execute(table.insert(), rows)
+
+
+def update(engine, full=False, per_user=20, chunk_rows=2000):
+    """Recompute suggestions; return how many users were updated."""
+
+    if np is None:
+        raise RuntimeError("recommendations need numpy and scipy")
+
+    changes = FollowChange.__table__
+    changed = dict(engine.execute(
+        select([changes.c.user_id, changes.c.changed_at])).fetchall())
+
+    graph = FollowGraph.load(engine)
+    if full:
+        rows = np.arange(len(graph.user_ids))
+    else:
+        rows = graph.affected_by(graph.indices(changed))
+
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        store(engine, list(graph.suggestions(chunk, per_user)))
+
+    # Forget the changes we've handled, but not ones made meanwhile.
+    with engine.begin() as conn:
+        for user_id, changed_at in changed.items():
+            conn.execute(changes.delete().where(
+                (changes.c.user_id == user_id)
+                & (changes.c.changed_at <= changed_at)))
+
+    return len(rows)
+
+
+recommendations_cli = AppGroup('recommendations',
+                               help="Compute who-to-follow suggestions.")
+
+
+@recommendations_cli.command('update')
+@click.option('--full', is_flag=True,
+              help="Recompute everyone, not just changed users.")
+def update_command(full):
+    """Recompute suggestions for users whose graph changed."""
+
+    if np is None:
+        raise click.UsageError("recommendations need numpy and scipy")
+    config = current_app.config
+    count = update(db.engine, full, config['RECOMMENDATIONS_PER_USER'],
+                   config['RECOMMENDATIONS_CHUNK_ROWS'])
+    click.echo(f"Updated suggestions for {count} users.")
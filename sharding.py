@@ -0,0 +1,597 @@
+"""Messages (and their likes) spread over several databases by author.
+
+With `MESSAGE_SHARDS` set to a list of database URLs, messages no longer
+live in the primary database: each author's messages, and the likes on
+them, are stored on one shard. An author's shard is `user_id % N` unless
+the `shard_placements` table on the primary says otherwise, which is how
+`flask shards move-author` moves an author without renumbering everyone.
+
+Users, follows and everything else stay on the primary, so the shard
+tables carry no foreign keys to `users`.
+
+A feed spans authors on several shards: `ShardRouter.feed()` asks each of
+those shards concurrently for its newest page of matching messages and
+merges the results. Snowflake ids sort by time, so merging by id gives
+exactly the page a single database would have returned.
+"""
+
+import heapq
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import (JSON, BigInteger, Column, DateTime, ForeignKey,
+                        Index, Integer, MetaData, String, Table, create_engine,
+                        func, select)
+
+import events
+import snowflake
+from models import db, Event, Likes, Message, ShardPlacement, User
+
+metadata = MetaData()
+
+# Mirrors models.Message and models.Likes, minus the foreign keys to users.
+messages = Table(
+    'messages', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Index('ix_messages_user_id_id', 'user_id', 'id'),
+)
+
+likes = Table(
+    'likes', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('message_id', BigInteger,
+           ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True),
+    Column('created_at', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# Events about writes on this shard, committed with them and relayed to the
+# primary's `events` log by ShardRouter.relay_events(). See events.py.
+outbox = Table(
+    'event_outbox', metadata,
+    Column('id', BigInteger().with_variant(Integer, 'sqlite'),
+           primary_key=True),
+    Column('type', String(30), nullable=False),
+    Column('data', JSON, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+)
+
+
+class ShardedMessage:
+    """A message row from a shard, with its author loaded from the primary.
+
+    Has the attributes templates use on `Message`.
+    """
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    def __init__(self, row, user=None):
+        self.id = row.id
+        self.text = row.text
+        self.timestamp = row.timestamp
+        self.user_id = row.user_id
+        self.user = user
+
+
+def with_authors(rows):
+    """ShardedMessages for `rows`, loading their authors in one query."""
+
+    ids = {row.user_id for row in rows}
+    users = {u.id: u for u in User.query.filter(User.id.in_(ids))} if ids else {}
+    return [ShardedMessage(row, users.get(row.user_id)) for row in rows]
+
+
+class ShardRouter:
+    """Route message reads and writes to the shard that owns each author."""
+
+    def __init__(self, shards, primary):
+        self.shards = list(shards)
+        self.primary = primary
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        # Executor threads don't survive a fork; start a pool per process.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=len(self.shards),
+                    thread_name_prefix='shard-query')
+                self._pid = os.getpid()
+            return self._executor
+
+    def create_all(self):
+        for engine in self.shards:
+            metadata.create_all(engine)
+
+    # -- placement
+
+    def default_shard(self, user_id):
+        return user_id % len(self.shards)
+
+    def placements(self, user_ids):
+        """{user_id: shard} for each of `user_ids`."""
+
+        user_ids = set(user_ids)
+        placed = {}
+        if user_ids:
+            query = (select([ShardPlacement.user_id, ShardPlacement.shard])
+                     .where(ShardPlacement.user_id.in_(user_ids)))
+            placed = dict(self.primary.execute(query).fetchall())
+        return {uid: placed.get(uid, self.default_shard(uid))
+                for uid in user_ids}
+
+    def shard_for(self, user_id):
+        return self.placements([user_id])[user_id]
+
+    def group_by_shard(self, user_ids):
+        """{shard: [user_id, ...]} for the authors in `user_ids`."""
+
+        groups = {}
+        for uid, shard in self.placements(user_ids).items():
+            groups.setdefault(shard, []).append(uid)
+        return groups
+
+    def _scatter(self, fn, shards):
+        """{shard: fn(engine, shard)}, running on all `shards` at once."""
+
+        shards = list(shards)
+        if len(shards) == 1:
+            return {shards[0]: fn(self.shards[shards[0]], shards[0])}
+
+        pool = self._pool()
+        futures = {s: pool.submit(fn, self.shards[s], s) for s in shards}
+        return {s: f.result() for s, f in futures.items()}
+
+    # -- reads
+
+    def feed(self, user_ids, limit, before=None):
+        """Newest `limit` messages by `user_ids`, older than id `before`."""
+
+        groups = self.group_by_shard(user_ids)
+
+        def page(engine, shard):
+            query = (select([messages])
+                     .where(messages.c.user_id.in_(groups[shard]))
+                     .order_by(messages.c.id.desc())
+                     .limit(limit))
+            if before is not None:
+                query = query.where(messages.c.id < before)
+            return engine.execute(query).fetchall()
+
+        pages = self._scatter(page, groups).values()
+        merged = heapq.merge(*pages, key=lambda row: row.id, reverse=True)
+        return with_authors(list(merged)[:limit])
+
+    def latest_ids(self, user_ids):
+        """{user_id: id of their newest message} for authors with any."""
+
+        groups = self.group_by_shard(user_ids)
+
+        def latest(engine, shard):
+            query = (select([messages.c.user_id, func.max(messages.c.id)])
+                     .where(messages.c.user_id.in_(groups[shard]))
+                     .group_by(messages.c.user_id))
+            return dict(engine.execute(query).fetchall())
+
+        found = {}
+        for ids in self._scatter(latest, groups).values():
+            found.update(ids)
+        return found
+
+    def count_since(self, user_ids, since):
+        """How many messages by `user_ids` are newer than id `since`."""
+
+        groups = self.group_by_shard(user_ids)
+
+        def count(engine, shard):
+            query = (select([func.count()])
+                     .where(messages.c.user_id.in_(groups[shard])
+                            & (messages.c.id > since)))
+            return engine.execute(query).scalar()
+
+        return sum(self._scatter(count, groups).values())
+
+    def message_count(self, user_id):
+        """How many messages `user_id` has posted."""
+
+        return self.shards[self.shard_for(user_id)].execute(
+            select([func.count()]).where(messages.c.user_id == user_id)
+        ).scalar()
+
+    def like_count(self, user_id):
+        """How many messages `user_id` has liked."""
+
+        def count(engine, shard):
+            return engine.execute(select([func.count()]).select_from(likes)
+                                  .where(likes.c.user_id == user_id)).scalar()
+
+        return sum(self._scatter(count, range(len(self.shards))).values())
+
+    def _locate(self, message_id):
+        """(shard, row) of a message, or (None, None) if there's none."""
+
+        def find(engine, shard):
+            query = select([messages]).where(messages.c.id == message_id)
+            return engine.execute(query).first()
+
+        found = {s: row for s, row in
+                 self._scatter(find, range(len(self.shards))).items() if row}
+        if not found:
+            return None, None
+
+        # Mid-move, an author's messages exist on two shards; the placement
+        # says which copy is live.
+        row = next(iter(found.values()))
+        shard = self.shard_for(row.user_id)
+        return (shard, found[shard]) if shard in found else (None, None)
+
+    def existing_ids(self, message_ids):
+        """Which of `message_ids` are stored on some shard."""
+
+        def find(engine, shard):
+            query = select([messages.c.id]).where(
+                messages.c.id.in_(message_ids))
+            return [row.id for row in engine.execute(query)]
+
+        return {message_id
+                for ids in self._scatter(find, range(len(self.shards))).values()
+                for message_id in ids}
+
+    def get(self, message_id):
+        """The message with this id, or None."""
+
+        shard, row = self._locate(message_id)
+        return with_authors([row])[0] if row else None
+
+    def get_many(self, refs):
+        """Messages for (message id, author id) pairs, newest first.
+
+        Knowing the authors, only their shards are asked.
+        """
+
+        authors = {}
+        for message_id, user_id in refs:
+            authors.setdefault(user_id, []).append(message_id)
+        groups = self.group_by_shard(authors)
+
+        def fetch(engine, shard):
+            ids = [i for uid in groups[shard] for i in authors[uid]]
+            query = (select([messages])
+                     .where(messages.c.id.in_(ids)
+                            & messages.c.user_id.in_(groups[shard]))
+                     .order_by(messages.c.id.desc()))
+            return engine.execute(query).fetchall()
+
+        pages = self._scatter(fetch, groups).values()
+        return with_authors(list(heapq.merge(*pages, key=lambda row: row.id,
+                                             reverse=True)))
+
+    def liked_messages(self, user_id):
+        """Messages `user_id` has liked, newest first."""
+
+        def liked(engine, shard):
+            query = (select([messages])
+                     .select_from(messages.join(
+                         likes, likes.c.message_id == messages.c.id))
+                     .where(likes.c.user_id == user_id)
+                     .order_by(messages.c.id.desc()))
+            return engine.execute(query).fetchall()
+
+        pages = self._scatter(liked, range(len(self.shards))).values()
+        rows = heapq.merge(*pages, key=lambda row: row.id, reverse=True)
+        return with_authors(list(rows))
+
+    def liked_ids(self, user_id):
+        """Ids of the messages `user_id` has liked."""
+
+        def liked(engine, shard):
+            query = (select([likes.c.message_id])
+                     .where(likes.c.user_id == user_id))
+            return [row.message_id for row in engine.execute(query)]
+
+        return {message_id
+                for ids in self._scatter(liked, range(len(self.shards))).values()
+                for message_id in ids}
+
+    # -- writes
+
+    def add(self, user_id, text, timestamp=None):
+        """Post a message on its author's shard; return its id."""
+
+        message_id = snowflake.next_id(at=timestamp)
+        engine = self.shards[self.shard_for(user_id)]
+        with engine.begin() as conn:
+            conn.execute(messages.insert().values(
+                id=message_id, text=text, user_id=user_id,
+                timestamp=timestamp or datetime.utcnow()))
+            conn.execute(outbox.insert().values(events.event_row(
+                'message.created', message_id=message_id, user_id=user_id,
+                text=text)))
+        return message_id
+
+    def delete(self, message_id, user_id):
+        """Delete `user_id`'s message `message_id`; False if they have none."""
+
+        engine = self.shards[self.shard_for(user_id)]
+        with engine.begin() as conn:
+            deleted = conn.execute(messages.delete().where(
+                (messages.c.id == message_id)
+                & (messages.c.user_id == user_id))).rowcount
+            if deleted:
+                conn.execute(likes.delete().where(
+                    likes.c.message_id == message_id))
+                conn.execute(outbox.insert().values(events.event_row(
+                    'message.deleted', message_id=message_id,
+                    user_id=user_id)))
+        return bool(deleted)
+
+    def toggle_like(self, user_id, message_id):
+        """Like or unlike a message. True if now liked, None if no message."""
+
+        shard, row = self._locate(message_id)
+        if row is None:
+            return None
+
+        with self.shards[shard].begin() as conn:
+            unliked = conn.execute(likes.delete().where(
+                (likes.c.user_id == user_id)
+                & (likes.c.message_id == message_id))).rowcount
+            if not unliked:
+                conn.execute(likes.insert().values(
+                    user_id=user_id, message_id=message_id))
+            conn.execute(outbox.insert().values(events.event_row(
+                'like.removed' if unliked else 'like.added',
+                user_id=user_id, message_id=message_id)))
+        return not unliked
+
+    def delete_author(self, user_id):
+        """Delete a user's messages, the likes on them, and their likes.
+
+        Every shard is cleared, in case the user was mid-move. Returns
+        (ids of the deleted messages, ids of the messages they had liked).
+        """
+
+        def delete(engine, shard):
+            with engine.begin() as conn:
+                ids = [row.id for row in conn.execute(
+                    select([messages.c.id])
+                    .where(messages.c.user_id == user_id))]
+                liked = [row.message_id for row in conn.execute(
+                    select([likes.c.message_id])
+                    .where(likes.c.user_id == user_id))]
+                conn.execute(likes.delete().where(
+                    likes.c.message_id.in_(ids)
+                    | (likes.c.user_id == user_id)))
+                conn.execute(messages.delete().where(
+                    messages.c.user_id == user_id))
+            return ids, liked
+
+        deleted = self._scatter(delete, range(len(self.shards))).values()
+        return ([i for ids, _ in deleted for i in ids],
+                [i for _, liked in deleted for i in liked])
+
+    def relay_events(self, batch_size=500):
+        """Move the shards' outbox events into the primary's log.
+
+        Each batch is committed on the primary before it is cleared from
+        the shard, so a crash in between repeats events, never loses them.
+        They take the relay time as `created_at`, so consume() doesn't
+        mistake them for old events past a gap. Returns how many moved.
+        """
+
+        log = Event.__table__
+        moved = 0
+        for engine in self.shards:
+            while True:
+                rows = engine.execute(select([outbox])
+                                      .order_by(outbox.c.id)
+                                      .limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                now = datetime.utcnow()
+                with self.primary.begin() as conn:
+                    conn.execute(log.insert(), [
+                        {'type': row.type, 'data': row.data,
+                         'created_at': now} for row in rows])
+                engine.execute(outbox.delete().where(
+                    outbox.c.id.in_([row.id for row in rows])))
+                moved += len(rows)
+        return moved
+
+    # -- rebalancing
+
+    def move_author(self, user_id, dest, batch_size=1000):
+        """Move an author's messages and their likes to shard `dest`.
+
+        Messages are copied in id order, then the placement is switched so
+        new posts go to `dest`, then anything posted on the old shard in
+        the meantime is copied too. Only old rows whose copies are on
+        `dest` are deleted; a post that lands on the old shard during the
+        delete stays behind and is copied on the next pass, until a pass
+        leaves nothing. Reads keep working throughout. Returns the number
+        of messages moved.
+        """
+
+        src = self.shard_for(user_id)
+        if src == dest:
+            return 0
+        src_engine, dest_engine = self.shards[src], self.shards[dest]
+
+        last_id, copied = self._copy_messages(
+            user_id, src_engine, dest_engine, None, batch_size)
+        self._set_placement(user_id, dest)
+        last_id, more = self._copy_messages(
+            user_id, src_engine, dest_engine, last_id, batch_size)
+        self._copy_likes(user_id, src_engine, dest_engine)
+        copied += more
+
+        while self._delete_copied(user_id, src_engine, dest_engine,
+                                  batch_size):
+            # what's left on src was never copied, so copy all of it
+            _, more = self._copy_messages(
+                user_id, src_engine, dest_engine, None, batch_size)
+            self._copy_likes(user_id, src_engine, dest_engine)
+            copied += more
+
+        return copied
+
+    def _copy_messages(self, user_id, src, dest, after, batch_size):
+        copied = 0
+        while True:
+            query = (select([messages])
+                     .where(messages.c.user_id == user_id)
+                     .order_by(messages.c.id)
+                     .limit(batch_size))
+            if after is not None:
+                query = query.where(messages.c.id > after)
+            rows = [dict(row) for row in src.execute(query)]
+            if not rows:
+                return after, copied
+
+            dest.execute(messages.insert(), rows)
+            after = rows[-1]['id']
+            copied += len(rows)
+
+    def _delete_copied(self, user_id, src, dest, batch_size):
+        """Delete the author's messages on `src` that are also on `dest`.
+
+        Returns how many were left because they aren't.
+        """
+
+        left = 0
+        after = None
+        while True:
+            query = (select([messages.c.id])
+                     .where(messages.c.user_id == user_id)
+                     .order_by(messages.c.id)
+                     .limit(batch_size))
+            if after is not None:
+                query = query.where(messages.c.id > after)
+            ids = [row.id for row in src.execute(query)]
+            if not ids:
+                return left
+
+            after = ids[-1]
+            copied = [row.id for row in dest.execute(
+                select([messages.c.id]).where(messages.c.id.in_(ids)))]
+            left += len(ids) - len(copied)
+            with src.begin() as conn:
+                conn.execute(likes.delete().where(
+                    likes.c.message_id.in_(copied)))
+                conn.execute(messages.delete().where(
+                    messages.c.id.in_(copied)))
+
+    def _copy_likes(self, user_id, src, dest):
+        query = (select([likes])
+                 .select_from(likes.join(
+                     messages, likes.c.message_id == messages.c.id))
+                 .where(messages.c.user_id == user_id))
+        have = {tuple(row) for row in dest.execute(query)}
+        missing = [dict(row) for row in src.execute(query)
+                   if tuple(row) not in have]
+        if missing:
+            dest.execute(likes.insert(), missing)
+
+    def _set_placement(self, user_id, shard):
+        table = ShardPlacement.__table__
+        with self.primary.begin() as conn:
+            conn.execute(table.delete().where(table.c.user_id == user_id))
+            if shard != self.default_shard(user_id):
+                conn.execute(table.insert().values(
+                    user_id=user_id, shard=shard))
+
+    def counts(self):
+        """Number of messages on each shard."""
+
+        def count(engine, shard):
+            return engine.execute(
+                select([func.count()]).select_from(messages)).scalar()
+
+        counts = self._scatter(count, range(len(self.shards)))
+        return [counts[s] for s in range(len(self.shards))]
+
+
+def message_count(user_id):
+    """How many messages `user_id` has posted, wherever they live."""
+
+    router = get_router()
+    if router:
+        return router.message_count(user_id)
+    return Message.query.filter(Message.user_id == user_id).count()
+
+
+def like_count(user_id):
+    """How many messages `user_id` has liked, wherever they live."""
+
+    router = get_router()
+    if router:
+        return router.like_count(user_id)
+    return Likes.query.filter(Likes.user_id == user_id).count()
+
+
+def init_app(app):
+    """Route messages through a ShardRouter if `MESSAGE_SHARDS` is set."""
+
+    app.jinja_env.globals.update(message_count=message_count,
+                                 like_count=like_count)
+
+    urls = app.config['MESSAGE_SHARDS']
+    if urls:
+        app.extensions['shard_router'] = ShardRouter(
+            [create_engine(url) for url in urls], db.get_engine(app))
+
+
+def get_router():
+    """The app's ShardRouter, or None when messages aren't sharded."""
+
+    # db.get_app() falls back to the connected app outside a context, as
+    # Model.query does
+    return db.get_app().extensions.get('shard_router')
+
+
+shards_cli = AppGroup('shards', help="Manage message shards.")
+
+
+def _require_router():
+    router = get_router()
+    if router is None:
+        raise click.UsageError("MESSAGE_SHARDS is not set.")
+    return router
+
+
+@shards_cli.command('init')
+def init_shards_command():
+    """Create the message tables on every shard."""
+
+    router = _require_router()
+    router.create_all()
+    click.echo(f"Created tables on {len(router.shards)} shards.")
+
+
+@shards_cli.command('status')
+def shards_status_command():
+    """Show how many messages each shard holds."""
+
+    for shard, count in enumerate(_require_router().counts()):
+        click.echo(f"shard {shard}: {count} messages")
+
+
+@shards_cli.command('move-author')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+def move_author_command(user_id, shard):
+    """Move USER_ID's messages to SHARD."""
+
+    router = _require_router()
+    if not 0 <= shard < len(router.shards):
+        raise click.BadParameter(f"there are {len(router.shards)} shards")
+    moved = router.move_author(user_id, shard)
+    click.echo(f"Moved {moved} messages of user {user_id} to shard {shard}.")
@@ -0,0 +1,302 @@
+"""Slow-query log with captured query plans.
+
+With `SLOW_QUERY_MS` set, every SQL statement a request runs that takes
+longer than that is recorded with:
+
+- the endpoint that ran it (e.g. `warbler.users_show`),
+- the shapes of its bind parameters (names and types, not values; runs of
+  numbered parameters such as an `IN (...)` list are summarized as one
+  entry with a count), and
+- the statement's plan, captured on a background thread after the
+  request has moved on: `EXPLAIN (ANALYZE, BUFFERS)` for SELECTs on
+  PostgreSQL (plain `EXPLAIN` for writes, which ANALYZE would execute),
+  `EXPLAIN QUERY PLAN` on SQLite. Re-running a slow query is not free, so
+  a statement is explained at most once per `SLOW_QUERY_EXPLAIN_INTERVAL`
+  seconds per process, and only while a few plans are pending.
+
+Entries are JSON lines in `SLOW_QUERY_DIR` (default: the instance
+folder), rotated after `SLOW_QUERY_MAX_BYTES` with `SLOW_QUERY_BACKUPS`
+old files kept. /admin/slow-queries, open to the users named in
+`ADMIN_USERNAMES`, groups them by normalized statement, so e.g. every
+feed query shows up as one `IN (...)` row however many authors it had.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# plans waiting to be captured, per process; more slow queries than this
+# are logged without a plan
+MAX_PENDING_PLANS = 4
+MAX_STATEMENT_CHARS = 4000
+
+_WHITESPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+|\?')
+_IN_LIST = re.compile(r'\bIN \(\?(?:, \?)*\)', re.IGNORECASE)
+_NUMBERED = re.compile(r'^(\w+?)_\d+$')
+
+
+def normalize(statement):
+    """`statement` with literals and bind parameters replaced by ?."""
+
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    statement = _STRING.sub('?', statement)
+    statement = _PLACEHOLDER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    return _IN_LIST.sub('IN (...)', statement)
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def _type_name(value):
+    return 'null' if value is None else type(value).__name__
+
+
+def param_shapes(parameters):
+    """{name: type} for bind parameters, collapsing numbered runs.
+
+    {'user_id_1': 1, 'user_id_2': 2, 'param_1': 'x'} becomes
+    {'user_id_*': 'int x2', 'param_*': 'str'}. Positional parameters are
+    keyed by position.
+    """
+
+    if isinstance(parameters, dict):
+        items = parameters.items()
+    else:
+        items = ((str(i), v) for i, v in enumerate(parameters or ()))
+
+    counts = Counter()
+    for name, value in items:
+        match = _NUMBERED.match(name)
+        if match:
+            name = match.group(1) + '_*'
+        counts[name, _type_name(value)] += 1
+
+    return {name: kind if n == 1 else f"{kind} x{n}"
+            for (name, kind), n in counts.items()}
+
+
+def explain(engine, statement, parameters):
+    """The plan of `statement` on `engine`, as lines of text."""
+
+    name = engine.dialect.name
+    if name == 'postgresql':
+        if statement.lstrip()[:6].upper() == 'SELECT':
+            prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+        else:
+            prefix = 'EXPLAIN '
+    elif name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+        # ANALYZE really ran the statement; leave nothing behind
+        conn.rollback()
+    finally:
+        conn.close()
+
+    if name == 'sqlite':
+        return [row[-1] for row in rows]
+    return [row[0] for row in rows]
+
+
+class SlowQueryLog:
+    """Record slow statements to rotating JSON-lines files."""
+
+    def __init__(self, path, threshold_ms, max_bytes=10 * 1024 * 1024,
+                 backups=5, explain_interval=300):
+        self.path = path
+        self.threshold = threshold_ms / 1000
+        self.backups = backups
+        self.explain_interval = explain_interval
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8',
+            delay=True)
+        self._lock = threading.Lock()
+        self._explained = {}
+        self._pending = 0
+        self._pid = None
+        self._executor = None
+
+    def _pool(self):
+        # Executor threads don't survive a fork; start a pool per process.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='slow-query-explain')
+                self._pid = os.getpid()
+                self._pending = 0
+            return self._executor
+
+    def _should_explain(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if self._pending >= MAX_PENDING_PLANS:
+                return False
+            last = self._explained.get(key)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self._explained[key] = now
+            self._pending += 1
+            return True
+
+    def record(self, engine, statement, parameters, seconds, endpoint,
+               executemany=False):
+        """Log one slow statement, with its plan when due for one."""
+
+        normalized = normalize(statement)
+        key = fingerprint(normalized)
+        entry = {
+            'time': datetime.utcnow().isoformat(timespec='seconds'),
+            'endpoint': endpoint,
+            'ms': round(seconds * 1000, 1),
+            'fingerprint': key,
+            'normalized': normalized,
+            'statement': statement[:MAX_STATEMENT_CHARS],
+            'params': param_shapes(
+                parameters[0] if executemany and parameters else parameters),
+            'plan': None,
+        }
+
+        if executemany or not self._should_explain(key):
+            self._write(entry)
+            return None
+
+        if isinstance(parameters, dict):
+            parameters = dict(parameters)
+        elif parameters is not None:
+            parameters = tuple(parameters)
+        return self._pool().submit(self._explain_and_write, entry, engine,
+                                   statement, parameters)
+
+    def _explain_and_write(self, entry, engine, statement, parameters):
+        try:
+            entry['plan'] = explain(engine, statement, parameters)
+        except Exception as exc:
+            entry['plan_error'] = str(exc)
+        finally:
+            with self._lock:
+                self._pending -= 1
+        self._write(entry)
+
+    def _write(self, entry):
+        self._handler.handle(logging.makeLogRecord(
+            {'msg': json.dumps(entry), 'args': None}))
+
+    def files(self):
+        """Log files, oldest first."""
+
+        names = [f"{self.path}.{i}" for i in range(self.backups, 0, -1)]
+        return [n for n in names + [self.path] if os.path.exists(n)]
+
+    def entries(self):
+        for name in self.files():
+            with open(name, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def groups(self):
+        """Entries grouped by normalized statement, most total time first."""
+
+        groups = {}
+        for entry in self.entries():
+            group = groups.get(entry['fingerprint'])
+            if group is None:
+                group = groups[entry['fingerprint']] = {
+                    'fingerprint': entry['fingerprint'],
+                    'normalized': entry['normalized'],
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'endpoints': Counter(),
+                    'params': entry['params'],
+                    'plan': None,
+                    'plan_time': None,
+                    'last_seen': None,
+                }
+            group['count'] += 1
+            group['total_ms'] += entry['ms']
+            group['max_ms'] = max(group['max_ms'], entry['ms'])
+            group['endpoints'][entry['endpoint']] += 1
+            group['last_seen'] = entry['time']
+            if entry.get('plan'):
+                group['plan'] = entry['plan']
+                group['plan_time'] = entry['time']
+                group['params'] = entry['params']
+
+        return sorted(groups.values(), key=lambda g: -g['total_ms'])
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info['slow_query_start'].pop()
+    if not has_request_context():
+        return
+    log = current_app.extensions.get('slow_queries')
+    if log is not None and seconds >= log.threshold:
+        log.record(conn.engine, statement, parameters, seconds,
+                   request.endpoint or 'none', executemany)
+
+
+def _handle_error(context):
+    starts = (context.connection
+              and context.connection.info.get('slow_query_start'))
+    if starts:
+        starts.pop()
+
+
+def instrument_queries():
+    """Time every SQL statement run by any engine."""
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+def init_app(app):
+    """Log the app's slow queries, if SLOW_QUERY_MS is set."""
+
+    if app.config['SLOW_QUERY_MS'] is None:
+        return
+
+    directory = (app.config['SLOW_QUERY_DIR']
+                 or os.path.join(app.instance_path, 'slow-queries'))
+    app.extensions['slow_queries'] = SlowQueryLog(
+        os.path.join(directory, 'slow-queries.log'),
+        app.config['SLOW_QUERY_MS'],
+        app.config['SLOW_QUERY_MAX_BYTES'],
+        app.config['SLOW_QUERY_BACKUPS'],
+        app.config['SLOW_QUERY_EXPLAIN_INTERVAL'])
+    instrument_queries()
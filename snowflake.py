@@ -0,0 +1,216 @@
+"""Time-sortable, unique ids for messages ("snowflakes").
+
+A snowflake is a 63-bit integer made of
+
+    | 41 bits: ms since EPOCH | 10 bits: worker id | 12 bits: sequence |
+
+so ids sort by creation time, and two processes with different worker
+ids can never hand out the same live id. Each process can mint 2048 ids
+per millisecond before it waits for the clock to tick over.
+
+The other half of each millisecond's sequence space is kept for
+backdated ids (imported or seeded messages), so those never collide with
+live ones. Worker ids are reused by later processes, though, and a
+process can't know which backdated ids its predecessors handed out. So
+the first backdated id of each millisecond takes random worker bits and
+a random start in the lower half of the sequence, and the ones after it
+count up from there (past the end of the sequence, into the next
+millisecond, starting at 0). Ids stay in time order, and two runs
+importing into the same millisecond collide with a chance of about one
+in a million. Bulk imports retry such a row with a fresh id.
+
+A worker id is a base plus a per-process slot. Slots (0 to
+`WARBLER_WORKER_SLOTS` - 1, default 32) are leased with a lock file in
+`WARBLER_WORKER_LOCK_DIR`, so processes on one host never share one. The
+slot is re-leased after a fork, so prefork workers each get their own,
+and it is freed when the process exits.
+
+The base comes from `WARBLER_WORKER_BASE` and defaults to 0, which is
+only safe while a single host mints ids. With several hosts, give each a
+base at least WARBLER_WORKER_SLOTS apart from the others'.
+"""
+
+import atexit
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+EPOCH = datetime(2010, 1, 1)
+
+TIME_BITS = 41
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+LIVE_SEQUENCE = (1 << (SEQUENCE_BITS - 1)) - 1
+BACKDATED = 1 << (SEQUENCE_BITS - 1)
+
+# How many past milliseconds' backdated sequences to remember. Imports
+# move through time in order, so only the recent ones are ever reused.
+BACKDATED_MS_KEPT = 65536
+
+
+def _ms(dt):
+    return int((dt - EPOCH) / timedelta(milliseconds=1))
+
+
+def timestamp_of(snowflake):
+    """The (UTC) time a snowflake was minted for."""
+
+    ms = snowflake >> (WORKER_BITS + SEQUENCE_BITS)
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def lowest_id_at(dt):
+    """The smallest snowflake minted at or after `dt`, for range queries."""
+
+    return max(_ms(dt), 0) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+def lease_slot(lock_dir, slots):
+    """Lock the lowest free slot in `lock_dir`; return (slot, lock file).
+
+    The slot is ours until the lock file is closed or we exit.
+    """
+
+    os.makedirs(lock_dir, exist_ok=True)
+    for slot in range(slots):
+        f = open(os.path.join(lock_dir, f'{slot}.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            continue
+        return slot, f
+    raise RuntimeError(f"all {slots} worker slots in {lock_dir} are taken")
+
+
+# (pid, worker id, lock file) of this process's lease
+_lease = None
+_lease_lock = threading.Lock()
+
+
+def default_worker_id():
+    global _lease
+
+    with _lease_lock:
+        if _lease is not None and _lease[0] == os.getpid():
+            return _lease[1]
+
+        slots = int(os.environ.get('WARBLER_WORKER_SLOTS', 32))
+        if not 0 < slots <= MAX_WORKER + 1:
+            raise ValueError(
+                f"WARBLER_WORKER_SLOTS must be 1-{MAX_WORKER + 1}")
+        base = int(os.environ.get('WARBLER_WORKER_BASE', 0))
+        if not 0 <= base <= MAX_WORKER + 1 - slots:
+            raise ValueError(f"WARBLER_WORKER_BASE must be "
+                             f"0-{MAX_WORKER + 1 - slots}")
+
+        if fcntl is None:
+            slot, lock = os.getpid() % slots, None
+        else:
+            # A forked child inherits its parent's lock file; it leases its
+            # own slot, and leaves the parent's lock alone.
+            lock_dir = os.environ.get(
+                'WARBLER_WORKER_LOCK_DIR',
+                os.path.join(tempfile.gettempdir(), 'warbler-worker-ids'))
+            slot, lock = lease_slot(lock_dir, slots)
+            atexit.register(lock.close)
+
+        _lease = (os.getpid(), base + slot, lock)
+        return base + slot
+
+
+class SnowflakeGenerator:
+    """Mint snowflakes for one worker id."""
+
+    def __init__(self, worker_id=None):
+        self._fixed_worker_id = worker_id
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.worker_id = (self._fixed_worker_id
+                          if self._fixed_worker_id is not None
+                          else default_worker_id())
+        self.last_ms = -1
+        self.sequence = 0
+        # {ms: (worker bits, last sequence) of its backdated ids}, least
+        # recently used first
+        self.backdated = OrderedDict()
+
+    def _compose(self, ms, sequence, worker_id=None):
+        if worker_id is None:
+            worker_id = self.worker_id
+        return ((ms << (WORKER_BITS + SEQUENCE_BITS))
+                | (worker_id << SEQUENCE_BITS)
+                | sequence)
+
+    def _backdated(self, ms):
+        spilled = False
+        while True:
+            if ms in self.backdated:
+                worker_id, sequence = self.backdated.pop(ms)
+                sequence += 1
+            else:
+                worker_id = random.randint(0, MAX_WORKER)
+                # a spill-over starts at 0 to make room for the rest; a
+                # first id starts in the lower half for the same reason
+                sequence = (0 if spilled
+                            else random.randint(0, LIVE_SEQUENCE // 2))
+            self.backdated[ms] = (worker_id, min(sequence, LIVE_SEQUENCE))
+            if len(self.backdated) > BACKDATED_MS_KEPT:
+                self.backdated.popitem(last=False)
+            if sequence <= LIVE_SEQUENCE:
+                return self._compose(ms, BACKDATED | sequence, worker_id)
+            ms += 1
+            spilled = True
+
+    def next_id(self, at=None):
+        """A new snowflake for now, or for the past time `at`.
+
+        Backdated ids keep their place in time order among the others.
+        """
+
+        with self._lock:
+            if self.pid != os.getpid():
+                self._reset()
+
+            now = _ms(datetime.utcnow())
+
+            if at is not None and _ms(at) < now:
+                return self._backdated(max(_ms(at), 0))
+
+            # Never go backwards, even if the wall clock does.
+            ms = max(now, self.last_ms)
+            if ms == self.last_ms:
+                self.sequence += 1
+                if self.sequence > LIVE_SEQUENCE:
+                    while ms <= self.last_ms:
+                        time.sleep(0.0001)
+                        ms = _ms(datetime.utcnow())
+                    self.sequence = 0
+            else:
+                self.sequence = 0
+
+            self.last_ms = ms
+            return self._compose(ms, self.sequence)
+
+
+generator = SnowflakeGenerator()
+
+
+def next_id(at=None):
+    """A new snowflake from this process's generator."""
+
+    return generator.next_id(at)
@@ -0,0 +1,212 @@
+"""Social context on profiles: "followed by people you follow".
+
+Which of the viewer's followees also follow the profile being viewed is
+the intersection of two sorted id lists: who the viewer follows, and
+who follows the profile. Each list is one index range scan of `follows`,
+projecting just the id column, never loading User rows. The lists are
+intersected with a galloping search, which walks the shorter list and
+jumps through the longer one. So a viewer who follows 200 people checks
+a profile with a million followers in a couple of thousand comparisons.
+
+Lists are cached per process, by total size (`SOCIAL_CACHE_MAX_IDS`),
+for `SOCIAL_CACHE_TTL` seconds. A follow or unfollow drops the two lists
+it changes from this worker's cache; other workers catch up within the
+TTL.
+
+The /following and /followers pages are read a page at a time with
+`follow_page()`, newest follow first, keyed on (follows.created_at, id)
+so each page is one index range scan however far down it is.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select, tuple_
+
+from models import db, Follows, User
+
+FollowedBy = namedtuple('FollowedBy', 'count users')
+
+# One card on a following/followers page. `followed` is whether the viewer
+# follows them.
+FollowCard = namedtuple('FollowCard', 'id username image_url '
+                        'header_image_url bio followed_at followed')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def gallop_intersect(a, b):
+    """Ids in both sorted sequences `a` and `b`, in order."""
+
+    if len(a) > len(b):
+        a, b = b, a
+    found = []
+    n = len(b)
+    lo = 0
+    for x in a:
+        # double the step until we pass x, then binary search that span
+        step = 1
+        while lo + step < n and b[lo + step] < x:
+            step *= 2
+        i = bisect_left(b, x, lo, min(lo + step + 1, n))
+        if i < n and b[i] == x:
+            found.append(x)
+            i += 1
+        lo = i
+        if lo >= n:
+            break
+    return found
+
+
+def _following_ids(user_id):
+    return array('q', (row[0] for row in db.session.execute(
+        select([Follows.user_being_followed_id])
+        .where(Follows.user_following_id == user_id)
+        .order_by(Follows.user_being_followed_id))))
+
+
+def _follower_ids(user_id):
+    return array('q', (row[0] for row in db.session.execute(
+        select([Follows.user_following_id])
+        .where(Follows.user_being_followed_id == user_id)
+        .order_by(Follows.user_following_id))))
+
+
+class FollowIdCache:
+    """Sorted follower/following id arrays per user, LRU by total size."""
+
+    LOADERS = {'following': _following_ids, 'followers': _follower_ids}
+
+    def __init__(self, max_ids=5_000_000, ttl=60, clock=time.monotonic):
+        self.max_ids = max_ids
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, kind, user_id):
+        key = (kind, user_id)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        ids = self.LOADERS[kind](user_id)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (now, ids)
+            self._size += len(ids)
+            while self._size > self.max_ids and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+        return ids
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def invalidate(self, follower_id, followed_id):
+        """Forget the lists a follow between these two users changes."""
+
+        with self._lock:
+            self._drop(('following', follower_id))
+            self._drop(('followers', followed_id))
+
+
+def followed_by(viewer_id, user_id, sample=3):
+    """FollowedBy: how many people `viewer_id` follows also follow
+    `user_id`, and up to `sample` of them."""
+
+    cache = current_app.extensions['social_cache']
+    common = gallop_intersect(cache.get('following', viewer_id),
+                              cache.get('followers', user_id))
+    users = []
+    if common:
+        users = (User.query
+                 .filter(User.id.in_(common[:sample]))
+                 .order_by(User.id)
+                 .all())
+    return FollowedBy(len(common), users)
+
+
+def invalidate(follower_id, followed_id):
+    current_app.extensions['social_cache'].invalidate(follower_id,
+                                                      followed_id)
+
+
+def encode_cursor(followed_at, user_id):
+    micros = (followed_at - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}.{user_id}"
+
+
+def decode_cursor(cursor):
+    """(followed_at, user id) from `encode_cursor()`, or None if invalid."""
+
+    try:
+        micros, user_id = (int(part) for part in cursor.split('.'))
+    except (AttributeError, ValueError):
+        return None
+    return EPOCH + timedelta(microseconds=micros), user_id
+
+
+def follow_page(user_id, kind, viewer_id=None, before=None, limit=48):
+    """One page of `user_id`'s 'following' or 'followers', newest first.
+
+    Returns (cards, cursor): FollowCards, and the `before` value for the
+    next page (None on the last page).
+    """
+
+    users = User.__table__
+    follows = Follows.__table__
+    if kind == 'following':
+        mine, theirs = (follows.c.user_following_id,
+                        follows.c.user_being_followed_id)
+    else:
+        mine, theirs = (follows.c.user_being_followed_id,
+                        follows.c.user_following_id)
+
+    query = (select([users.c.id, users.c.username, users.c.image_url,
+                     users.c.header_image_url, users.c.bio,
+                     follows.c.created_at])
+             .select_from(follows.join(users, users.c.id == theirs))
+             .where(mine == user_id)
+             .order_by(follows.c.created_at.desc(), theirs.desc())
+             .limit(limit + 1))
+    position = decode_cursor(before) if before else None
+    if position:
+        query = query.where(tuple_(follows.c.created_at, theirs)
+                            < tuple_(*position))
+    rows = db.session.execute(query).fetchall()
+
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+    # whether the viewer follows each of them, in one query for the page
+    followed = set()
+    if viewer_id is not None and rows:
+        followed = {row[0] for row in db.session.execute(
+            select([follows.c.user_being_followed_id])
+            .where(follows.c.user_following_id == viewer_id)
+            .where(follows.c.user_being_followed_id.in_(
+                [row.id for row in rows])))}
+
+    cards = [FollowCard(row.id, row.username, row.image_url,
+                        row.header_image_url, row.bio, row.created_at,
+                        row.id in followed)
+             for row in rows]
+    return cards, cursor
+
+
+def init_app(app):
+    app.extensions['social_cache'] = FollowIdCache(
+        app.config['SOCIAL_CACHE_MAX_IDS'], app.config['SOCIAL_CACHE_TTL'])
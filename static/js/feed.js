@@ -0,0 +1,55 @@
+// Prepend warbles pushed over /stream (Server-Sent Events) to the home feed.
+(function () {
+  var list = document.getElementById('messages');
+  if (!list || !window.EventSource) return;
+
+  function el(tag, attrs, children) {
+    var node = document.createElement(tag);
+    Object.keys(attrs || {}).forEach(function (key) {
+      node.setAttribute(key, attrs[key]);
+    });
+    (children || []).forEach(function (child) {
+      node.appendChild(typeof child === 'string'
+        ? document.createTextNode(child) : child);
+    });
+    return node;
+  }
+
+  function render(msg) {
+    var date = new Date(msg.timestamp + 'Z').toLocaleDateString('en-GB', {
+      day: '2-digit', month: 'long', year: 'numeric'
+    });
+    var profile = '/users/' + msg.user_id;
+
+    return el('li', { 'class': 'list-group-item' }, [
+      el('a', { href: '/messages/' + msg.id, 'class': 'message-link' }),
+      el('a', { href: profile }, [
+        el('img', { src: msg.avatar, alt: '', 'class': 'timeline-image' })
+      ]),
+      el('div', { 'class': 'message-area' }, [
+        el('a', { href: profile }, ['@' + msg.username]),
+        el('span', { 'class': 'text-muted' }, [' ' + date]),
+        el('p', {}, [msg.text])
+      ]),
+      el('form', { method: 'POST', action: '/users/add_like/' + msg.id }, [
+        el('button', { 'class': 'btn btn-sm btn-secondary' }, [
+          el('i', { 'class': 'fa fa-thumbs-up' })
+        ])
+      ])
+    ]);
+  }
+
+  var source = new EventSource('/stream');
+
+  source.onmessage = function (event) {
+    var msg = JSON.parse(event.data);
+    if (list.querySelector('a[href="/messages/' + msg.id + '"]')) return;
+    list.insertBefore(render(msg), list.firstChild);
+  };
+
+  // we fell too far behind to catch up event by event
+  source.addEventListener('reset', function () {
+    source.close();
+    window.location.reload();
+  });
+})();
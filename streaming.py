@@ -0,0 +1,73 @@
+"""Streamed rendering for the long listing pages.
+
+With `STREAM_TEMPLATES` on, `render_listing()` renders a template as a
+generator instead of one big string: the page header goes out as soon as
+it is rendered, and list items follow in ~`STREAM_BUFFER_BYTES` chunks
+while their rows are still being fetched. Any SQLAlchemy query passed in
+the context is iterated with `yield_per()`, which on Postgres uses a
+server-side cursor, so neither the rows nor the HTML are ever held in
+memory all at once.
+
+With it off, queries are loaded with `.all()` and the page is rendered
+with the usual `render_template`.
+"""
+
+from flask import (Response, current_app, render_template,
+                   stream_with_context)
+from flask_sqlalchemy import BaseQuery
+
+# Flush the first chunk early: it's the <head> and nav, which lets the
+# browser start fetching stylesheets while we're still querying.
+FIRST_CHUNK_BYTES = 1024
+
+
+def _chunked(pieces, size):
+    """Join template output into chunks of roughly `size` bytes."""
+
+    buf = []
+    buffered = 0
+    limit = FIRST_CHUNK_BYTES
+
+    for piece in pieces:
+        buf.append(piece)
+        buffered += len(piece)
+        if buffered >= limit:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+            limit = size
+
+    if buf:
+        yield ''.join(buf)
+
+
+def stream_template(template_name, **context):
+    """Render `template_name` as a streamed response."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    pieces = template.generate(context)
+    chunks = _chunked(pieces, app.config['STREAM_BUFFER_BYTES'])
+    return Response(stream_with_context(chunks), mimetype='text/html')
+
+
+def render_listing(template_name, **context):
+    """Render a listing page, streaming it if `STREAM_TEMPLATES` is on.
+
+    Query values in `context` are fetched with a server-side cursor when
+    streaming and loaded up front otherwise.
+    """
+
+    config = current_app.config
+    streaming = config['STREAM_TEMPLATES']
+
+    for key, value in context.items():
+        if isinstance(value, BaseQuery):
+            context[key] = (value.yield_per(config['STREAM_ROW_BATCH'])
+                            if streaming else value.all())
+
+    if streaming:
+        return stream_template(template_name, **context)
+    return render_template(template_name, **context)
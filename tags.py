@@ -0,0 +1,195 @@
+"""#tags and @mentions, indexed when a message is written.
+
+Each new message's text is scanned for `#tags` and `@usernames`, and one
+row per tag goes into `message_tags` and one per mentioned user into
+`message_mentions`, in the same transaction as the message where the
+write path allows it. Both tables are keyed (tag or user, message id),
+and message ids are time-ordered snowflakes, so the /tags/<tag> and
+/mentions timelines read a page as one index range scan, newest first,
+with the last id as the cursor for the next page, and never scan
+message text.
+
+Rows carry the message's author, so with sharded messages a page is
+fetched from just the authors' shards.
+
+`flask tags backfill` indexes messages written before this existed.
+"""
+
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+
+import sharding
+from models import db, Message, MessageMention, MessageTag, User
+
+TAG = re.compile(r'(?<![\w#&])#(\w{1,50})')
+MENTION = re.compile(r'(?<![\w@])@(\w{1,50})')
+
+
+def extract(text):
+    """(tags, usernames) used in `text`, each without duplicates.
+
+    Tags are case-insensitive and stored lowercased; usernames are kept
+    as written.
+    """
+
+    tags = list(dict.fromkeys(t.lower() for t in TAG.findall(text)))
+    names = list(dict.fromkeys(MENTION.findall(text)))
+    return tags, names
+
+
+def index_messages(rows):
+    """Add index rows for messages (dicts with id, user_id and text).
+
+    Runs on the session; the caller commits.
+    """
+
+    found = [(row, *extract(row['text'])) for row in rows]
+    names = {name for _, _, names in found for name in names}
+    user_ids = {}
+    if names:
+        user_ids = dict(db.session.query(User.username, User.id)
+                        .filter(User.username.in_(names)))
+
+    tag_rows = []
+    mention_rows = []
+    for row, tags, names in found:
+        for tag in tags:
+            tag_rows.append({'tag': tag, 'message_id': row['id'],
+                             'author_id': row['user_id']})
+        for name in names:
+            if name in user_ids:
+                mention_rows.append({'user_id': user_ids[name],
+                                     'message_id': row['id'],
+                                     'author_id': row['user_id']})
+
+    if tag_rows:
+        db.session.execute(MessageTag.__table__.insert(), tag_rows)
+    if mention_rows:
+        db.session.execute(MessageMention.__table__.insert(), mention_rows)
+
+
+def index_message(message_id, user_id, text):
+    index_messages([{'id': message_id, 'user_id': user_id, 'text': text}])
+
+
+def unindex_messages(message_ids):
+    """Drop the index rows of deleted messages; the caller commits."""
+
+    for model in (MessageTag, MessageMention):
+        (model.query
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+
+def _page(query, column, before, limit):
+    if before is not None:
+        query = query.filter(column < before)
+    return query.order_by(column.desc()).limit(limit).all()
+
+
+def load_messages(refs):
+    """Messages for (message id, author id) pairs, newest first.
+
+    Messages deleted since they were indexed are left out.
+    """
+
+    if not refs:
+        return []
+    router = sharding.get_router()
+    if router:
+        return router.get_many(refs)
+    return (Message
+            .query
+            .filter(Message.id.in_([message_id for message_id, _ in refs]))
+            .order_by(Message.id.desc())
+            .all())
+
+
+def tag_page(tag, before=None, limit=100):
+    """(messages, next cursor or None) of one /tags/<tag> page."""
+
+    refs = _page(db.session.query(MessageTag.message_id, MessageTag.author_id)
+                 .filter(MessageTag.tag == tag.lower()),
+                 MessageTag.message_id, before, limit)
+    cursor = refs[-1][0] if len(refs) == limit else None
+    return load_messages(refs), cursor
+
+
+def mentions_page(user_id, before=None, limit=100):
+    """(messages, next cursor or None) of one page mentioning `user_id`."""
+
+    refs = _page(db.session.query(MessageMention.message_id,
+                                  MessageMention.author_id)
+                 .filter(MessageMention.user_id == user_id),
+                 MessageMention.message_id, before, limit)
+    cursor = refs[-1][0] if len(refs) == limit else None
+    return load_messages(refs), cursor
+
+
+def tag_count(tag):
+    return (db.session.query(func.count())
+            .filter(MessageTag.tag == tag.lower())
+            .scalar())
+
+
+def mention_count(user_id):
+    return (db.session.query(func.count())
+            .filter(MessageMention.user_id == user_id)
+            .scalar())
+
+
+##############################################################################
+# Backfill
+
+
+def _message_sources():
+    """(engine, messages table) for every database holding messages."""
+
+    router = sharding.get_router()
+    if router:
+        return [(engine, sharding.messages) for engine in router.shards]
+    return [(db.engine, Message.__table__)]
+
+
+def backfill(batch_size=1000):
+    """Rebuild the index for every message, a batch at a time.
+
+    Each batch replaces its messages' index rows in one transaction, so
+    the backfill can be re-run or interrupted safely, and live writes
+    carry on meanwhile. Returns the number of messages indexed.
+    """
+
+    total = 0
+    for engine, table in _message_sources():
+        after = None
+        while True:
+            query = (select([table.c.id, table.c.user_id, table.c.text])
+                     .order_by(table.c.id)
+                     .limit(batch_size))
+            if after is not None:
+                query = query.where(table.c.id > after)
+            rows = [dict(row) for row in engine.execute(query)]
+            if not rows:
+                break
+
+            unindex_messages([row['id'] for row in rows])
+            index_messages(rows)
+            db.session.commit()
+            after = rows[-1]['id']
+            total += len(rows)
+    return total
+
+
+tags_cli = AppGroup('tags', help="Manage the #tag and @mention index.")
+
+
+@tags_cli.command('backfill')
+@click.option('--batch-size', default=1000, show_default=True)
+def backfill_command(batch_size):
+    """Index the tags and mentions of existing messages."""
+
+    count = backfill(batch_size)
+    click.echo(f"Indexed {count} messages.")
@@ -0,0 +1,87 @@
+"""Shared on-disk bytecode cache for Jinja templates.
+
+Every new worker would otherwise compile base.html, home.html and the
+rest on first use. With `TEMPLATE_BYTECODE_CACHE` on, compiled templates
+are stored in `TEMPLATE_CACHE_DIR` (default: instance/jinja-cache) and
+shared by every worker on the host. Entries are keyed on the template's
+source hash, so workers from two deploys can run side by side without
+overwriting each other's entries. Writes are atomic, so a worker never
+reads a half-written file.
+
+`flask precompile-templates` fills the cache ahead of time (e.g. in the
+deploy step), so not even the first worker pays for compilation.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2.bccache import Bucket, FileSystemBytecodeCache, bc_magic
+
+import metrics
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache keyed on source hash, with atomic writes."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory, '%s.jinja')
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        key = hashlib.sha1(
+            bc_magic + f"{name}\0{checksum}".encode('utf-8')).hexdigest()
+
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        metrics.cache_result('templates', bucket.code is not None)
+        return bucket
+
+    def dump_bytecode(self, bucket):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp, self._get_cache_filename(bucket))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def init_app(app):
+    """Have `app` compile templates through the shared bytecode cache.
+
+    Must run before anything touches `app.jinja_env`.
+    """
+
+    if not app.config['TEMPLATE_BYTECODE_CACHE']:
+        return
+
+    directory = (app.config['TEMPLATE_CACHE_DIR']
+                 or os.path.join(app.instance_path, 'jinja-cache'))
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=SharedBytecodeCache(directory))
+
+
+def precompile_templates(app):
+    """Compile every template of `app`, filling the bytecode cache."""
+
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """Compile all templates into TEMPLATE_CACHE_DIR."""
+
+    names = precompile_templates(current_app)
+    cache = current_app.jinja_env.bytecode_cache
+    where = cache.directory if cache else 'memory (cache is off)'
+    click.echo(f"Compiled {len(names)} templates into {where}.")
@@ -0,0 +1,142 @@
+"""Profile activity analytics tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_analytics.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Follows, Likes, Message, User, UserActivity
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import analytics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# a Wednesday
+NOW = datetime(2021, 3, 10, 15, 30)
+
+
+class AnalyticsTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        UserActivity.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i in range(1, 4):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password",
+                               None)
+            user.id = i
+        db.session.commit()
+
+        # user 1 posts twice this week (Wed 09:xx, Mon 09:xx), and once
+        # in the week of Feb 18 (Tue 22:xx); plus once before the window
+        # (ids are snowflakes of the timestamps)
+        messages = [Message(text="hi", user_id=1, timestamp=at)
+                    for at in (NOW - timedelta(hours=6),
+                               NOW - timedelta(days=2, hours=6),
+                               NOW - timedelta(days=15, hours=-7),
+                               NOW - timedelta(weeks=10))]
+        messages.append(Message(text="hi", user_id=2,
+                                timestamp=NOW - timedelta(days=1)))
+        db.session.add_all(messages)
+        db.session.commit()
+
+        db.session.add_all([
+            Likes(user_id=2, message_id=messages[0].id, created_at=NOW),
+            Likes(user_id=3, message_id=messages[2].id,
+                  created_at=NOW - timedelta(days=8)),
+            # user 2 had a follower long ago, user 3 last week
+            Follows(user_following_id=1, user_being_followed_id=2,
+                    created_at=NOW - timedelta(weeks=20)),
+            Follows(user_following_id=3, user_being_followed_id=2,
+                    created_at=NOW - timedelta(days=9)),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_update(self):
+        with app.app_context():
+            count = analytics.update(db.engine, weeks=4, chunk_users=2,
+                                     now=NOW)
+            one = analytics.for_user(1)
+            two = analytics.for_user(2)
+
+        self.assertEqual(count, 3)
+        self.assertEqual(one.window_end, datetime(2021, 3, 11))
+        self.assertEqual(one.posts, [0, 1, 0, 2])
+        self.assertEqual(one.likes, [0, 0, 1, 1])
+        self.assertEqual(one.followers, [0, 0, 0, 0])
+        self.assertEqual(one.weekdays, [1, 1, 1, 0, 0, 0, 0])
+        self.assertEqual(sum(one.hours), 3)
+        self.assertEqual(one.hours[9], 2)
+        self.assertEqual(one.hours[22], 1)
+
+        self.assertEqual(two.posts, [0, 0, 0, 1])
+        self.assertEqual(two.followers, [1, 1, 2, 2])
+
+        # running again replaces the rows
+        with app.app_context():
+            analytics.update(db.engine, weeks=4, now=NOW)
+        self.assertEqual(UserActivity.query.count(), 3)
+
+    def test_profile_reads_stored_arrays(self):
+        client = app.test_client()
+        self.assertNotIn('id="activity"',
+                         client.get('/users/1').get_data(as_text=True))
+
+        with app.app_context():
+            analytics.update(db.engine, weeks=4, now=NOW)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            html = client.get('/users/1').get_data(as_text=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertIn('id="activity"', html)
+        self.assertIn('title="Mon: 1"', html)
+        # (like counts sum their counter rows, which is fine)
+        self.assertFalse([s for s in statements
+                          if 'GROUP BY' in s and 'like_counts' not in s])
+
+    def test_aggregate_skips_unknown_users(self):
+        np = analytics.np
+        at = np.datetime64(NOW - timedelta(hours=6), 's')
+        # 2 and 9 aren't in the chunk: between its users, and past the end
+        users = np.array([1, 2, 3, 9], dtype=np.int64)
+        times = np.array([at] * 4)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype='M8[s]'))
+
+        counts = analytics.aggregate(np.array([1, 3], dtype=np.int64),
+                                     (users, times), empty, (users, times),
+                                     NOW, 4)
+
+        self.assertEqual(counts['posts'].tolist(), [[0, 0, 0, 1],
+                                                    [0, 0, 0, 1]])
+        self.assertEqual(counts['followers'].tolist(), [[0, 0, 0, 1],
+                                                        [0, 0, 0, 1]])
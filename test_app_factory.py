@@ -0,0 +1,54 @@
+"""Application factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import create_app
+
+
+class AppFactoryTestCase(TestCase):
+    """Test config profiles, dev-only extensions and warm-up."""
+
+    def test_profiles(self):
+        app = create_app('testing')
+        self.assertTrue(app.config['TESTING'])
+        self.assertFalse(app.config['WTF_CSRF_ENABLED'])
+
+        app = create_app('production')
+        self.assertTrue(app.config['WARM_UP'])
+
+    def test_environ_overrides_profile(self):
+        app = create_app('development')
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'],
+                         "postgresql:///warbler-test")
+
+    def test_keyword_overrides(self):
+        app = create_app('development', STREAM_TEMPLATES=True)
+        self.assertTrue(app.config['STREAM_TEMPLATES'])
+
+    def test_debug_toolbar_dev_only(self):
+        dev = create_app('development', DEBUG=True)
+        prod = create_app('production', DEBUG=True)
+
+        self.assertIn('debugtoolbar', dev.blueprints)
+        self.assertNotIn('debugtoolbar', prod.blueprints)
+
+    def test_warm_up_compiles_templates(self):
+        cold = create_app('production', serve=True, WARM_UP=False)
+        warm = create_app('production', serve=True)
+
+        self.assertEqual(len(cold.jinja_env.cache), 0)
+        self.assertIn('base.html',
+                      [key[1] for key in warm.jinja_env.cache.keys()])
+
+    def test_warm_up_only_when_served(self):
+        # tests, scripts and the flask CLI build the app without serve=True
+        app = create_app('production')
+        self.assertEqual(len(app.jinja_env.cache), 0)
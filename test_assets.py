@@ -0,0 +1,93 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from assets import AssetManifest, build_assets, IMMUTABLE
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+
+class AssetPipelineTestCase(TestCase):
+    """Test fingerprinting, manifest lookups and serving."""
+
+    def setUp(self):
+        self.static = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static, 'images'))
+        os.makedirs(os.path.join(self.static, 'stylesheets'))
+        with open(os.path.join(self.static, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG fake')
+        with open(os.path.join(self.static, 'stylesheets', 'a.css'), 'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n' * 50)
+
+        self.manifest = build_assets(self.static)
+        self.assets = AssetManifest(self.static)
+
+    def tearDown(self):
+        shutil.rmtree(self.static)
+
+    def test_build_fingerprints(self):
+        css = self.manifest['stylesheets/a.css']
+        self.assertRegex(css, r'^stylesheets/a\.[0-9a-f]{12}\.css$')
+
+        dist = os.path.join(self.static, 'dist')
+        self.assertTrue(os.path.isfile(os.path.join(dist, css + '.gz')))
+        # images are already compressed
+        png = self.manifest['images/bg.png']
+        self.assertFalse(os.path.exists(os.path.join(dist, png + '.gz')))
+
+        with open(os.path.join(dist, css)) as f:
+            self.assertIn(f"/assets/{png}", f.read())
+
+    def test_url(self):
+        png = self.manifest['images/bg.png']
+        self.assertEqual(self.assets.url('images/bg.png'), f"/assets/{png}")
+        self.assertEqual(self.assets.url('/static/images/bg.png'),
+                         f"/assets/{png}")
+        self.assertEqual(self.assets.url('/static/missing.png'),
+                         '/static/missing.png')
+        self.assertEqual(self.assets.url('http://x.com/a.png'),
+                         'http://x.com/a.png')
+
+    def test_send_precompressed(self):
+        css = self.manifest['stylesheets/a.css']
+
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            resp = self.assets.send(css)
+            resp.direct_passthrough = False
+
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+            self.assertEqual(resp.mimetype, 'text/css')
+            self.assertIn(b'background', gzip.decompress(resp.get_data()))
+
+        with app.test_request_context():
+            resp = self.assets.send(css)
+            self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_asset_route_keeps_cache_headers(self):
+        self.addCleanup(app.extensions.__setitem__, 'assets',
+                        app.extensions['assets'])
+        app.extensions['assets'] = self.assets
+        client = app.test_client()
+
+        resp = client.get(self.assets.url('stylesheets/a.css'))
+        self.assertEqual(resp.status_code, 200)
+        # not overridden by the no-cache headers other pages get
+        self.assertEqual(resp.headers['Cache-Control'], IMMUTABLE)
+        self.assertNotIn('Pragma', resp.headers)
+        self.assertNotEqual(resp.headers['Expires'], '0')
+        self.assertTrue(resp.headers['ETag'])
+        resp.close()
+
+        self.assertEqual(client.get('/assets/nope.css').status_code, 404)
@@ -0,0 +1,224 @@
+"""Bulk message import tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_bulk_import.py
+
+
+import json
+import os
+import re
+from base64 import b64encode
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from models import db, Event, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import snowflake
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def ndjson(*items):
+    return "\n".join(i if isinstance(i, str) else json.dumps(i)
+                     for i in items) + "\n"
+
+
+class BulkImportTestCase(TestCase):
+    """Import messages through the API."""
+
+    def setUp(self):
+        db.session.rollback()
+        Event.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        self.client = app.test_client()
+
+    def post(self, body, **kwargs):
+        return self.client.post("/api/messages/import", data=body,
+                                content_type="application/x-ndjson",
+                                **kwargs)
+
+    def basic_auth(self, password="testuser"):
+        token = b64encode(f"testuser:{password}".encode()).decode()
+        return {"Authorization": f"Basic {token}"}
+
+    def test_requires_auth(self):
+        resp = self.post(ndjson({"text": "hi"}))
+        self.assertEqual(resp.status_code, 401)
+
+        resp = self.post(ndjson({"text": "hi"}),
+                         headers=self.basic_auth("wrong!"))
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_session_needs_csrf_token(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            resp = self.post(ndjson({"text": "forged"}))
+            self.assertEqual(resp.status_code, 401)
+
+            html = self.client.get("/messages/new").get_data(as_text=True)
+            token = re.search(r'name="csrf_token" type="hidden" '
+                              r'value="([^"]+)"', html).group(1)
+            resp = self.post(ndjson({"text": "mine"}),
+                             headers={"X-CSRFToken": token})
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+        self.assertEqual([m.text for m in Message.query], ["mine"])
+
+    def test_import(self):
+        resp = self.post(ndjson({"text": "one"}, {"text": "two"}),
+                         headers=self.basic_auth())
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['imported'], 2)
+        self.assertEqual(resp.json['failed'], 0)
+
+        msgs = Message.query.order_by(Message.id).all()
+        self.assertEqual([m.text for m in msgs], ["one", "two"])
+        self.assertEqual([r['id'] for r in resp.json['results']],
+                         [m.id for m in msgs])
+
+        self.assertEqual(
+            [(e.type, e.data) for e in Event.query.order_by(Event.seq)],
+            [('message.created', {'message_id': m.id,
+                                  'user_id': self.testuser_id,
+                                  'text': m.text}) for m in msgs])
+
+    def test_per_item_errors(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        resp = self.post(ndjson(
+            {"text": "fine"},
+            {"text": "x" * 141},
+            "not json",
+            "",
+            {"text": ""},
+            {"text": "old", "timestamp": "2015-03-01T12:00:00"},
+            {"text": "later", "timestamp": "2999-01-01T00:00:00"},
+        ))
+
+        results = resp.json['results']
+        self.assertEqual(resp.json['imported'], 2)
+        self.assertEqual([r['line'] for r in results], [1, 2, 3, 5, 6, 7])
+        self.assertIn('text', results[1]['errors'])
+        self.assertIn('line', results[2]['errors'])
+        self.assertIn('text', results[3]['errors'])
+        self.assertIn('timestamp', results[5]['errors'])
+
+        old = Message.query.filter_by(text="old").one()
+        self.assertEqual(old.timestamp, datetime(2015, 3, 1, 12))
+        self.assertEqual(snowflake.timestamp_of(old.id),
+                         datetime(2015, 3, 1, 12))
+
+    def test_taken_backdated_id_is_replaced(self):
+        at = datetime(2015, 3, 1, 12)
+        taken = snowflake.next_id(at=at)
+        db.session.add(Message(id=taken, text="earlier import",
+                               user_id=self.testuser_id, timestamp=at))
+        db.session.commit()
+
+        # as if a previous run had minted the same backdated id
+        with mock.patch('bulk_import.snowflake.next_id',
+                        side_effect=[taken, taken + 1]):
+            resp = self.post(ndjson({"text": "again",
+                                     "timestamp": at.isoformat()}),
+                             headers=self.basic_auth())
+
+        self.assertEqual(resp.json['imported'], 1)
+        self.assertEqual(resp.json['results'][0]['id'], taken + 1)
+        self.assertEqual(Message.query.get(taken + 1).text, "again")
+        self.assertEqual([e.data['message_id'] for e in Event.query],
+                         [taken + 1])
+
+    def test_rejects_archived_months(self):
+        app.config['MESSAGE_ARCHIVE_AFTER_MONTHS'] = 3
+        try:
+            recent = datetime.utcnow() - timedelta(days=1)
+            resp = self.post(ndjson(
+                {"text": "archived", "timestamp": "2015-03-01T12:00:00"},
+                {"text": "recent", "timestamp": recent.isoformat()},
+            ), headers=self.basic_auth())
+        finally:
+            app.config['MESSAGE_ARCHIVE_AFTER_MONTHS'] = None
+
+        self.assertEqual(resp.json['imported'], 1)
+        self.assertIn('timestamp', resp.json['results'][0]['errors'])
+        self.assertEqual([m.text for m in Message.query], ["recent"])
+
+    def test_notifies_feeds_and_trending(self):
+        sub = app.extensions['pubsub'].subscribe([self.testuser_id])
+        try:
+            with mock.patch.object(app.extensions['trending'],
+                                   'record_post') as record_post:
+                resp = self.post(ndjson(
+                    {"text": "new #news"},
+                    {"text": "old #news", "timestamp": "2015-03-01T12:00:00"},
+                ), headers=self.basic_auth())
+
+            # only the message posted now is news to anyone
+            topic, event = sub.get(0.1)
+            self.assertIsNone(sub.get(0.01))
+        finally:
+            sub.close()
+
+        self.assertEqual(topic, self.testuser_id)
+        self.assertEqual(event['id'], resp.json['results'][0]['id'])
+        self.assertEqual(event['username'], "testuser")
+        record_post.assert_called_once_with(['news'])
+
+    def test_batches_and_limit(self):
+        app.config['BULK_IMPORT_BATCH'] = 3
+        app.config['BULK_IMPORT_MAX_ITEMS'] = 5
+        try:
+            resp = self.post(ndjson(*({"text": f"m{i}"} for i in range(7))),
+                             headers=self.basic_auth())
+        finally:
+            app.config['BULK_IMPORT_BATCH'] = 500
+            app.config['BULK_IMPORT_MAX_ITEMS'] = 10000
+
+        self.assertEqual(resp.json['imported'], 5)
+        self.assertEqual(len(resp.json['results']), 6)
+        self.assertIn('line', resp.json['results'][-1]['errors'])
+        self.assertEqual(Message.query.count(), 5)
+
+    def test_form_rejects_long_message(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        self.client.post("/messages/new", data={"text": "x" * 141})
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_cli(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(
+            args=["import-messages", "testuser", "-"],
+            input=ndjson({"text": "from cli"}, {"text": "y" * 200}))
+
+        self.assertIn("Imported 1 messages, 1 failed.", result.output)
+        self.assertIn("line 2:", result.output)
+        self.assertEqual(Message.query.one().text, "from cli")
@@ -0,0 +1,77 @@
+"""Response compression middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import os
+import zlib
+from unittest import TestCase
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from compression import CompressionMiddleware
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+
+def streaming_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+    for i in range(3):
+        yield f"<li>row {i}</li>".encode()
+
+
+class CompressionMiddlewareTestCase(TestCase):
+    """Test negotiation, thresholds and streamed compression."""
+
+    def test_negotiate(self):
+        mw = CompressionMiddleware(None)
+
+        self.assertEqual(mw.negotiate('gzip, deflate'), 'gzip')
+        self.assertIsNone(mw.negotiate('gzip;q=0'))
+        self.assertIsNone(mw.negotiate(''))
+
+    def test_compresses_rendered_page(self):
+        client = app.test_client()
+        resp = client.get('/login', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(int(resp.headers['Content-Length']),
+                         len(resp.data))
+        self.assertIn(b'<form', gzip.decompress(resp.data))
+
+    def test_no_accept_encoding(self):
+        resp = app.test_client().get('/login')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'<form', resp.data)
+
+    def test_skips_small_responses(self):
+        small = Response('tiny', mimetype='text/html')
+        client = Client(CompressionMiddleware(small), Response)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, b'tiny')
+
+    def test_skips_uncompressible_types(self):
+        png = Response(b'x' * 1000, mimetype='image/png')
+        client = Client(CompressionMiddleware(png), Response)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_streamed_response(self):
+        client = Client(CompressionMiddleware(streaming_app), Response)
+        resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(zlib.decompress(resp.data, 31),
+                         b'<li>row 0</li><li>row 1</li><li>row 2</li>')
@@ -0,0 +1,130 @@
+"""Change event log tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_events.py
+
+
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import TestCase
+
+from models import (db, Event, EventCheckpoint, Follows, Likes, Message,
+                    User)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import events
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class EventLogTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        EventCheckpoint.query.delete()
+        Event.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i in (1, 2):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password",
+                               None)
+            user.id = i
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def log(self):
+        return [(e.type, e.data) for e in Event.query.order_by(Event.seq)]
+
+    def test_views_record_events(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post('/messages/new', data={'text': "hello"})
+            msg_id = Message.query.one().id
+            c.post(f'/users/add_like/{msg_id}', headers={'Referer': '/'})
+            c.post(f'/users/add_like/{msg_id}', headers={'Referer': '/'})
+            c.post('/users/follow/2')
+            c.post('/users/stop-following/2')
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'user1@test.com',
+                                           'bio': 'hi',
+                                           'password': 'password'})
+            c.post(f'/messages/{msg_id}/delete')
+            c.post('/users/delete')
+
+        self.assertEqual(self.log(), [
+            ('message.created', {'message_id': msg_id, 'user_id': 1,
+                                 'text': "hello"}),
+            ('like.added', {'user_id': 1, 'message_id': msg_id}),
+            ('like.removed', {'user_id': 1, 'message_id': msg_id}),
+            ('follow.added', {'user_id': 1, 'followed_id': 2}),
+            ('follow.removed', {'user_id': 1, 'followed_id': 2}),
+            ('user.updated', {'user_id': 1, 'username': 'renamed',
+                              'image_url': User.image_url.default.arg,
+                              'header_image_url':
+                                  User.header_image_url.default.arg,
+                              'bio': 'hi'}),
+            ('message.deleted', {'message_id': msg_id, 'user_id': 1}),
+            ('user.deleted', {'user_id': 1}),
+        ])
+        self.assertIsNone(User.query.get(1))
+
+    def test_rolled_back_with_the_write(self):
+        events.record('follow.added', user_id=1, followed_id=2)
+        db.session.rollback()
+        self.assertEqual(self.log(), [])
+
+        with self.assertRaises(ValueError):
+            events.record('follow.added', user_id=1)
+
+    def test_consumer_checkpoints(self):
+        for i in range(5):
+            events.record('user.deleted', user_id=i)
+        db.session.commit()
+
+        seen = []
+        self.assertEqual(events.consume('feed', seen.extend, batch_size=3),
+                         3)
+        self.assertEqual(events.consume('feed', seen.extend, batch_size=3),
+                         2)
+        self.assertEqual(events.consume('feed', seen.extend), 0)
+        self.assertEqual([e.data['user_id'] for e in seen], list(range(5)))
+        self.assertEqual(events.checkpoint('feed'), seen[-1].seq)
+        self.assertEqual(events.checkpoint('search'), 0)
+
+        def fail(batch):
+            raise RuntimeError("handler crashed")
+
+        with self.assertRaises(RuntimeError):
+            events.consume('search', fail)
+        db.session.rollback()
+        self.assertEqual(events.checkpoint('search'), 0)
+
+    def test_waits_at_recent_gap(self):
+        now = datetime.utcnow()
+        old = now - timedelta(minutes=1)
+        batch = [SimpleNamespace(seq=seq, created_at=at)
+                 for seq, at in ((1, old), (3, now), (4, now))]
+        cutoff = now - timedelta(seconds=5)
+
+        self.assertEqual([e.seq for e in events.settled(batch, 0, cutoff)],
+                         [1])
+        batch[1].created_at = old
+        self.assertEqual([e.seq for e in events.settled(batch, 0, cutoff)],
+                         [1, 3, 4])
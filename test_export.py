@@ -0,0 +1,148 @@
+"""Account data export tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_export.py
+
+
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from unittest import TestCase
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from export import ExportJobs, section_batches
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(TestCase):
+    """Stream and archive a user's data."""
+
+    def setUp(self):
+        db.session.rollback()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        self.u1.id, self.u2.id = 1, 2
+        db.session.commit()
+
+        for i in range(25):
+            db.session.add(Message(text=f"warble {i}", user_id=1))
+        other = Message(text="theirs", user_id=2)
+        db.session.add(other)
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.commit()
+        db.session.add(Likes(user_id=1, message_id=other.id))
+        db.session.commit()
+
+        self.tmp = tempfile.mkdtemp()
+        self.app_jobs = app.extensions['exports']
+        app.extensions['exports'] = ExportJobs(app, self.tmp)
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def tearDown(self):
+        app.extensions['exports'] = self.app_jobs
+        shutil.rmtree(self.tmp)
+        db.session.rollback()
+
+    def test_batches(self):
+        with app.app_context():
+            batches = list(section_batches(1, 'messages', batch_size=10))
+        self.assertEqual([len(b) for b in batches], [10, 10, 5])
+        self.assertEqual(batches[0][0]['text'], "warble 24")
+
+    def test_ndjson_download(self):
+        resp = self.client.get("/users/export.ndjson")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIn("attachment", resp.headers['Content-Disposition'])
+
+        records = [json.loads(line)
+                   for line in resp.get_data(as_text=True).splitlines()]
+        by_section = {}
+        for r in records:
+            by_section.setdefault(r['section'], []).append(r)
+
+        self.assertEqual(by_section['profile'][0]['username'], "u1")
+        self.assertNotIn('password', by_section['profile'][0])
+        self.assertEqual(len(by_section['messages']), 25)
+        self.assertEqual(len(by_section['likes']), 1)
+        self.assertEqual(by_section['following'][0]['username'], "u2")
+        self.assertNotIn('followers', by_section)
+
+    def test_csv_download(self):
+        resp = self.client.get("/users/export/messages.csv")
+
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[-1]['text'], "warble 0")
+
+        self.assertEqual(self.client.get("/users/export/bogus.csv")
+                         .status_code, 404)
+
+    def test_no_login(self):
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+        resp = self.client.get("/users/export.ndjson")
+        self.assertEqual(resp.status_code, 302)
+
+    def wait_for(self, location):
+        for _ in range(100):
+            resp = self.client.get(location)
+            if resp.status_code != 202:
+                return resp
+            time.sleep(0.05)
+        self.fail("export never finished")
+
+    def test_background_ndjson(self):
+        resp = self.client.post("/users/export", data={"format": "ndjson"})
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.wait_for(resp.location)
+        self.assertEqual(resp.status_code, 200)
+        lines = gzip.decompress(resp.get_data()).splitlines()
+        self.assertEqual(len(lines), 1 + 25 + 1 + 1)
+
+    def test_background_csv(self):
+        resp = self.client.post("/users/export", data={"format": "csv"})
+        resp = self.wait_for(resp.location)
+
+        with zipfile.ZipFile(io.BytesIO(resp.get_data())) as zf:
+            self.assertEqual(sorted(zf.namelist()),
+                             ['followers.csv', 'following.csv', 'likes.csv',
+                              'messages.csv', 'profile.csv'])
+            messages = zf.read('messages.csv').decode().splitlines()
+        self.assertEqual(len(messages), 26)
+
+    def test_others_exports_hidden(self):
+        resp = self.client.post("/users/export", data={"format": "ndjson"})
+        self.wait_for(resp.location)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+        self.assertEqual(self.client.get(resp.location).status_code, 404)
@@ -0,0 +1,174 @@
+"""High-water mark polling tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_highwater.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Follows, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from highwater import HighWaterMarks
+from social import FollowIdCache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeDatabase:
+    """Messages as {user_id: [ids]}, counting the queries made."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.queries = 0
+
+    def load_latest(self, user_ids):
+        self.queries += 1
+        return {uid: max(self.messages[uid]) for uid in user_ids
+                if self.messages.get(uid)}
+
+    def count_since(self, user_ids, since):
+        self.queries += 1
+        return sum(1 for uid in user_ids for i in self.messages.get(uid, [])
+                   if i > since)
+
+    def post(self, marks, user_id, message_id):
+        self.messages.setdefault(user_id, []).append(message_id)
+        marks.observe(user_id, message_id)
+
+
+class HighWaterMarksTestCase(TestCase):
+    """Count new messages from memory where possible."""
+
+    def setUp(self):
+        self.now = 0
+        self.db = FakeDatabase({1: [10, 20], 2: [15], 3: []})
+        self.marks = HighWaterMarks(self.db.load_latest, self.db.count_since,
+                                    ttl=30, recent=3,
+                                    clock=lambda: self.now)
+
+    def test_nothing_new_is_free(self):
+        self.assertEqual(self.marks.new_since([1, 2, 3], 20), (0, 20))
+        self.assertEqual(self.db.queries, 1)  # first load
+
+        for _ in range(5):
+            self.assertEqual(self.marks.new_since([1, 2, 3], 20), (0, 20))
+        self.assertEqual(self.db.queries, 1)
+
+    def test_observed_posts_counted_in_memory(self):
+        self.marks.new_since([1, 2, 3], 20)
+
+        self.db.post(self.marks, 2, 30)
+        self.db.post(self.marks, 3, 40)
+        self.assertEqual(self.marks.new_since([1, 2, 3], 20), (2, 40))
+        self.assertEqual(self.marks.new_since([1, 2], 20), (1, 30))
+        self.assertEqual(self.db.queries, 1)
+
+    def test_below_floor_asks_database(self):
+        self.marks.new_since([1], 20)
+
+        # older than what we loaded: we only know user 1's newest id
+        self.assertEqual(self.marks.new_since([1], 5), (2, 20))
+        self.assertEqual(self.db.queries, 2)
+
+    def test_recent_window_slides(self):
+        self.marks.new_since([2], 15)
+        for i in (16, 17, 18, 19):
+            self.db.post(self.marks, 2, i)
+
+        # 15 fell out of the window; 16 is now the floor
+        self.assertEqual(self.marks.new_since([2], 17), (2, 19))
+        self.assertEqual(self.db.queries, 1)
+        self.assertEqual(self.marks.new_since([2], 15), (4, 19))
+        self.assertEqual(self.db.queries, 2)
+
+    def test_ttl_catches_missed_posts(self):
+        self.marks.new_since([1], 20)
+        self.db.messages[1].append(25)  # posted by another process
+
+        self.assertEqual(self.marks.new_since([1], 20), (0, 20))
+        self.now = 31
+        self.assertEqual(self.marks.new_since([1], 20), (1, 25))
+
+
+class FeedNewViewTestCase(TestCase):
+    """The /api/feed/new endpoint."""
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.viewer = User.signup("viewer", "v@test.com", "password", None)
+        self.author = User.signup("author", "a@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.author.id,
+                               user_following_id=self.viewer.id))
+        old = Message(text="old news", user_id=self.author.id)
+        db.session.add(old)
+        db.session.commit()
+        self.old_id = old.id
+        self.viewer_id = self.viewer.id
+        self.author_id = self.author.id
+
+        app.extensions['highwater']._marks.clear()
+        app.extensions['social_cache'] = FollowIdCache()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_requires_login_and_since(self):
+        self.assertEqual(app.test_client().get("/api/feed/new?since=1")
+                         .status_code, 401)
+        self.assertEqual(self.client_for(self.viewer_id)
+                         .get("/api/feed/new").status_code, 400)
+
+    def test_counts_new_posts(self):
+        viewer = self.client_for(self.viewer_id)
+        url = f"/api/feed/new?since={self.old_id}"
+
+        self.assertEqual(viewer.get(url).json,
+                         {'count': 0, 'latest': self.old_id})
+
+        self.client_for(self.author_id).post(
+            "/messages/new", data={"text": "fresh"})
+
+        resp = viewer.get(url + "&include=messages").json
+        self.assertEqual(resp['count'], 1)
+        self.assertEqual([m['text'] for m in resp['messages']], ["fresh"])
+        self.assertEqual(resp['latest'], resp['messages'][0]['id'])
+
+    def test_poll_does_not_load_followees(self):
+        viewer = self.client_for(self.viewer_id)
+        url = f"/api/feed/new?since={self.old_id}"
+        viewer.get(url)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = viewer.get(url).json
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(resp, {'count': 0, 'latest': self.old_id})
+        self.assertFalse([s for s in statements if 'follows' in s])
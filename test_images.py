@@ -0,0 +1,234 @@
+"""Image thumbnail service tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_images.py
+
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase, mock
+
+from PIL import Image
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from images import (ImageService, thumb_url, ImageCache, ImageError,
+                    HTTPFetcher, LocalDirectoryFetcher)
+
+db.create_all()
+
+
+def png_bytes(size=(400, 300), color='red'):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class ImageServiceTestCase(TestCase):
+    """Test fetching, thumbnailing and caching images."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source')
+        os.makedirs(os.path.join(self.source, 'example.com', 'pics'))
+        with open(os.path.join(self.source, 'example.com', 'pics', 'a.png'),
+                  'wb') as f:
+            f.write(png_bytes())
+
+        self.service = ImageService(
+            cache_dir=os.path.join(self.tmp, 'cache'),
+            upload_dir=os.path.join(self.tmp, 'uploads'),
+            static_dir=app.static_folder,
+            fetcher=LocalDirectoryFetcher(self.source),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_thumbnail(self):
+        path = self.service.thumbnail('https://example.com/pics/a.png',
+                                      'avatar')
+
+        with Image.open(path) as img:
+            self.assertEqual(img.size, (96, 96))
+            self.assertEqual(img.format, 'JPEG')
+
+        # second call is served from the cache without refetching
+        self.service.fetcher = None
+        self.assertEqual(
+            self.service.thumbnail('https://example.com/pics/a.png', 'avatar'),
+            path)
+
+    def test_content_addressed(self):
+        a = self.service.thumbnail('/static/images/default-pic.png', 'card')
+        b = self.service.thumbnail('/static/images/../images/default-pic.png',
+                                   'card')
+        self.assertEqual(a, b)
+
+    def test_fetcher_stays_in_root(self):
+        with self.assertRaises(ImageError):
+            self.service.fetcher.fetch('https://example.com/../../etc/passwd')
+
+    def test_upload(self):
+        url = self.service.store_upload(png_bytes(color='blue'))
+        self.assertTrue(url.startswith('/uploads/'))
+
+        with Image.open(self.service.thumbnail(url, 'header')) as img:
+            self.assertEqual(img.size, (1200, 300))
+
+        with self.assertRaises(ImageError):
+            self.service.store_upload(b'not an image')
+
+    def test_lru_eviction(self):
+        cache = ImageCache(os.path.join(self.tmp, 'lru'), max_bytes=250)
+        old = cache.put(cache.path('old'), b'x' * 100)
+        os.utime(old, (time.time() - 60, time.time() - 60))
+        new = cache.put(cache.path('new'), b'x' * 100)
+        cache.put(cache.path('newest'), b'x' * 100)
+
+        self.assertIsNone(cache.get(old))
+        self.assertEqual(cache.get(new), new)
+
+
+class HTTPFetcherTestCase(TestCase):
+    """Test that fetches can't be steered at internal addresses."""
+
+    PUBLIC_IP = '93.184.216.34'
+
+    def setUp(self):
+        requests = self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append((self.path, self.headers['Host']))
+                if self.path == '/pic.png':
+                    self.send_response(302)
+                    self.send_header('Location', f'http://127.0.0.1:'
+                                     f'{self.server.server_port}/secret')
+                    self.end_headers()
+                else:
+                    self.send_response(200)
+                    self.end_headers()
+                    self.wfile.write(b'secret')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+        # public.test resolves to a public address, which we route to
+        # the local server
+        real_getaddrinfo = socket.getaddrinfo
+        real_connect = socket.create_connection
+        port = self.server.server_port
+
+        def getaddrinfo(host, *args, **kwargs):
+            if host == 'public.test':
+                return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                         (self.PUBLIC_IP, port))]
+            return real_getaddrinfo(host, *args, **kwargs)
+
+        def create_connection(address, *args, **kwargs):
+            if address[0] == self.PUBLIC_IP:
+                address = ('127.0.0.1', address[1])
+            return real_connect(address, *args, **kwargs)
+
+        self.patches = [
+            mock.patch('images.socket.getaddrinfo', getaddrinfo),
+            mock.patch('images.socket.create_connection', create_connection),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_refuses_loopback(self):
+        with self.assertRaises(ImageError):
+            HTTPFetcher().fetch(f'http://127.0.0.1:{self.server.server_port}/')
+        self.assertEqual(self.requests, [])
+
+    def test_refuses_redirect_to_loopback(self):
+        url = f'http://public.test:{self.server.server_port}/pic.png'
+        with self.assertRaises(ImageError):
+            HTTPFetcher().fetch(url)
+
+        # the first hop went to the vetted address, with the original Host
+        self.assertEqual(self.requests, [
+            ('/pic.png', f'public.test:{self.server.server_port}')])
+
+
+class ImageViewTestCase(TestCase):
+    """Test serving thumbnails."""
+
+    def setUp(self):
+        db.session.rollback()
+        User.query.delete()
+        self.user = User(id=500, username='pic', email='pic@test.com',
+                         password='x',
+                         image_url='/static/images/default-pic.png')
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = app.test_client()
+
+    def test_serve_thumbnail(self):
+        with app.app_context():
+            url = thumb_url(self.user, 'avatar')
+
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertNotIn('Pragma', resp.headers)
+
+        partial = self.client.get(url, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(len(partial.data), 10)
+
+    def test_stale_key_redirects(self):
+        resp = self.client.get('/users/500/images/avatar/0000000000000000')
+
+        self.assertEqual(resp.status_code, 302)
+        with app.app_context():
+            self.assertTrue(
+                resp.location.endswith(thumb_url(self.user, 'avatar')))
+
+    def test_uploads_keep_their_type(self):
+        service = app.extensions['images']
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.addCleanup(setattr, service, 'upload_dir', service.upload_dir)
+        service.upload_dir = tmp
+
+        for fmt, mimetype in (('PNG', 'image/png'), ('GIF', 'image/gif'),
+                              ('WEBP', 'image/webp'),
+                              ('JPEG', 'image/jpeg')):
+            out = io.BytesIO()
+            Image.new('RGB', (10, 10), 'red').save(out, fmt)
+            url = service.store_upload(out.getvalue())
+
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, mimetype)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertNotIn('Pragma', resp.headers)
+
+    def test_unknown_variant(self):
+        resp = self.client.get('/users/500/images/huge/whatever')
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,119 @@
+"""Influence score tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_influence.py
+
+
+import os
+from unittest import TestCase
+
+import numpy as np
+from scipy import sparse
+
+from models import db, Follows, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import influence
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def dense_pagerank(edges, n, damping=0.85):
+    """PageRank by solving the linear system directly."""
+
+    transition = np.zeros((n, n))
+    for follower, followed in edges:
+        transition[followed, follower] = 1
+    out = transition.sum(axis=0)
+    transition[:, out == 0] = 1
+    transition /= transition.sum(axis=0)
+    system = np.eye(n) - damping * transition
+    return np.linalg.solve(system, np.full(n, (1 - damping) / n))
+
+
+class PageRankTestCase(TestCase):
+
+    edges = [(0, 1), (1, 2), (2, 0), (3, 2), (4, 2), (4, 0)]
+
+    def adjacency(self, n=6):
+        rows, cols = zip(*self.edges)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32),
+                                  (rows, cols)), shape=(n, n))
+
+    def test_matches_direct_solution(self):
+        # user 5 follows nobody
+        rank, deltas = influence.pagerank(self.adjacency(), tolerance=1e-10,
+                                          max_iterations=500)
+
+        self.assertLess(deltas[-1], 1e-10)
+        self.assertAlmostEqual(rank.sum(), 1)
+        np.testing.assert_allclose(rank, dense_pagerank(self.edges, 6),
+                                   atol=1e-8)
+
+    def test_warm_start(self):
+        cold, cold_deltas = influence.pagerank(self.adjacency())
+        warm, warm_deltas = influence.pagerank(self.adjacency(),
+                                               start=cold * 6)
+
+        self.assertLess(len(warm_deltas), len(cold_deltas))
+        np.testing.assert_allclose(warm, cold, atol=1e-6)
+
+    def test_empty(self):
+        rank, deltas = influence.pagerank(sparse.csr_matrix((0, 0)))
+        self.assertEqual(len(rank), 0)
+
+
+class InfluenceUpdateTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i, name in enumerate(['ann', 'annie', 'bob', 'joanna'], 1):
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = i
+        # everyone follows joanna; ann follows annie
+        for follower, followed in ((1, 4), (2, 4), (3, 4), (1, 2)):
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def scores(self):
+        return {user.username: user.influence
+                for user in User.query.order_by(User.id)}
+
+    def test_update_and_listing(self):
+        deltas = influence.update(db.engine)
+        scores = self.scores()
+
+        self.assertAlmostEqual(sum(scores.values()), 4)
+        self.assertGreater(scores['joanna'], scores['annie'])
+        self.assertGreater(scores['annie'], scores['bob'])
+
+        # warm restart converges straight away
+        self.assertEqual(len(influence.update(db.engine)), 1)
+        self.assertGreater(len(deltas), 1)
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertLess(html.index('@joanna'), html.index('@annie'))
+        self.assertLess(html.index('@annie'), html.index('@ann<'))
+
+        # exact match, then prefix, then by influence
+        html = self.client.get('/users?q=ann').get_data(as_text=True)
+        self.assertLess(html.index('@ann<'), html.index('@annie'))
+        self.assertLess(html.index('@annie'), html.index('@joanna'))
@@ -0,0 +1,179 @@
+"""Message like count tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_counts.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Follows, LikeCount, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from like_counts import LikeCounter, recount
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeCountTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        LikeCount.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i in (1, 2, 3):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password",
+                               None)
+            user.id = i
+        db.session.add(Message(id=77, text="likeable", user_id=1))
+        db.session.add(Message(id=78, text="ignored", user_id=1))
+        db.session.add(Follows(user_following_id=2,
+                               user_being_followed_id=1))
+        db.session.commit()
+
+        self.saved = app.extensions['like_counts']
+        self.counter = LikeCounter(app, shards=4)
+        # no background thread; the tests flush by hand
+        self.counter._pid = os.getpid()
+        app.extensions['like_counts'] = self.counter
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions['like_counts'] = self.saved
+        db.session.rollback()
+
+    def like(self, user_id, message_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post(f'/users/add_like/{message_id}', headers={'Referer': '/'})
+
+    def get(self, user_id, path):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return c.get(path).get_data(as_text=True)
+
+    def test_many_users_like_one_message(self):
+        for user_id in (1, 2, 3):
+            self.like(user_id, 77)
+        self.like(3, 77)
+
+        self.assertEqual(Likes.query.filter_by(message_id=77).count(), 2)
+        with app.app_context():
+            # counted before the flush, from this worker's pending deltas
+            self.assertEqual(self.counter.counts([77, 78]), {77: 2})
+            self.counter.flush(db.engine)
+            self.assertEqual(self.counter.counts([77, 78]), {77: 2})
+
+    def test_shown_on_pages(self):
+        self.like(2, 77)
+        self.like(3, 77)
+        with app.app_context():
+            self.counter.flush(db.engine)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            pages = [self.get(2, '/'), self.get(2, '/users/1')]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        for html in pages:
+            self.assertIn('<span class="like-count">2</span>', html)
+            self.assertEqual(html.count('class="like-count"'), 1)
+        # (the profile's count of the user's own likes is fine)
+        self.assertFalse([s for s in statements if 'count(' in s.lower()
+                          and 'likes' in s and 'likes.user_id' not in s])
+
+        html = self.get(2, '/messages/77')
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 2', html)
+
+    def test_flush_spreads_over_shards(self):
+        with app.app_context():
+            for _ in range(40):
+                self.counter.record(77, True)
+                self.counter.flush(db.engine)
+            self.counter.record(77, False)
+            self.counter.flush(db.engine)
+
+            self.assertEqual(self.counter.counts([77]), {77: 39})
+        rows = LikeCount.query.filter_by(message_id=77).all()
+        self.assertGreater(len(rows), 1)
+        self.assertLessEqual(len(rows), 4)
+
+    def test_failed_flush_keeps_counts(self):
+        self.counter.record(77, True)
+
+        class Broken:
+            def begin(self):
+                raise RuntimeError("database went away")
+
+        with self.assertRaises(RuntimeError):
+            self.counter.flush(Broken())
+        self.assertEqual(self.counter.pending(), {77: 1})
+
+    def test_counted_while_flushing(self):
+        self.counter.record(77, True)
+        seen = []
+        counter = self.counter
+
+        class Watched:
+            def begin(self):
+                # in the flush, before it commits
+                seen.append(counter.counts([77]))
+                return db.engine.begin()
+
+        with app.app_context():
+            self.counter.flush(Watched())
+            self.assertEqual(seen, [{77: 1}])
+            self.assertEqual(self.counter.pending(), {})
+            self.assertEqual(self.counter.counts([77]), {77: 1})
+
+    def test_deleted_message_stays_uncounted(self):
+        self.like(2, 77)
+        # another worker's unflushed like of the same message
+        other = LikeCounter(app, shards=4)
+        other._pid = os.getpid()
+        other.record(77, True)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post('/messages/77/delete')
+
+        self.assertEqual(self.counter.pending(), {})
+        with app.app_context():
+            other.flush(db.engine)
+        self.assertEqual(LikeCount.query.filter_by(message_id=77).count(), 0)
+        self.assertEqual(other.pending(), {})
+
+    def test_recount(self):
+        db.session.add_all([Likes(user_id=2, message_id=77),
+                            Likes(user_id=3, message_id=77),
+                            Likes(user_id=3, message_id=78),
+                            LikeCount(message_id=77, shard=3, count=9)])
+        db.session.commit()
+
+        with app.app_context():
+            self.assertEqual(recount(db.engine), 2)
+            self.assertEqual(self.counter.counts([77, 78]), {77: 2, 78: 1})
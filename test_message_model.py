@@ -6,8 +6,10 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
+import snowflake
 from models import db, User, Message, Follows, Likes
 from flask_bcrypt import Bcrypt
 
@@ -88,4 +90,26 @@ class MessageModelTestCase(TestCase):
 
 
         self.assertEqual(len(usr.likes), 1)
-        self.assertIn('abcd', [l.text for l in usr.likes])
\ No newline at end of file
+        self.assertIn('abcd', [l.text for l in usr.likes])
+
+    def test_message_ids_sort_by_time(self):
+        first = Message(text='first', user_id=self.user_id)
+        db.session.add(first)
+        db.session.commit()
+        second = Message(text='second', user_id=self.user_id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreaterEqual(second.timestamp, first.timestamp)
+        self.assertNotEqual(first.timestamp, second.timestamp)
+
+    def test_backdated_message_id(self):
+        old = Message(text='old', user_id=self.user_id,
+                      timestamp=datetime(2017, 1, 21, 11, 4, 53))
+        new = Message(text='new', user_id=self.user_id)
+        db.session.add_all([new, old])
+        db.session.commit()
+
+        self.assertLess(old.id, new.id)
+        self.assertEqual(snowflake.timestamp_of(old.id).year, 2017)
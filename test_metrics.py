@@ -0,0 +1,150 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_metrics.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def sample(text, line_start):
+    """The value of the first line of `text` starting with `line_start`."""
+
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+class MetricsFormatTestCase(TestCase):
+    """Merging and rendering snapshots."""
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        registry.inc('warbler_http_responses_total', endpoint='a', status='200')
+        registry.observe('warbler_http_request_duration_seconds', 0.02,
+                         endpoint='a', method='GET')
+        registry.observe('warbler_http_request_duration_seconds', 20,
+                         endpoint='a', method='GET')
+
+        text = metrics.exposition(*metrics.merge([registry.snapshot()]))
+
+        self.assertIn("# TYPE warbler_http_responses_total counter", text)
+        self.assertEqual(sample(text, 'warbler_http_responses_total'
+                                      '{endpoint="a",status="200"}'), 1)
+        labels = 'endpoint="a",method="GET"'
+        name = 'warbler_http_request_duration_seconds'
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="0.01"}}'),
+                         0)
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="0.025"}}'),
+                         1)
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="10"}}'), 1)
+        self.assertEqual(sample(text, f'{name}_bucket{{{labels},le="+Inf"}}'),
+                         2)
+        self.assertEqual(sample(text, f'{name}_count{{{labels}}}'), 2)
+        self.assertAlmostEqual(sample(text, f'{name}_sum{{{labels}}}'), 20.02)
+
+    def test_merge_drops_gauges_of_exited_processes(self):
+        def snapshot(pid):
+            registry = metrics.Registry()
+            registry.pid = pid
+            registry.inc('warbler_db_queries_total', 3, endpoint='x')
+            registry.inc('warbler_http_requests_in_flight', 2)
+            return registry.snapshot()
+
+        # a pid far above pid_max never belongs to a running process
+        values, _ = metrics.merge([snapshot(os.getpid()),
+                                   snapshot(2 ** 31 - 1)])
+
+        self.assertEqual(
+            values[('warbler_db_queries_total', (('endpoint', 'x'),))], 6)
+        self.assertEqual(values[('warbler_http_requests_in_flight', ())], 2)
+
+
+class MetricsEndpointTestCase(TestCase):
+    """/metrics on the app."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        self.dir = tempfile.mkdtemp()
+        self.saved = app.extensions.pop('metrics_dir', None)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions.pop('metrics_dir', None)
+        if self.saved is not None:
+            app.extensions['metrics_dir'] = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_counts_requests_and_queries(self):
+        before = self.client.get('/metrics').get_data(as_text=True)
+        self.client.get('/login')
+        self.client.get('/users')
+        after = self.client.get('/metrics').get_data(as_text=True)
+
+        def delta(line_start):
+            return (sample(after, line_start) or 0) - (
+                sample(before, line_start) or 0)
+
+        self.assertEqual(delta('warbler_http_responses_total'
+                               '{endpoint="warbler.login",status="200"}'), 1)
+        self.assertGreater(delta('warbler_db_queries_total'
+                                 '{endpoint="warbler.list_users"}'), 0)
+        # the scrape itself is still in flight
+        self.assertEqual(sample(after, 'warbler_http_requests_in_flight'), 1)
+
+    def test_bcrypt(self):
+        before = metrics.merge([metrics.registry().snapshot()])[1]
+        User.signup('metrics', 'metrics@test.com', 'password', None)
+        after = metrics.merge([metrics.registry().snapshot()])[1]
+
+        key = ('warbler_bcrypt_duration_seconds', ())
+        self.assertEqual(after[key][2] - before.get(key, [0, 0, 0])[2], 1)
+
+    def test_metrics_dir(self):
+        app.extensions['metrics_dir'] = metrics.MetricsDirectory(self.dir)
+
+        # another worker's numbers
+        other = metrics.Registry()
+        other.pid = 2 ** 31 - 1
+        other.inc('warbler_cache_requests_total', 5, cache='images',
+                  result='hit')
+        with open(os.path.join(self.dir, f'{other.pid}.json'), 'w') as f:
+            metrics.json.dump(other.snapshot(), f)
+
+        own = metrics.registry().values.get(
+            ('warbler_cache_requests_total',
+             (('cache', 'images'), ('result', 'hit'))), 0)
+        text = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertEqual(sample(text, 'warbler_cache_requests_total'
+                                      '{cache="images",result="hit"}'),
+                         own + 5)
+        self.assertIn(f'{os.getpid()}.json', os.listdir(self.dir))
+
+    def test_disabled(self):
+        app.config['METRICS_ENABLED'] = False
+        try:
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+        finally:
+            app.config['METRICS_ENABLED'] = True
@@ -0,0 +1,162 @@
+"""Message partitioning and archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_partitions.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import date, datetime
+from unittest import TestCase
+
+from models import db, LikeCount, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from partitions import (MessageArchive, PartitionManager, add_months,
+                        month_bounds)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PartitionTestCase(TestCase):
+    """Archive old months and read them back."""
+
+    def setUp(self):
+        db.session.rollback()
+        LikeCount.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.tmp = tempfile.mkdtemp()
+        self.archive = MessageArchive(self.tmp)
+        self.app_archive = app.extensions['message_archive']
+        app.extensions['message_archive'] = self.archive
+        self.manager = PartitionManager(db.engine, self.archive)
+
+        self.u1 = User.signup("u1", "u1@test.com", "password", None)
+        self.u2 = User.signup("u2", "u2@test.com", "password", None)
+        self.u1.id, self.u2.id = 1, 2
+        db.session.commit()
+
+        # two messages each in Jan and Feb 2020, one each in June
+        for month, day in ((1, 5), (1, 20), (2, 5), (2, 20), (6, 1)):
+            for u in (self.u1, self.u2):
+                db.session.add(Message(
+                    text=f"{u.username} {month}/{day}", user_id=u.id,
+                    timestamp=datetime(2020, month, day)))
+        db.session.commit()
+
+        self.liked = (Message.query
+                      .filter_by(text="u2 1/20").one().id)
+        db.session.add(Likes(user_id=1, message_id=self.liked))
+        db.session.commit()
+
+    def tearDown(self):
+        app.extensions['message_archive'] = self.app_archive
+        shutil.rmtree(self.tmp)
+        db.session.rollback()
+
+    def test_add_months(self):
+        self.assertEqual(add_months(date(2020, 11, 1), 3), date(2021, 2, 1))
+        self.assertEqual(add_months(date(2020, 1, 1), -1), date(2019, 12, 1))
+
+        lo, hi = month_bounds(date(2020, 1, 1))
+        jan = Message.query.filter(Message.id >= lo, Message.id < hi)
+        self.assertEqual(jan.count(), 4)
+
+    def test_archive_month(self):
+        months = self.manager.months_with_messages(before=date(2020, 6, 1))
+        self.assertEqual(months, [date(2020, 1, 1), date(2020, 2, 1)])
+
+        self.assertEqual(self.manager.archive_month(date(2020, 1, 1)), 4)
+
+        self.assertEqual(Message.query.count(), 6)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.archive.months(), [date(2020, 1, 1)])
+
+        # the file as a whole is still plain gzipped NDJSON
+        path = os.path.join(self.tmp, "messages-2020-01.ndjson.gz")
+        with gzip.open(path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+        records = self.archive.messages(2)
+        self.assertEqual([r['text'] for r in records], ["u2 1/20", "u2 1/5"])
+        self.assertEqual(records[0]['likes'], [1])
+
+    def test_archive_month_again_merges(self):
+        self.manager.archive_month(date(2020, 1, 1))
+
+        # a backdated post lands in the archived month
+        db.session.add(Message(text="u1 1/10", user_id=1,
+                               timestamp=datetime(2020, 1, 10)))
+        db.session.commit()
+        self.assertEqual(self.manager.months_with_messages(
+            before=date(2020, 2, 1)), [date(2020, 1, 1)])
+        self.assertEqual(self.manager.archive_month(date(2020, 1, 1)), 1)
+
+        self.assertEqual([r['text'] for r in self.archive.messages(1)],
+                         ["u1 1/20", "u1 1/10", "u1 1/5"])
+        records = self.archive.messages(2)
+        self.assertEqual([r['text'] for r in records], ["u2 1/20", "u2 1/5"])
+        self.assertEqual(records[0]['likes'], [1])
+
+        path = os.path.join(self.tmp, "messages-2020-01.ndjson.gz")
+        with gzip.open(path) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+    def test_archive_keeps_late_rows(self):
+        db.session.add(LikeCount(message_id=self.liked, shard=0, count=1))
+        db.session.commit()
+        write_month = self.archive.write_month
+
+        def write_then_post(*args):
+            count = write_month(*args)
+            # posted into the month after it was read
+            db.session.add(Message(text="u1 1/25", user_id=1,
+                                   timestamp=datetime(2020, 1, 25)))
+            db.session.commit()
+            return count
+
+        self.archive.write_month = write_then_post
+        self.assertEqual(self.manager.archive_month(date(2020, 1, 1)), 4)
+
+        lo, hi = month_bounds(date(2020, 1, 1))
+        live = Message.query.filter(Message.id >= lo, Message.id < hi)
+        self.assertEqual([m.text for m in live], ["u1 1/25"])
+        self.assertEqual(LikeCount.query.count(), 0)
+
+    def test_archive_before_and_limit(self):
+        self.manager.archive_month(date(2020, 1, 1))
+        self.manager.archive_month(date(2020, 2, 1))
+
+        records = self.archive.messages(1, limit=3)
+        self.assertEqual([r['text'] for r in records],
+                         ["u1 2/20", "u1 2/5", "u1 1/20"])
+
+        older = self.archive.messages(1, before=records[1]['id'])
+        self.assertEqual([r['text'] for r in older], ["u1 1/20", "u1 1/5"])
+
+    def test_profile_deep_scroll(self):
+        self.manager.archive_month(date(2020, 1, 1))
+        self.manager.archive_month(date(2020, 2, 1))
+
+        with app.test_client() as c:
+            resp = c.get("/users/1")
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        for text in ("u1 6/1", "u1 2/20", "u1 1/5"):
+            self.assertIn(text, html)
+        self.assertNotIn("u2 1/5", html)
@@ -0,0 +1,205 @@
+"""Pub/sub and live feed stream tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_pubsub.py
+
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, Follows, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from pubsub import (ConnectionLimiter, InMemoryBroker, PubSubHub,
+                    SocketBroker, event_stream)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def events(chunks):
+    """Decode SSE `data:` payloads from a list of stream chunks."""
+
+    chunks = [c.decode() if isinstance(c, bytes) else c for c in chunks]
+    return [json.loads(line[len("data: "):])
+            for chunk in chunks for line in chunk.splitlines()
+            if line.startswith("data: ")]
+
+
+class BrokerTestCase(TestCase):
+    """Brokers and stream plumbing, without the app."""
+
+    def test_in_memory(self):
+        broker = InMemoryBroker()
+        sub = broker.subscribe([1, 2])
+
+        broker.publish(1, {'id': 1})
+        broker.publish(3, {'id': 3})
+        self.assertEqual(sub.get(0.1), (1, {'id': 1}))
+        self.assertIsNone(sub.get(0.01))
+
+        sub.close()
+        self.assertEqual(broker.subscriber_count, 0)
+
+    def test_overflow(self):
+        broker = InMemoryBroker(queue_size=2)
+        sub = broker.subscribe([1])
+        for i in range(3):
+            broker.publish(1, {'id': i})
+
+        self.assertTrue(sub.overflowed)
+        chunks = list(event_stream(sub, heartbeat=0.01, max_seconds=1))
+        self.assertIn("event: reset", chunks[-1])
+
+    def test_heartbeat_and_deadline(self):
+        broker = InMemoryBroker()
+        sub = broker.subscribe([1])
+
+        chunks = list(event_stream(sub, heartbeat=0.02, max_seconds=0.1,
+                                   backlog=[{'id': 5}]))
+
+        self.assertTrue(chunks[0].startswith("retry:"))
+        self.assertEqual(events(chunks), [{'id': 5}])
+        self.assertIn(": heartbeat\n\n", chunks)
+
+    def test_connection_limits(self):
+        limiter = ConnectionLimiter(max_total=3, max_per_user=2)
+
+        self.assertTrue(limiter.acquire(1))
+        self.assertTrue(limiter.acquire(1))
+        self.assertFalse(limiter.acquire(1))
+        self.assertTrue(limiter.acquire(2))
+        self.assertFalse(limiter.acquire(3))
+
+        limiter.release(1)
+        self.assertTrue(limiter.acquire(3))
+
+    def test_socket_broker(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, "pubsub.sock")
+        hub = PubSubHub(path)
+        threading.Thread(target=hub.serve_forever, daemon=True).start()
+        try:
+            one, two = SocketBroker(path), SocketBroker(path)
+            sub = two.subscribe([7])
+            one.subscribe([])
+
+            # wait for both workers to reach the hub
+            for _ in range(100):
+                if len(hub.clients) == 2:
+                    break
+                time.sleep(0.05)
+
+            one.publish(7, {'id': 70})
+            self.assertEqual(sub.get(2), (7, {'id': 70}))
+        finally:
+            hub.shutdown()
+            hub.server_close()
+            shutil.rmtree(tmp)
+
+    def test_socket_broker_without_hub(self):
+        broker = SocketBroker("/nonexistent/pubsub.sock")
+        sub = broker.subscribe([1])
+        broker.publish(1, {'id': 1})
+        self.assertEqual(sub.get(0.1), (1, {'id': 1}))
+
+
+class StreamViewTestCase(TestCase):
+    """The /stream endpoint and publishing from messages_add."""
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.viewer = User.signup("viewer", "v@test.com", "password", None)
+        self.author = User.signup("author", "a@test.com", "password", None)
+        self.stranger = User.signup("stranger", "s@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.author.id,
+                               user_following_id=self.viewer.id))
+        db.session.commit()
+        self.viewer_id = self.viewer.id
+        self.author_id = self.author.id
+        self.stranger_id = self.stranger.id
+
+        app.config['SSE_MAX_SECONDS'] = 0.5
+        app.config['SSE_HEARTBEAT_SECONDS'] = 0.05
+
+    def tearDown(self):
+        app.config['SSE_MAX_SECONDS'] = 300
+        app.config['SSE_HEARTBEAT_SECONDS'] = 15
+        db.session.rollback()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def test_requires_login(self):
+        self.assertEqual(app.test_client().get("/stream").status_code, 401)
+
+    def test_pushes_followed_posts(self):
+        resp = self.client_for(self.viewer_id).get("/stream", buffered=False)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        chunks = iter(resp.response)
+        next(chunks)  # retry: line; we are subscribed from here on
+
+        self.client_for(self.stranger_id).post(
+            "/messages/new", data={"text": "not for you"})
+        self.client_for(self.author_id).post(
+            "/messages/new", data={"text": "hello followers"})
+
+        received = events(list(chunks))
+        resp.close()
+
+        self.assertEqual([e['text'] for e in received], ["hello followers"])
+        self.assertEqual(received[0]['username'], "author")
+        self.assertEqual(received[0]['id'],
+                         Message.query.filter_by(user_id=self.author_id)
+                         .one().id)
+
+    def test_last_event_id_backlog(self):
+        first = Message(text="seen", user_id=self.author_id)
+        db.session.add(first)
+        db.session.commit()
+        first_id = first.id
+        db.session.add(Message(text="missed", user_id=self.author_id))
+        db.session.commit()
+
+        resp = self.client_for(self.viewer_id).get(
+            "/stream", headers={"Last-Event-ID": str(first_id)})
+        self.assertEqual([e['text'] for e in events([resp.get_data(True)])],
+                         ["missed"])
+
+    def test_connection_limit(self):
+        app.config['SSE_MAX_PER_USER'] = 1
+        connections = app.extensions['sse_connections']
+        connections.max_per_user = 1
+        try:
+            client = self.client_for(self.viewer_id)
+            first = client.get("/stream", buffered=False)
+            second = client.get("/stream", buffered=False)
+            self.assertEqual(second.status_code, 503)
+
+            first.close()
+            third = client.get("/stream", buffered=False)
+            self.assertEqual(third.status_code, 200)
+            third.close()
+        finally:
+            connections.max_per_user = 3
@@ -0,0 +1,156 @@
+"""Who-to-follow tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, Follows, FollowChange, Message, Recommendation,
+                    User)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationsTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        Recommendation.query.delete()
+        FollowChange.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i in range(1, 7):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password",
+                               None)
+            user.id = i
+        db.session.commit()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def follow(self, *pairs):
+        for follower, followed in pairs:
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+    def suggested(self, user_id):
+        return [(r.candidate_id, r.score) for r in
+                Recommendation.query.filter_by(user_id=user_id)
+                .order_by(Recommendation.score.desc(),
+                          Recommendation.candidate_id)]
+
+    def test_two_hop_scores(self):
+        # 1 follows 2 and 3; both follow 4, 2 also follows 1 and 5
+        self.follow((1, 2), (1, 3), (2, 4), (3, 4), (2, 5), (2, 1),
+                    (3, 2))
+
+        count = recommendations.update(db.engine, full=True, per_user=5,
+                                       chunk_rows=2)
+
+        self.assertEqual(count, 6)
+        # 2 is followed already and 1 is user 1 themself
+        self.assertEqual(self.suggested(1), [(4, 2.0), (5, 1.0)])
+        self.assertEqual(self.suggested(3), [(1, 1.0), (5, 1.0)])
+        self.assertEqual(self.suggested(4), [])
+
+    def test_top_n(self):
+        self.follow((1, 2), (2, 3), (2, 4), (2, 5), (2, 6))
+
+        recommendations.update(db.engine, full=True, per_user=2)
+
+        self.assertEqual(self.suggested(1), [(3, 1.0), (4, 1.0)])
+
+    def test_load_skips_new_users(self):
+        self.follow((1, 2))
+        test = self
+
+        class SignupMeanwhile:
+            """Someone signs up and follows right after users are read."""
+
+            def execute(self, query):
+                result = db.engine.execute(query)
+                if not test.follows_added:
+                    rows = result.fetchall()
+                    test.follows_added = True
+                    user = User.signup("user7", "user7@test.com",
+                                       "password", None)
+                    user.id = 7
+                    db.session.commit()
+                    test.follow((7, 1), (1, 7))
+                    return rows
+                return result
+
+            def execution_options(self, **options):
+                return self
+
+        self.follows_added = False
+        graph = recommendations.FollowGraph.load(SignupMeanwhile())
+
+        self.assertEqual(list(graph.user_ids), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(graph.adjacency.nnz, 1)
+        self.assertEqual(graph.adjacency[0, 1], 1)
+
+    def test_incremental(self):
+        self.follow((1, 2), (5, 1))
+        recommendations.update(db.engine, full=True)
+        self.assertEqual(self.suggested(5), [(2, 1.0)])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post('/users/follow/3')
+        self.assertEqual(FollowChange.query.count(), 1)
+        # a stale row for someone unaffected stays untouched
+        db.session.add(Recommendation(user_id=6, candidate_id=4, score=9))
+        db.session.commit()
+
+        count = recommendations.update(db.engine)
+
+        # 1 changed, and 5 follows 1
+        self.assertEqual(count, 2)
+        self.assertEqual(self.suggested(5), [(2, 1.0), (3, 1.0)])
+        self.assertEqual(self.suggested(6), [(4, 9.0)])
+        self.assertEqual(FollowChange.query.count(), 0)
+
+    def test_shown_on_home_and_users(self):
+        db.session.add(Recommendation(user_id=1, candidate_id=4, score=1))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            home = c.get('/').get_data(as_text=True)
+            users = c.get('/users').get_data(as_text=True)
+
+        for html in (home, users):
+            self.assertIn('Who to follow', html)
+            self.assertIn('action="/users/follow/4"', html)
+
+    def test_followed_since_update_not_shown(self):
+        db.session.add_all([
+            Recommendation(user_id=1, candidate_id=3, score=2),
+            Recommendation(user_id=1, candidate_id=4, score=1)])
+        db.session.commit()
+
+        self.follow((1, 3))
+
+        self.assertEqual([u.id for u in recommendations.for_user(1, 5)],
+                         [4])
@@ -0,0 +1,274 @@
+"""Message sharding tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_sharding.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, select
+
+from models import db, Event, Message, User, ShardPlacement
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import bulk_import
+import events
+import snowflake
+from sharding import ShardRouter, likes, messages, outbox
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ShardRouterTestCase(TestCase):
+    """Route messages over three local SQLite shards."""
+
+    def setUp(self):
+        db.session.rollback()
+        Event.query.delete()
+        ShardPlacement.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = []
+        for i in range(1, 5):
+            u = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+            u.id = i
+            self.users.append(u)
+        db.session.commit()
+
+        self.tmp = tempfile.mkdtemp()
+        self.router = ShardRouter(
+            [create_engine(f"sqlite:///{self.tmp}/shard{i}.db")
+             for i in range(3)],
+            db.engine)
+        self.router.create_all()
+
+    def tearDown(self):
+        app.extensions.pop('shard_router', None)
+        for engine in self.router.shards:
+            engine.dispose()
+        shutil.rmtree(self.tmp)
+        db.session.rollback()
+
+    def post_all(self):
+        """Ten messages per user, interleaved in time; return their ids."""
+
+        start = datetime(2020, 1, 1)
+        ids = []
+        for n in range(10):
+            for uid in (1, 2, 3, 4):
+                ids.append(self.router.add(
+                    uid, f"{uid}/{n}",
+                    timestamp=start + timedelta(minutes=10 * n + uid)))
+        return ids
+
+    def shard_rows(self, shard, table=messages):
+        return self.router.shards[shard].execute(select([table])).fetchall()
+
+    def test_default_placement(self):
+        self.router.add(1, "one")
+        self.router.add(3, "three")
+
+        self.assertEqual([r.user_id for r in self.shard_rows(1)], [1])
+        self.assertEqual([r.user_id for r in self.shard_rows(0)], [3])
+        self.assertEqual(self.router.counts(), [1, 1, 0])
+
+    def test_feed_merges_shards(self):
+        ids = self.post_all()
+
+        feed = self.router.feed([1, 2, 3], limit=12)
+        expected = sorted((i for i, uid in zip(ids, [1, 2, 3, 4] * 10)
+                           if uid != 4), reverse=True)[:12]
+
+        self.assertEqual([m.id for m in feed], expected)
+        self.assertEqual(feed[0].user.username, "user3")
+        self.assertEqual(feed[0].text, "3/9")
+
+    def test_get_many(self):
+        ids = self.post_all()
+        authors = [1, 2, 3, 4] * 10
+        refs = [(ids[i], authors[i]) for i in (0, 5, 14, 39)]
+
+        found = self.router.get_many(refs + [(12345, 2)])
+
+        self.assertEqual([m.id for m in found],
+                         sorted((i for i, _ in refs), reverse=True))
+        self.assertEqual(found[0].user.username, "user4")
+
+    def test_feed_before(self):
+        self.post_all()
+
+        first = self.router.feed([1, 2, 4], limit=5)
+        second = self.router.feed([1, 2, 4], limit=5, before=first[-1].id)
+
+        self.assertEqual(len(second), 5)
+        self.assertLess(second[0].id, first[-1].id)
+        everything = self.router.feed([1, 2, 4], limit=10)
+        self.assertEqual([m.id for m in first + second],
+                         [m.id for m in everything])
+
+    def test_likes(self):
+        msg_id = self.router.add(2, "likeable")
+
+        self.assertTrue(self.router.toggle_like(1, msg_id))
+        self.assertEqual(self.router.liked_ids(1), {msg_id})
+        self.assertEqual([m.id for m in self.router.liked_messages(1)],
+                         [msg_id])
+
+        self.assertFalse(self.router.toggle_like(1, msg_id))
+        self.assertEqual(self.router.liked_ids(1), set())
+        self.assertIsNone(self.router.toggle_like(1, 12345))
+
+    def test_delete(self):
+        msg_id = self.router.add(2, "doomed")
+        self.router.toggle_like(1, msg_id)
+
+        self.assertFalse(self.router.delete(msg_id, 1))
+        self.assertTrue(self.router.delete(msg_id, 2))
+        self.assertIsNone(self.router.get(msg_id))
+        self.assertEqual(self.shard_rows(2, likes), [])
+
+    def test_move_author(self):
+        ids = self.post_all()
+        liked = ids[1]  # by user 2
+        self.router.toggle_like(3, liked)
+
+        moved = self.router.move_author(2, 0, batch_size=3)
+
+        self.assertEqual(moved, 10)
+        self.assertEqual(self.router.shard_for(2), 0)
+        self.assertEqual(ShardPlacement.query.get(2).shard, 0)
+        self.assertFalse([r for r in self.shard_rows(2) if r.user_id == 2])
+        self.assertEqual(self.router.counts(), [20, 20, 0])
+        self.assertEqual(self.router.liked_ids(3), {liked})
+        self.assertEqual(len(self.router.feed([2], limit=100)), 10)
+
+        # moving back to the default shard drops the override
+        self.router.move_author(2, 2)
+        self.assertIsNone(ShardPlacement.query.get(2))
+        self.assertEqual(self.router.counts(), [10, 20, 10])
+
+    def test_move_author_keeps_late_posts(self):
+        ids = self.post_all()
+        src = self.router.shards[2]
+        copy_likes = self.router._copy_likes
+        late = []
+
+        def post_late(user_id, *args):
+            # a writer that looked up the placement before the switch
+            # commits on the old shard after the last copy pass; one post
+            # is backdated below ids already copied
+            if not late:
+                for at in (datetime(2020, 1, 1), datetime(2021, 1, 1)):
+                    late.append(snowflake.next_id(at=at))
+                    src.execute(messages.insert().values(
+                        id=late[-1], text="late", user_id=2, timestamp=at))
+            copy_likes(user_id, *args)
+
+        self.router._copy_likes = post_late
+        moved = self.router.move_author(2, 0, batch_size=3)
+
+        self.assertEqual(moved, 12)
+        self.assertFalse([r for r in self.shard_rows(2) if r.user_id == 2])
+        self.assertEqual({m.id for m in self.router.feed([2], limit=100)},
+                         set(ids[1::4]) | set(late))
+
+    def test_views(self):
+        app.extensions['shard_router'] = self.router
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.post("/messages/new", data={"text": "sharded hello"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Message.query.count(), 0)
+
+            [row] = self.shard_rows(1)
+            self.assertEqual(row.text, "sharded hello")
+
+            resp = c.get("/")
+            self.assertIn("sharded hello", resp.get_data(as_text=True))
+
+            resp = c.get(f"/messages/{row.id}")
+            self.assertIn("sharded hello", resp.get_data(as_text=True))
+
+            c.post(f"/users/add_like/{row.id}",
+                   headers={"Referer": "/"})
+            self.assertEqual(self.router.liked_ids(1), {row.id})
+
+            c.post(f"/messages/{row.id}/delete")
+            self.assertEqual(self.shard_rows(1), [])
+
+        # the events wait in the shard's outbox until relayed
+        self.assertEqual(Event.query.count(), 0)
+        self.assertEqual(len(self.shard_rows(1, outbox)), 3)
+
+        seen = []
+        with app.app_context():
+            events.consume('feed', seen.extend)
+            log = [(e.type, e.data) for e in seen]
+        self.assertEqual(log, [
+            ('message.created', {'message_id': row.id, 'user_id': 1,
+                                 'text': "sharded hello"}),
+            ('like.added', {'user_id': 1, 'message_id': row.id}),
+            ('message.deleted', {'message_id': row.id, 'user_id': 1}),
+        ])
+        self.assertEqual(self.shard_rows(1, outbox), [])
+
+    def test_bulk_import_logs_to_outbox(self):
+        app.extensions['shard_router'] = self.router
+        with app.test_request_context():
+            results = bulk_import.import_messages(
+                1, ['{"text": "one"}', '{"text": "two"}'])
+        ids = [r['id'] for r in results]
+
+        self.assertEqual(sorted(row.id for row in self.shard_rows(1)), ids)
+        self.assertEqual(Event.query.count(), 0)
+        self.assertEqual(
+            [row.data['message_id'] for row in self.shard_rows(1, outbox)],
+            ids)
+
+    def test_profile_counts_and_delete_user(self):
+        app.extensions['shard_router'] = self.router
+        mine = [self.router.add(2, f"mine {i}") for i in range(3)]
+        theirs = self.router.add(1, "theirs")
+        self.router.toggle_like(2, theirs)
+        self.router.toggle_like(1, mine[0])
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            html = c.get("/users/2").get_data(as_text=True)
+            self.assertIn('<a href="/users/2">3</a>', html)
+            self.assertIn('<a href="/users/2/likes">1</a>', html)
+
+            c.post("/users/delete")
+
+        self.assertIsNone(User.query.get(2))
+        self.assertEqual(self.router.message_count(2), 0)
+        self.assertEqual(self.router.like_count(1), 0)
+        self.assertEqual(self.router.like_count(2), 0)
+        self.assertEqual([m.id for m in self.router.feed([1, 2], limit=10)],
+                         [theirs])
+
+    def test_failed_write_logs_nothing(self):
+        msg_id = self.router.add(2, "one")
+        with self.assertRaises(Exception):
+            self.router.add(2, None)
+        self.assertEqual(self.router.relay_events(batch_size=1), 1)
+        self.assertEqual([e.data['message_id'] for e in Event.query],
+                         [msg_id])
@@ -0,0 +1,138 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_slow_queries.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from slow_queries import (SlowQueryLog, instrument_queries, normalize,
+                          param_shapes)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class NormalizeTestCase(TestCase):
+    """Statement fingerprints and parameter shapes."""
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT * FROM messages\n  WHERE user_id IN "
+                      "(%(user_id_1)s, %(user_id_2)s) AND id < 10 LIMIT 100"),
+            "SELECT * FROM messages WHERE user_id IN (...) AND id < ? "
+            "LIMIT ?")
+        self.assertEqual(
+            normalize("SELECT id FROM users WHERE username LIKE 'a%' "
+                      "AND id = :id_1::integer"),
+            "SELECT id FROM users WHERE username LIKE ? AND id = ?::integer")
+        self.assertEqual(normalize("SELECT a FROM t WHERE b IN (?, ?, ?)"),
+                         normalize("SELECT a FROM t WHERE b IN (?)"))
+
+    def test_param_shapes(self):
+        self.assertEqual(
+            param_shapes({'user_id_1': 1, 'user_id_2': 2, 'param_1': 'x',
+                          'before': None}),
+            {'user_id_*': 'int x2', 'param_*': 'str', 'before': 'null'})
+        self.assertEqual(param_shapes((1, 'a')), {'0': 'int', '1': 'str'})
+        self.assertEqual(param_shapes(None), {})
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Recording, rotation and the admin view."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        admin = User.signup('admin', 'admin@test.com', 'password', None)
+        user = User.signup('someone', 'someone@test.com', 'password', None)
+        db.session.commit()
+        self.admin_id = admin.id
+        self.user_id = user.id
+
+        self.dir = tempfile.mkdtemp()
+        self.log = SlowQueryLog(os.path.join(self.dir, 'slow.log'),
+                                threshold_ms=0)
+        app.extensions['slow_queries'] = self.log
+        instrument_queries()
+        app.config['ADMIN_USERNAMES'] = ['admin']
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions.pop('slow_queries', None)
+        app.config['ADMIN_USERNAMES'] = []
+        shutil.rmtree(self.dir)
+
+    def wait_for_plans(self):
+        # one explain thread: once this runs, earlier plans are written
+        self.log._pool().submit(lambda: None).result()
+
+    def test_records_request_queries(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.get('/users?q=some')
+        self.wait_for_plans()
+
+        groups = self.log.groups()
+        search = [g for g in groups if 'LIKE' in g['normalized']]
+        self.assertEqual(len(search), 1)
+        self.assertIn('warbler.list_users', search[0]['endpoints'])
+        self.assertIn('str', search[0]['params'].values())
+        self.assertTrue(search[0]['plan'])
+        self.assertNotIn('some', search[0]['normalized'])
+
+    def test_explains_once_per_interval(self):
+        for _ in range(3):
+            self.client.get('/users?q=x')
+        self.wait_for_plans()
+
+        entries = [e for e in self.log.entries() if 'LIKE' in e['normalized']]
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(sum(1 for e in entries if e['plan']), 1)
+
+    def test_rotation(self):
+        log = SlowQueryLog(os.path.join(self.dir, 'small.log'),
+                           threshold_ms=0, max_bytes=2000, backups=2)
+        for i in range(50):
+            log.record(db.engine, f"UPDATE t SET a = {i}", None, 0.5, 'x',
+                       executemany=True)
+
+        self.assertEqual(len(log.files()), 3)
+        groups = log.groups()
+        self.assertEqual(len(groups), 1)
+        self.assertLess(groups[0]['count'], 50)
+
+    def test_admin_view(self):
+        self.client.get('/users?q=x')
+        self.wait_for_plans()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get('/admin/slow-queries')
+            self.assertEqual(resp.status_code, 302)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+            resp = c.get('/admin/slow-queries')
+            html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('LIKE', html)
+        self.assertIn('warbler.list_users', html)
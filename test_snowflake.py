@@ -0,0 +1,128 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import snowflake
+from snowflake import (SnowflakeGenerator, timestamp_of, lowest_id_at,
+                       lease_slot, MAX_WORKER)
+
+
+class SnowflakeTestCase(TestCase):
+    """Test id generation."""
+
+    def test_monotonic_and_unique(self):
+        gen = SnowflakeGenerator(worker_id=7)
+        ids = [gen.next_id() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_workers_never_collide(self):
+        a = SnowflakeGenerator(worker_id=1)
+        b = SnowflakeGenerator(worker_id=2)
+        ids = [a.next_id() for _ in range(1000)] + \
+              [b.next_id() for _ in range(1000)]
+
+        self.assertEqual(len(set(ids)), 2000)
+
+    def test_timestamp_roundtrip(self):
+        before = datetime.utcnow()
+        snowflake = SnowflakeGenerator(worker_id=MAX_WORKER).next_id()
+        after = datetime.utcnow()
+
+        self.assertLessEqual(timestamp_of(snowflake), after)
+        self.assertGreaterEqual(timestamp_of(snowflake),
+                                before - timedelta(milliseconds=1))
+
+    def test_backdated(self):
+        gen = SnowflakeGenerator(worker_id=3)
+        at = datetime(2017, 5, 1, 12, 0, 0)
+        ids = [gen.next_id(at=at) for _ in range(100)]
+
+        self.assertEqual(len(set(ids)), 100)
+        self.assertTrue(all(timestamp_of(i) == at for i in ids))
+        self.assertLess(max(ids), gen.next_id())
+        self.assertGreaterEqual(min(ids), lowest_id_at(at))
+
+    def test_many_backdated_for_one_ms(self):
+        gen = SnowflakeGenerator(worker_id=3)
+        at = datetime(2017, 5, 1, 12, 0, 0)
+        ids = [gen.next_id(at=at) for _ in range(5000)]
+
+        self.assertEqual(len(set(ids)), 5000)
+        self.assertEqual(ids, sorted(ids))
+        # the overflow spills into the following milliseconds
+        self.assertEqual(timestamp_of(ids[0]), at)
+        self.assertLessEqual(timestamp_of(ids[-1]),
+                             at + timedelta(milliseconds=3))
+
+    def test_backdated_differ_across_restarts(self):
+        # the same worker id, in two lifetimes of a process
+        at = datetime(2020, 1, 1, 12)
+        first = [SnowflakeGenerator(worker_id=3).next_id(at=at)
+                 for _ in range(20)]
+        again = [SnowflakeGenerator(worker_id=3).next_id(at=at)
+                 for _ in range(20)]
+
+        self.assertEqual(len(set(first) | set(again)), 40)
+        self.assertTrue(all(timestamp_of(i) == at for i in first + again))
+
+    def test_worker_slots_are_leased(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+
+        first, first_lock = lease_slot(lock_dir, 4)
+        second, second_lock = lease_slot(lock_dir, 4)
+        self.assertEqual((first, second), (0, 1))
+
+        first_lock.close()
+        again, again_lock = lease_slot(lock_dir, 4)
+        self.assertEqual(again, 0)
+        second_lock.close()
+        again_lock.close()
+
+    def test_forked_workers_get_their_own_ids(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        env = {'WARBLER_WORKER_BASE': '64',
+               'WARBLER_WORKER_LOCK_DIR': lock_dir}
+        saved = {key: os.environ.get(key) for key in env}
+        os.environ.update(env)
+
+        def restore():
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+        self.addCleanup(restore)
+        # forget this process's lease, taken with the default settings
+        self.addCleanup(setattr, snowflake, '_lease', snowflake._lease)
+        snowflake._lease = None
+
+        gen = SnowflakeGenerator()
+        gen.next_id()
+        parent = gen.worker_id
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            gen.next_id()
+            os.write(write, str(gen.worker_id).encode())
+            os._exit(0)
+        os.waitpid(pid, 0)
+        child = int(os.read(read, 16))
+        os.close(read)
+        os.close(write)
+
+        self.assertTrue(64 <= parent < 96)
+        self.assertTrue(64 <= child < 96)
+        self.assertNotEqual(parent, child)
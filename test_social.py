@@ -0,0 +1,189 @@
+"""Social context and follow list tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_social.py
+
+
+import os
+import random
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Follows, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from social import FollowIdCache, follow_page, gallop_intersect
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class GallopTestCase(TestCase):
+
+    def test_matches_set_intersection(self):
+        rng = random.Random(45)
+        for _ in range(200):
+            a = sorted(rng.sample(range(1000), rng.randint(0, 30)))
+            b = sorted(rng.sample(range(1000), rng.randint(0, 600)))
+            expected = sorted(set(a) & set(b))
+            self.assertEqual(gallop_intersect(a, b), expected)
+            self.assertEqual(gallop_intersect(b, a), expected)
+
+
+class SocialContextTestCase(TestCase):
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i in range(1, 6):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password",
+                               None)
+            user.id = i
+        # 1 follows 2, 3 and 4; 2 and 3 follow 5
+        for follower, followed in ((1, 2), (1, 3), (1, 4), (2, 5), (3, 5)):
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+        self.client = app.test_client()
+        app.extensions['social_cache'] = FollowIdCache()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def view(self, path):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            return c.get(path).get_data(as_text=True)
+
+    def test_profile_pages(self):
+        for path in ('/users/5', '/users/5/followers', '/users/5/following'):
+            html = self.view(path)
+            self.assertIn('id="followed-by"', html)
+            self.assertIn('@user2</a>,', html)
+            self.assertIn('@user3</a>', html)
+
+        self.assertNotIn('id="followed-by"', self.view('/users/1'))
+        self.assertNotIn('id="followed-by"', self.view('/users/4'))
+
+    def test_follow_invalidates(self):
+        self.assertNotIn('@user4</a>', self.view('/users/5'))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 4
+            c.post('/users/follow/5')
+
+        self.assertIn('@user4</a>', self.view('/users/5'))
+
+    def test_cache_bounded_by_size(self):
+        clock = [0]
+        cache = FollowIdCache(max_ids=3, ttl=10, clock=lambda: clock[0])
+        with app.app_context():
+            self.assertEqual(list(cache.get('following', 1)), [2, 3, 4])
+            self.assertEqual(list(cache.get('followers', 5)), [2, 3])
+
+            # the oldest list went to make room
+            self.assertEqual(list(cache._entries), [('followers', 5)])
+
+            db.session.add(Follows(user_following_id=4,
+                                   user_being_followed_id=5))
+            db.session.commit()
+            self.assertEqual(list(cache.get('followers', 5)), [2, 3])
+            clock[0] = 11
+            self.assertEqual(list(cache.get('followers', 5)), [2, 3, 4])
+
+
+class FollowPageTestCase(TestCase):
+    """Paginated following/followers lists."""
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        for i in range(1, 8):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password",
+                               None)
+            user.id = i
+        db.session.commit()
+
+        # 2..7 follow 1, a minute apart; 1 follows back 3 and 6
+        start = datetime(2020, 1, 1)
+        for i in range(2, 8):
+            db.session.add(Follows(user_following_id=i,
+                                   user_being_followed_id=1,
+                                   created_at=start + timedelta(minutes=i)))
+        for i in (3, 6):
+            db.session.add(Follows(user_following_id=1,
+                                   user_being_followed_id=i))
+        db.session.commit()
+
+        self.client = app.test_client()
+        app.config['FOLLOW_PAGE_SIZE'] = 4
+
+    def tearDown(self):
+        app.config['FOLLOW_PAGE_SIZE'] = 48
+        db.session.rollback()
+
+    def test_pages(self):
+        with app.app_context():
+            cards, cursor = follow_page(1, 'followers', viewer_id=1, limit=4)
+            self.assertEqual([c.id for c in cards], [7, 6, 5, 4])
+            self.assertEqual([c.followed for c in cards],
+                             [False, True, False, False])
+
+            cards, last = follow_page(1, 'followers', viewer_id=1,
+                                      before=cursor, limit=4)
+            self.assertEqual([c.id for c in cards], [3, 2])
+            self.assertIsNone(last)
+
+            cards, _ = follow_page(1, 'followers', before='junk')
+            self.assertEqual(len(cards), 6)
+
+    def test_view(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                html = c.get('/users/1/followers').get_data(as_text=True)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+            self.assertIn('@user7', html)
+            self.assertNotIn('@user3', html)
+            self.assertIn('action="/users/stop-following/6"', html)
+            self.assertIn('action="/users/follow/7"', html)
+            # one query for the page and one for the viewer's follow flags
+            self.assertEqual(
+                len([s for s in statements if 'follows' in s
+                     and 'count(' not in s.lower()]), 2)
+
+            cursor = html.split('?before=')[1].split('"')[0]
+            html = c.get(f'/users/1/followers?before={cursor}').get_data(
+                as_text=True)
+            self.assertIn('@user3', html)
+            self.assertNotIn('@user7', html)
+            self.assertNotIn('?before=', html)
@@ -0,0 +1,76 @@
+"""Streamed template rendering tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_streaming.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from streaming import _chunked, FIRST_CHUNK_BYTES
+
+db.create_all()
+
+
+class StreamingTestCase(TestCase):
+    """Test streamed listing pages."""
+
+    def setUp(self):
+        db.session.rollback()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        for i in range(20):
+            db.session.add(User(id=100 + i, username=f"user{i}",
+                                email=f"user{i}@test.com", password="x"))
+        db.session.commit()
+
+        db.session.add_all(Follows(user_being_followed_id=100 + i,
+                                   user_following_id=100)
+                           for i in range(1, 6))
+        db.session.commit()
+
+        app.config['STREAM_TEMPLATES'] = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['STREAM_TEMPLATES'] = False
+        db.session.rollback()
+
+    def test_chunked(self):
+        pieces = ['x' * 100] * 200
+        chunks = list(_chunked(pieces, 4096))
+
+        self.assertEqual(''.join(chunks), 'x' * 20000)
+        self.assertLess(len(chunks[0]), 4096)
+        self.assertGreaterEqual(len(chunks[0]), FIRST_CHUNK_BYTES)
+
+    def test_list_users_streamed(self):
+        resp = self.client.get('/users')
+
+        self.assertTrue(resp.is_streamed)
+        self.assertIn('@user0', str(resp.data))
+        self.assertIn('@user19', str(resp.data))
+
+    def test_no_users_found(self):
+        resp = self.client.get('/users?q=nobody')
+
+        self.assertIn('Sorry, no users found', str(resp.data))
+
+    def test_following_streamed(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+
+            resp = c.get('/users/100/following')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('@user5', str(resp.data))
+            self.assertNotIn('@user6', str(resp.data))
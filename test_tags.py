@@ -0,0 +1,137 @@
+"""#tag and @mention index tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_tags.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, MessageMention, MessageTag, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import tags
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExtractTestCase(TestCase):
+
+    def test_extract(self):
+        self.assertEqual(
+            tags.extract("#Python and #python, @alice@bob #x-y email@host "
+                         "a#b &#39; @alice"),
+            (['python', 'x'], ['alice']))
+
+
+class TagsTestCase(TestCase):
+    """Indexing at write time, timelines and backfill."""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        MessageMention.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+        for i, name in enumerate(['alice', 'bob']):
+            user = User.signup(name, f'{name}@test.com', 'password', None)
+            user.id = i + 1
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, user_id, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            resp = c.post('/messages/new', data={'text': text})
+        self.assertEqual(resp.status_code, 302)
+        return (Message.query.filter_by(user_id=user_id, text=text)
+                .one().id)
+
+    def test_indexed_on_write(self):
+        msg_id = self.post(1, "Hi @bob, see #Flask and @nobody")
+
+        self.assertEqual(
+            [(t.tag, t.message_id, t.author_id) for t in MessageTag.query],
+            [('flask', msg_id, 1)])
+        self.assertEqual(
+            [(m.user_id, m.message_id, m.author_id)
+             for m in MessageMention.query],
+            [(2, msg_id, 1)])
+
+    def test_tag_timeline(self):
+        first = self.post(1, "#flask one")
+        self.post(2, "no tags")
+        second = self.post(2, "#Flask two")
+
+        resp = self.client.get('/tags/FLASK')
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("2 warbles", html)
+        self.assertIn("two", html)
+        self.assertNotIn("no tags", html)
+
+        with app.app_context():
+            messages, cursor = tags.tag_page('flask', limit=1)
+            self.assertEqual([m.id for m in messages], [second])
+            self.assertEqual(cursor, second)
+            messages, cursor = tags.tag_page('flask', before=cursor, limit=1)
+            self.assertEqual([m.id for m in messages], [first])
+            messages, cursor = tags.tag_page('flask', before=cursor, limit=1)
+            self.assertEqual((messages, cursor), ([], None))
+
+    def test_mentions_timeline(self):
+        self.post(1, "hey @bob")
+        self.post(1, "hey @alice")
+
+        resp = app.test_client().get('/mentions')
+        self.assertEqual(resp.status_code, 302)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+            html = c.get('/mentions').get_data(as_text=True)
+
+        self.assertIn("1 warble<", html)
+        self.assertIn("hey @bob", html)
+        self.assertNotIn("hey @alice", html)
+
+    def test_delete_unindexes(self):
+        msg_id = self.post(1, "#gone @bob")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post(f'/messages/{msg_id}/delete')
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(MessageMention.query.count(), 0)
+        self.assertEqual(tags.tag_count('gone'), 0)
+
+    def test_backfill(self):
+        for i in range(5):
+            db.session.add(Message(text=f"old #t{i % 2} @alice", user_id=2))
+        db.session.commit()
+        # already indexed rows are replaced, not duplicated
+        tags.index_messages([{'id': m.id, 'user_id': 2, 'text': m.text}
+                             for m in Message.query.limit(2)])
+        db.session.commit()
+
+        with app.app_context():
+            self.assertEqual(tags.backfill(batch_size=2), 5)
+
+        self.assertEqual(tags.tag_count('t0'), 3)
+        self.assertEqual(tags.tag_count('t1'), 2)
+        self.assertEqual(tags.mention_count(1), 5)
@@ -0,0 +1,60 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_template_cache.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jinja2 import DictLoader, Environment
+
+from template_cache import SharedBytecodeCache
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import create_app
+from template_cache import precompile_templates
+
+
+class TemplateCacheTestCase(TestCase):
+    """Test the shared bytecode cache."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def env(self, source):
+        return Environment(loader=DictLoader({'t.html': source}),
+                           bytecode_cache=SharedBytecodeCache(self.dir))
+
+    def entries(self):
+        return [f for f in os.listdir(self.dir) if f.endswith('.jinja')]
+
+    def test_reused_between_environments(self):
+        self.env('Hi {{ name }}').get_template('t.html')
+        self.assertEqual(len(self.entries()), 1)
+
+        template = self.env('Hi {{ name }}').get_template('t.html')
+        self.assertEqual(template.render(name='you'), 'Hi you')
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_keyed_on_source(self):
+        self.env('old {{ x }}').get_template('t.html')
+        template = self.env('new {{ x }}').get_template('t.html')
+
+        self.assertEqual(template.render(x=1), 'new 1')
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_precompile_templates(self):
+        app = create_app('production', WARM_UP=False,
+                         TEMPLATE_CACHE_DIR=self.dir)
+        names = precompile_templates(app)
+
+        self.assertIn('home.html', names)
+        self.assertGreaterEqual(len(self.entries()), len(names))
@@ -0,0 +1,147 @@
+"""Trending counters tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_trending.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, Message, TrendingCount, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from trending import SlidingWindowCounters, Trending, flush
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class Clock:
+    def __init__(self, now=1_000_000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SlidingWindowTestCase(TestCase):
+    """Counting and ranking, in memory."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.counters = SlidingWindowCounters(bucket_seconds=60,
+                                              window_buckets=10, top_k=2,
+                                              clock=self.clock)
+
+    def test_velocity(self):
+        for _ in range(3):
+            self.counters.record('tag', 'old')
+        self.clock.now += 5 * 60
+        self.counters.record('tag', 'new')
+        self.counters.record('tag', 'new')
+
+        scores = self.counters.scores('tag')
+        self.assertAlmostEqual(scores['old'], 3 * 0.5)
+        self.assertAlmostEqual(scores['new'], 2)
+
+        self.clock.now += 5 * 60
+        self.assertEqual(list(self.counters.scores('tag')), ['new'])
+
+    def test_top_k(self):
+        for key, n in (('a', 1), ('b', 3), ('c', 2)):
+            for _ in range(n):
+                self.counters.record('message', key)
+        self.counters.record('message', 'c', -2)
+
+        self.assertEqual(self.counters.top('message'), [])
+        self.counters.compute_top()
+        self.assertEqual([key for key, _ in self.counters.top('message')],
+                         ['b', 'a'])
+
+
+class TrendingTestCase(TestCase):
+    """Flushing, and the anonymous landing page."""
+
+    def setUp(self):
+        db.session.rollback()
+        TrendingCount.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup('author', 'author@test.com', 'password', None)
+        user.id = 1
+        db.session.add(Message(id=77, text="hot take #hot", user_id=1))
+        db.session.commit()
+
+        self.saved = app.extensions['trending']
+        self.trending = Trending(app, SlidingWindowCounters(top_k=5))
+        # no background thread; the tests refresh by hand
+        self.trending._pid = os.getpid()
+        app.extensions['trending'] = self.trending
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions['trending'] = self.saved
+        db.session.rollback()
+
+    def test_flush_merges_workers(self):
+        one = SlidingWindowCounters()
+        two = SlidingWindowCounters()
+        one.record('tag', 'x', 2)
+        two.record('tag', 'x', 3)
+        two.record('tag', 'y')
+
+        flush(one, db.engine)
+        flush(two, db.engine)
+        flush(one, db.engine)
+
+        self.assertEqual(one.scores('tag'), two.scores('tag'))
+        self.assertAlmostEqual(one.scores('tag')['x'], 5)
+
+        # nothing left to flush: flushing again changes nothing
+        flush(two, db.engine)
+        self.assertAlmostEqual(two.scores('tag')['x'], 5)
+
+    def test_likes_and_posts_reach_landing_page(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post('/users/add_like/77', headers={'Referer': '/'})
+            c.post('/messages/new', data={'text': "more #hot #tea"})
+            c.get('/logout')
+
+        self.trending.refresh()
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            html = self.client.get('/').get_data(as_text=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertIn("hot take #hot", html)
+        self.assertIn('href="/tags/hot"', html)
+        self.assertIn('href="/tags/tea"', html)
+        self.assertFalse([s for s in statements
+                          if 'messages' in s or 'likes' in s])
+
+    def test_unlike(self):
+        self.trending.record_like(77, True)
+        self.trending.record_like(77, False)
+        self.trending.refresh()
+
+        self.assertEqual(self.trending.snapshot()['messages'], [])
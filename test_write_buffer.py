@@ -0,0 +1,87 @@
+"""Group-commit write buffer tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_write_buffer.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Event, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from write_buffer import MessageWriteBuffer
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class WriteBufferTestCase(TestCase):
+    """Test coalesced message writes."""
+
+    def setUp(self):
+        db.session.rollback()
+        Event.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        self.testuser.id = 10
+        self.testuser_id = 10
+
+        db.session.commit()
+
+        self.buf = MessageWriteBuffer(db.engine, window_ms=20)
+
+    def tearDown(self):
+        self.buf.close()
+        db.session.rollback()
+
+    def test_batch_is_committed(self):
+        writes = [self.buf.submit(self.testuser_id, f"msg {i}")
+                  for i in range(5)]
+        for w in writes:
+            w.wait(5)
+
+        self.assertEqual(Message.query.count(), 5)
+
+    def test_bad_row_fails_alone(self):
+        good = self.buf.submit(self.testuser_id, "fine")
+        bad = self.buf.submit(self.testuser_id, None)
+
+        good.wait(5)
+        with self.assertRaises(Exception):
+            bad.wait(5)
+
+        self.assertEqual([m.text for m in Message.query.all()], ["fine"])
+        # each event committed (or not) with its message
+        self.assertEqual([(e.type, e.data['text']) for e in Event.query],
+                         [('message.created', "fine")])
+
+    def test_add_message_coalesced(self):
+        app.config['MESSAGE_WRITE_COALESCING'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.post("/messages/new", data={"text": "Hello"},
+                              follow_redirects=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("Hello", str(resp.data))
+        finally:
+            app.config['MESSAGE_WRITE_COALESCING'] = False
@@ -0,0 +1,250 @@
+"""Trending warbles and #tags from sliding-window counters.
+
+`like_or_unlike()` counts likes (and unlikes) per message and
+`messages_add()` counts posts per #tag, in memory, in time buckets of
+`TRENDING_BUCKET_SECONDS`. A thing's score is its count over the last
+`TRENDING_WINDOW_BUCKETS` buckets, with older buckets weighing linearly
+less, so it tracks velocity rather than all-time totals.
+
+Every `TRENDING_FLUSH_SECONDS` a background thread in each worker adds
+its new counts to the `trending_counts` table, drops buckets that have
+left the window, and reads the window back, so every worker ranks by
+everyone's counts and a restart loses at most one interval. It then
+precomputes the top `TRENDING_TOP_K` of each kind, loading the text and
+author of the top warbles by primary key.
+
+Reading the trending lists (e.g. for the anonymous landing page) only
+returns that precomputed snapshot: no query per visitor, and nothing
+ever scans `likes` or `messages`.
+"""
+
+import heapq
+import os
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import select
+
+import sharding
+from models import db, Message, TrendingCount, User
+
+KINDS = ('message', 'tag')
+
+TrendingAuthor = namedtuple(
+    'TrendingAuthor', 'id username image_url header_image_url')
+TrendingMessage = namedtuple('TrendingMessage', 'id text timestamp user')
+
+
+class SlidingWindowCounters:
+    """Counts per (kind, key) in time buckets, with a precomputed top K."""
+
+    def __init__(self, bucket_seconds=60, window_buckets=60, top_k=10,
+                 clock=time.time):
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = window_buckets
+        self.top_k = top_k
+        self.clock = clock
+        self._lock = threading.Lock()
+        # {(kind, key): {bucket: count}}, flushed and unflushed alike
+        self._counts = {}
+        # {(kind, key, bucket): count} not yet in the database
+        self._pending = {}
+        self._top = {kind: [] for kind in KINDS}
+
+    def bucket(self, now=None):
+        return int((self.clock() if now is None else now)
+                   // self.bucket_seconds)
+
+    def oldest_bucket(self, now=None):
+        return self.bucket(now) - self.window_buckets + 1
+
+    def record(self, kind, key, amount=1):
+        key = str(key)
+        bucket = self.bucket()
+        with self._lock:
+            buckets = self._counts.setdefault((kind, key), {})
+            buckets[bucket] = buckets.get(bucket, 0) + amount
+            pending = (kind, key, bucket)
+            self._pending[pending] = self._pending.get(pending, 0) + amount
+
+    def scores(self, kind):
+        """{key: score} for `kind`, newest buckets weighing the most."""
+
+        current = self.bucket()
+        oldest = self.oldest_bucket()
+        scores = {}
+        with self._lock:
+            for (k, key), buckets in self._counts.items():
+                if k != kind:
+                    continue
+                score = sum(count * (self.window_buckets - (current - b))
+                            / self.window_buckets
+                            for b, count in buckets.items() if b >= oldest)
+                if score > 0:
+                    scores[key] = score
+        return scores
+
+    def compute_top(self):
+        """Recompute the top K of every kind from the counters."""
+
+        top = {kind: heapq.nlargest(self.top_k, self.scores(kind).items(),
+                                    key=lambda item: (item[1], item[0]))
+               for kind in KINDS}
+        self._top = top
+        return top
+
+    def top(self, kind):
+        """The last computed [(key, score), ...] for `kind`, best first."""
+
+        return self._top[kind]
+
+    def take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore_pending(self, pending):
+        """Put back counts that failed to flush."""
+
+        with self._lock:
+            for item, amount in pending.items():
+                self._pending[item] = self._pending.get(item, 0) + amount
+
+    def load(self, rows):
+        """Replace the counters with `rows` of (kind, key, bucket, count)
+        from the database, plus whatever hasn't been flushed yet."""
+
+        counts = {}
+        for kind, key, bucket, count in rows:
+            counts.setdefault((kind, key), {})[bucket] = count
+        with self._lock:
+            for (kind, key, bucket), amount in self._pending.items():
+                buckets = counts.setdefault((kind, key), {})
+                buckets[bucket] = buckets.get(bucket, 0) + amount
+            self._counts = counts
+
+
+def flush(counters, engine):
+    """Add `counters`' new counts to the database and reload the window."""
+
+    table = TrendingCount.__table__
+    oldest = counters.oldest_bucket()
+    pending = counters.take_pending()
+    try:
+        with engine.begin() as conn:
+            for (kind, key, bucket), amount in pending.items():
+                if not amount or bucket < oldest:
+                    continue
+                match = ((table.c.kind == kind) & (table.c.key == key)
+                         & (table.c.bucket == bucket))
+                updated = conn.execute(table.update().where(match).values(
+                    count=table.c.count + amount)).rowcount
+                if not updated:
+                    conn.execute(table.insert().values(
+                        kind=kind, key=key, bucket=bucket, count=amount))
+            conn.execute(table.delete().where(table.c.bucket < oldest))
+    except Exception:
+        counters.restore_pending(pending)
+        raise
+
+    rows = engine.execute(
+        select([table.c.kind, table.c.key, table.c.bucket, table.c.count])
+        .where(table.c.bucket >= oldest)).fetchall()
+    counters.load(rows)
+
+
+def load_messages(message_ids):
+    """TrendingMessages for `message_ids` that still exist, by id."""
+
+    router = sharding.get_router()
+    if router:
+        found = [router.get(i) for i in message_ids]
+        found = [m for m in found if m is not None]
+    else:
+        found = (Message
+                 .query
+                 .join(User)
+                 .filter(Message.id.in_(message_ids))
+                 .all())
+
+    return {m.id: TrendingMessage(
+                m.id, m.text, m.timestamp,
+                TrendingAuthor(m.user.id, m.user.username, m.user.image_url,
+                               m.user.header_image_url))
+            for m in found}
+
+
+class Trending:
+    """An app's counters, with the worker thread that flushes them."""
+
+    def __init__(self, app, counters, flush_seconds=10):
+        self.app = app
+        self.counters = counters
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pid = None
+        self._messages = {}
+        self._snapshot = {'messages': [], 'tags': []}
+
+    def _ensure_thread(self):
+        # The flush thread doesn't survive a fork; start one per process.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='trending-flush',
+                         daemon=True).start()
+
+    def record_like(self, message_id, liked):
+        self._ensure_thread()
+        self.counters.record('message', message_id, 1 if liked else -1)
+
+    def record_post(self, tags):
+        self._ensure_thread()
+        for tag in tags:
+            self.counters.record('tag', tag)
+
+    def snapshot(self):
+        """{'messages': [TrendingMessage], 'tags': [(tag, score)]}."""
+
+        self._ensure_thread()
+        return self._snapshot
+
+    def refresh(self):
+        """Flush counts, recompute the top K, and load the top warbles."""
+
+        with self.app.app_context():
+            flush(self.counters, db.get_engine(self.app))
+            top = self.counters.compute_top()
+
+            ids = [int(key) for key, _ in top['message']]
+            missing = [i for i in ids if i not in self._messages]
+            if missing:
+                self._messages.update(load_messages(missing))
+            self._messages = {i: self._messages[i] for i in ids
+                              if i in self._messages}
+
+        self._snapshot = {
+            'messages': [self._messages[i] for i in ids
+                         if i in self._messages],
+            'tags': top['tag'],
+        }
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            try:
+                self.refresh()
+            except Exception:
+                self.app.logger.exception("trending refresh failed")
+            time.sleep(self.flush_seconds)
+
+
+def init_app(app):
+    config = app.config
+    counters = SlidingWindowCounters(config['TRENDING_BUCKET_SECONDS'],
+                                     config['TRENDING_WINDOW_BUCKETS'],
+                                     config['TRENDING_TOP_K'])
+    app.extensions['trending'] = Trending(app, counters,
+                                          config['TRENDING_FLUSH_SECONDS'])
@@ -0,0 +1,177 @@
+"""Group-commit write buffering for new messages.
+
+When `MESSAGE_WRITE_COALESCING` is on, `messages_add()` hands each new
+warble to a MessageWriteBuffer instead of committing it itself. A
+background thread collects everything posted within a short window
+(`MESSAGE_WRITE_WINDOW_MS`) and writes the whole batch with multi-row
+INSERTs in a single transaction, so a burst of posts costs one commit
+instead of one per post.
+
+Each message's `message.created` event is inserted in the same
+transaction, so the log has an event exactly for the posts that
+committed.
+
+Each caller gets its own PendingWrite back and blocks on it until its row
+is committed (or has failed), so the redirect after posting still sees the
+new message.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+
+import events
+import snowflake
+from models import db, Event, Message
+
+_buffer_lock = threading.Lock()
+
+
+class PendingWrite:
+    """A message waiting in the buffer; wait() returns once it is durable."""
+
+    def __init__(self, row):
+        self.row = row
+        self.event = events.event_row('message.created',
+                                      message_id=row['id'],
+                                      user_id=row['user_id'],
+                                      text=row['text'])
+        self.error = None
+        self._done = threading.Event()
+
+    def resolve(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Block until this row is committed; re-raise its error if it failed."""
+
+        if not self._done.wait(timeout):
+            raise TimeoutError("message write was not flushed in time")
+        if self.error is not None:
+            raise self.error
+
+
+def insert_messages(conn, rows):
+    """Insert `rows` (dicts of message columns) as one multi-row INSERT."""
+
+    conn.execute(Message.__table__.insert().values(rows))
+
+
+def write_batch(conn, batch):
+    """Insert the PendingWrites' messages and their events."""
+
+    insert_messages(conn, [w.row for w in batch])
+    conn.execute(Event.__table__.insert(), [w.event for w in batch])
+
+
+class MessageWriteBuffer:
+    """Coalesce concurrent message inserts into batched commits."""
+
+    def __init__(self, engine, window_ms=5, max_batch=200):
+        self.engine = engine
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="message-write-buffer",
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, text, timestamp=None):
+        """Queue a message for the next batch and return its PendingWrite."""
+
+        write = PendingWrite({
+            # minted here rather than at insert, so callers know the id
+            'id': snowflake.next_id(at=timestamp),
+            'user_id': user_id,
+            'text': text,
+            'timestamp': timestamp or datetime.utcnow(),
+        })
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("message write buffer is closed")
+            self._pending.append(write)
+            self._cond.notify()
+
+        return write
+
+    def close(self):
+        """Flush whatever is still queued and stop the writer thread."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+
+                # Hold the first write for the coalescing window so that
+                # anything posted meanwhile rides along in the same commit.
+                deadline = time.monotonic() + self.window
+                while (len(self._pending) < self.max_batch
+                       and not self._closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            with self.engine.begin() as conn:
+                write_batch(conn, batch)
+        except Exception:
+            # One bad row must not fail everybody else's post: retry them
+            # one at a time so each request gets its own outcome.
+            for write in batch:
+                try:
+                    with self.engine.begin() as conn:
+                        write_batch(conn, [write])
+                except Exception as exc:
+                    write.resolve(exc)
+                else:
+                    write.resolve()
+        else:
+            for write in batch:
+                write.resolve()
+
+
+def get_write_buffer():
+    """Return this process's MessageWriteBuffer, starting it if needed.
+
+    The buffer is created lazily and per-pid, since the writer thread does
+    not survive a fork into prefork workers.
+    """
+
+    app = current_app._get_current_object()
+
+    with _buffer_lock:
+        buf = app.extensions.get('message_write_buffer')
+
+        if buf is None or buf[0] != os.getpid():
+            buf = (os.getpid(), MessageWriteBuffer(
+                db.engine,
+                window_ms=app.config['MESSAGE_WRITE_WINDOW_MS'],
+                max_batch=app.config['MESSAGE_WRITE_MAX_BATCH'],
+            ))
+            app.extensions['message_write_buffer'] = buf
+
+    return buf[1]
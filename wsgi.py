@@ -0,0 +1,10 @@
+"""The app for WSGI servers, warmed up (see WARM_UP in config.py).
+
+With a preloading prefork server the warm-up happens once, in the master:
+
+    gunicorn --preload wsgi:app
+"""
+
+from app import create_app
+
+app = create_app(serve=True)